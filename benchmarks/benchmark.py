@@ -0,0 +1,379 @@
+#!/usr/bin/env python2
+
+""" Benchmarks of the package manager on synthetic repositories served by a
+local HTTP server. The results are written as JSON and can be compared with
+a baseline written before. """
+
+import optparse
+import json
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import random
+import hashlib
+import tarfile
+import platform
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import posixpath
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pm
+
+
+class _RepositoryRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """ Serve the files below the root of the server. The repository index
+    can be hidden to benchmark the directory listing fallback. """
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split('?', 1)[0].split('#', 1)[0]))
+        return os.path.join(self.server.root, *[p for p in path.split('/') if p and p not in ('.', '..')])
+
+    def send_head(self):
+        if self.server.hideIndex and os.path.basename(self.path).startswith(pm._repositoryIndexFile):
+            self.send_error(404, "File not found")
+            return None
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RepositoryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server for the repository at root on a free local port. """
+    daemon_threads = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _RepositoryRequestHandler)
+        self.root = root
+        self.hideIndex = False
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _writeTarball(path, directory, size, seed):
+    """ Write a gzip compressed tarball of directory containing a file of
+    size bytes of pseudo random, hardly compressible data. """
+    sourcePath = os.path.join(os.path.dirname(path), directory)
+    os.makedirs(sourcePath)
+    with open(os.path.join(sourcePath, 'data.bin'), 'wb') as f:
+        for counter in xrange(size // 64):
+            f.write(hashlib.sha512('{0}-{1}'.format(seed, counter)).digest())
+    with open(os.path.join(sourcePath, 'README'), 'w') as f:
+        f.write("synthetic package {0}\n".format(directory))
+    tf = tarfile.open(path, 'w:gz', compresslevel=1)
+    try:
+        tf.add(sourcePath, arcname=directory)
+    finally:
+        tf.close()
+    shutil.rmtree(sourcePath)
+
+
+def generateRepository(repositoryPath, packages, depth, width, largePackages, tarballSize, seed=0):
+    """ Write a synthetic repository with about the given number of packages
+    to repositoryPath and return the names of the roots of its dependency
+    graphs. The repository contains a chain of depth packages, a package with
+    width direct dependencies, a diamond shaped graph of layers of width
+    packages, largePackages archive packages with tarballs of tarballSize
+    bytes, and random acyclic filler packages, some in several versions with
+    version constraints.
+
+    """
+    rand = random.Random(seed)
+    configs = {}
+
+    def add(name, dependencies=(), version='1.0', **extra):
+        config = {'name': name, 'version': version, 'type': 'meta', 'dependencies': list(dependencies),
+                'description': "synthetic {0} package number {1}".format(name.rstrip('0123456789'),
+                len(configs))}
+        config.update(extra)
+        configs['{0}-{1}.json'.format(name, version)] = config
+
+    for i in range(depth):
+        add('deep{0}'.format(i), i + 1 < depth and ['deep{0}'.format(i + 1)] or [])
+    for i in range(width):
+        add('leaf{0}'.format(i))
+    add('wide', ['leaf{0}'.format(i) for i in range(width)])
+    layers = max(2, width // 10)
+    layerWidth = max(2, width // layers)
+    for layer in range(layers):
+        for i in range(layerWidth):
+            dependencies = []
+            if layer + 1 < layers:
+                dependencies = ['diamond{0}x{1}'.format(layer + 1, j) for j in range(layerWidth)]
+            add('diamond{0}x{1}'.format(layer, i), dependencies)
+    add('diamond', ['diamond0x{0}'.format(i) for i in range(layerWidth)])
+
+    sourcesPath = os.path.join(repositoryPath, pm._sourcesDir)
+    installScriptsPath = os.path.join(repositoryPath, pm._installScriptsDir)
+    for d in [os.path.join(repositoryPath, pm._availablePackagesDir), sourcesPath, installScriptsPath,
+            os.path.join(repositoryPath, pm._pmDir)]:
+        os.makedirs(d)
+    shutil.copy(pm._initFilePath, os.path.join(repositoryPath, pm._pmDir))
+    with open(os.path.join(installScriptsPath, 'install.sh'), 'w') as f:
+        f.write("#!/bin/sh\ntrue\n")
+    for i in range(largePackages):
+        name = 'large{0}'.format(i)
+        sourceFile = '{0}-1.0.tar.gz'.format(name)
+        _writeTarball(os.path.join(sourcesPath, sourceFile), name + '-1.0', tarballSize, seed + i)
+        add(name, type='archive', sourceFile=sourceFile, installScript='install.sh')
+    add('large', ['large{0}'.format(i) for i in range(largePackages)])
+
+    fillers = max(0, packages - len(configs))
+    for i in range(fillers):
+        # depend on packages with higher numbers only, so the graph is acyclic
+        candidates = range(i + 1, min(fillers, i + 50))
+        dependencies = ['filler{0}'.format(j) for j in rand.sample(candidates, min(len(candidates), 3))]
+        if i % 10 == 0:
+            for version in ['1.0', '1.1', '2.0']:
+                add('filler{0}'.format(i), dependencies, version)
+        elif i % 10 == 1 and dependencies:
+            dependencies[0] += '<2'
+            add('filler{0}'.format(i), dependencies)
+        else:
+            add('filler{0}'.format(i), dependencies)
+
+    for configFile, config in configs.iteritems():
+        with open(os.path.join(repositoryPath, pm._availablePackagesDir, configFile), 'w') as f:
+            json.dump(config, f)
+    pm.writeRepositoryIndex(repositoryPath)
+    roots = ['deep0', 'wide', 'diamond', 'large']
+    if fillers:
+        roots.append('filler0')
+    return roots
+
+
+class Benchmarks(object):
+    """ Time the phases of the package manager against the repository
+    served at repositoryURL. Every benchmark is run repeat times, the output
+    of the package manager is discarded.
+
+    """
+    def __init__(self, repositoryURL, workPath, roots, server, repeat):
+        self._repositoryURL = repositoryURL
+        self._workPath = workPath
+        self._roots = roots
+        self._server = server
+        self._repeat = repeat
+        self.results = {}
+
+    def _packageManager(self):
+        return pm.PackageManager({'packageManagerDir': os.path.join(self._workPath, 'pm'),
+                'packageRepositoryURL': self._repositoryURL,
+                'installationEnvironmentVariables': {'LPM_INSTALL_PREFIX': os.path.join(self._workPath,
+                'prefix')}})
+
+    def _remove(self, *paths):
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def _quietly(self, function, *args):
+        """ Call function with its output discarded. """
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            return function(*args)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def measure(self, name, function, setup=None):
+        """ Run setup and function repeat times and record the times of
+        function under name. """
+        runs = []
+
+        def run():
+            args = setup is not None and setup() or ()
+            startTime = time.time()
+            function(*args)
+            return time.time() - startTime
+
+        for i in range(self._repeat):
+            runs.append(self._quietly(run))
+        runs.sort()
+        self.results[name] = {'min': runs[0], 'median': runs[len(runs) // 2], 'max': runs[-1], 'runs': runs}
+        print "{0:<24} {1:10.4f} s (min {2:.4f} s, max {3:.4f} s)".format(name, runs[len(runs) // 2],
+                runs[0], runs[-1])
+
+    def run(self):
+        base = os.path.join(self._workPath, 'pm')
+        availablePath = os.path.join(base, pm._availablePackagesDir)
+        statePath = os.path.join(base, pm._repositoryStateFile)
+        packageIndexPath = availablePath + pm._packageIndexSuffix
+        searchIndexPath = availablePath + pm._searchIndexSuffix
+
+        # updates
+        def emptyAvailablePackages():
+            self._remove(availablePath, statePath)
+            return (self._packageManager(),)
+        self.measure('update.index', lambda p: p.updateAvailablePackages(), emptyAvailablePackages)
+        self.measure('update.noChanges', lambda p: p.updateAvailablePackages(),
+                lambda: (self._packageManager(),))
+        self._server.hideIndex = True
+        try:
+            self.measure('update.listing', lambda p: p.updateAvailablePackages(), emptyAvailablePackages)
+        finally:
+            self._server.hideIndex = False
+        self._quietly(self._packageManager().updateAvailablePackages)
+
+        # startup
+        def coldStart():
+            self._remove(packageIndexPath)
+            return (self._packageManager(),)
+        self.measure('startup.cold', lambda p: p._availablePackages, coldStart)
+        self.measure('startup.warm', lambda p: p._availablePackages, lambda: (self._packageManager(),))
+
+        # planning, the way installPackages does it
+        def plan(p, roots):
+            resolved = p._resolveVersions([(name, None) for name in roots])
+            pm.DependencyGraph(resolved).dependencies(roots)
+
+        def loadedPackageManager():
+            p = self._packageManager()
+            p._availablePackages
+            p._installedPackages
+            return (p,)
+        for root in self._roots:
+            self.measure('plan.' + root, lambda p: plan(p, [root]), loadedPackageManager)
+        self.measure('plan.all', lambda p: plan(p, sorted(p._availablePackages)), loadedPackageManager)
+
+        # search
+        def coldSearch():
+            self._remove(searchIndexPath)
+            return (self._packageManager(),)
+        self.measure('search.cold', lambda p: p.searchPackages(['filler1']), coldSearch)
+        self.measure('search.warm', lambda p: p.searchPackages(['filler1']), lambda: (self._packageManager(),))
+        self.measure('search.fuzzy', lambda p: p.searchPackages(['dimaond']), lambda: (self._packageManager(),))
+        self.measure('search.regex', lambda p: p.searchPackages(['^filler1.*9$'], regex=True),
+                lambda: (self._packageManager(),))
+
+        # download and unpack of the large packages
+        def archivePackages():
+            p = self._packageManager()
+            return p, [q for q in p._availablePackages.values() if q.packageType == 'archive']
+
+        def emptySources():
+            p = self._packageManager()
+            self._remove(p._sourcesPath, p._installScriptsPath)
+            os.makedirs(p._sourcesPath)
+            os.makedirs(p._installScriptsPath)
+            return archivePackages()
+        self.measure('download', lambda p, packages: p.downloadPackages(packages), emptySources)
+
+        def unpack(p, packages):
+            for q in packages:
+                q._unpackSource(p._sourcesPath, p._buildPath)
+        self.measure('unpack', unpack, archivePackages)
+        return self.results
+
+
+def compare(results, baseline, threshold, minDelta):
+    """ Print the change of the fastest run of every benchmark against
+    baseline and return the names of the benchmarks which got slower by more
+    than the threshold fraction and more than minDelta seconds. The fastest
+    run is the one least disturbed by other load on the machine.
+
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['min']
+        new = results[name]['min']
+        change = (new - old) / max(old, 1e-9)
+        marker = ''
+        if change > threshold and new - old > minDelta:
+            regressions.append(name)
+            marker = '  REGRESSION'
+        print "{0:<24} {1:10.4f} s -> {2:10.4f} s ({3:+.1%}){4}".format(name, old, new, change, marker)
+    return regressions
+
+
+def main():
+    optParser = optparse.OptionParser(usage="usage: %prog [options]", description=__doc__)
+    optParser.add_option('--packages', dest='packages', type='int', default=5000, \
+            help="number of packages in the repository (default %default)")
+    optParser.add_option('--depth', dest='depth', type='int', default=500, \
+            help="length of the dependency chain (default %default)")
+    optParser.add_option('--width', dest='width', type='int', default=200, \
+            help="number of direct dependencies of the wide package (default %default)")
+    optParser.add_option('--large-packages', dest='largePackages', type='int', default=3, \
+            help="number of packages with large tarballs (default %default)")
+    optParser.add_option('--tarball-mb', dest='tarballMB', type='float', default=16, \
+            help="size of the large tarballs in MB (default %default)")
+    optParser.add_option('--repeat', dest='repeat', type='int', default=5, \
+            help="number of runs of every benchmark (default %default)")
+    optParser.add_option('--seed', dest='seed', type='int', default=0, \
+            help="seed of the random repository (default %default)")
+    optParser.add_option('-o', '--output', dest='output', metavar='FILE', \
+            help="write the results as JSON to FILE")
+    optParser.add_option('--baseline', dest='baseline', metavar='FILE', \
+            help="compare with the results in FILE and exit with 1 on regressions")
+    optParser.add_option('--threshold', dest='threshold', type='float', default=0.1, \
+            help="relative slowdown of the fastest run counted as regression (default %default)")
+    optParser.add_option('--min-delta', dest='minDelta', type='float', default=0.005, \
+            help="slowdowns below this number of seconds are no regressions (default %default)")
+    (opts, args) = optParser.parse_args()
+    if args:
+        optParser.error("No arguments expected")
+    if opts.repeat < 1:
+        optParser.error("--repeat must be at least 1")
+
+    parameters = {'packages': opts.packages, 'depth': opts.depth, 'width': opts.width,
+            'largePackages': opts.largePackages, 'tarballMB': opts.tarballMB, 'seed': opts.seed}
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != parameters:
+            optParser.error("Baseline was run with different parameters: {0}".format(baseline['parameters']))
+
+    workPath = tempfile.mkdtemp(prefix='pm-benchmark-')
+    try:
+        repositoryPath = os.path.join(workPath, 'repository')
+        print "generating repository in {0}".format(repositoryPath)
+        roots = generateRepository(repositoryPath, opts.packages, opts.depth, opts.width, opts.largePackages,
+                int(opts.tarballMB * 1024 * 1024), opts.seed)
+        server = RepositoryServer(repositoryPath)
+        try:
+            benchmarks = Benchmarks(server.url, workPath, roots, server, opts.repeat)
+            results = benchmarks.run()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(workPath)
+
+    report = {'parameters': parameters,
+            'repeat': opts.repeat,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'version': pm._metadata['version'],
+            'time': time.time(),
+            'results': results}
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, sort_keys=True, indent=4, separators=(',', ': '))
+    if baseline is not None:
+        print
+        print "compared with {0}:".format(opts.baseline)
+        regressions = compare(results, baseline['results'], opts.threshold, opts.minDelta)
+        if regressions:
+            print "{0} benchmarks are more than {1:.0%} slower: {2}".format(len(regressions), opts.threshold,
+                    ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -10,23 +10,92 @@ import stat
 import subprocess
 import tarfile
 import shutil
-from urllib2 import urlopen, HTTPError
-from urlparse import urljoin
+import tempfile
+import threading
+import Queue
+import time
+import hashlib
+import heapq
+import operator
+import itertools
+from collections import deque
+import gzip
+import marshal
+import bisect
+import difflib
+from StringIO import StringIO
+from urllib2 import urlopen, Request, HTTPError, URLError
+from urlparse import urljoin, urlsplit
+import urllib
+import httplib
 import re
 import warnings
+import contextlib
+import cProfile
+import socket
+import sqlite3
+import BaseHTTPServer
+import SocketServer
+import cgi
+import struct
+import zlib
+import email.utils
+import errno
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not reported there
+    resource = None
 
 
 _emptyConfig = {'packageManagerDir': '~/local/packageManager',
         'packageRepositoryURL': 'http://',
+        'packageRepositoryURLs': [],
         'installationEnvironmentVariables': {'LPM_INSTALL_PREFIX': '~/local'},
+        'sourcesCacheMaxSizeMB': 0,
+        'binaryCache': False,
+        'incrementalBuilds': False,
+        'installStore': False,
         }
 
 _availablePackagesDir = 'availablePackages'
+# installed packages were kept as config files in this directory before the database
 _installedPackagesDir = 'installedPackages'
+_installedDatabaseFile = 'installed.sqlite'
 _sourcesDir = 'sources'
 _installScriptsDir = 'installScripts'
 _buildDir = 'build'
+_binariesDir = 'binaries'
+_deltasDir = 'deltas'
+_gitDir = 'git'
+_storeDir = 'store'
+_profilesDir = 'profiles'
 _pmDir = 'pm'
+_repositoryIndexFile = 'repositoryIndex.json'
+_repositoryStateFile = 'repositoryState.json'
+_packageIndexSuffix = '.index'
+_lockfileFormatVersion = 1
+_searchIndexSuffix = '.search'
+
+_defaultDownloadJobs = 4
+_defaultBuildJobs = 1
+_downloadChunkSize = 64 * 1024
+# seconds without data after which a connection counts as stalled
+_connectionTimeout = 30
+# rounds over all mirrors after the first one, waiting longer before each
+_downloadRetries = 2
+_retryDelay = 1.0
+# source file deltas are made of blocks of this size and used if smaller than this part of the file
+_deltaBlockSize = 2048
+_maxDeltaRatio = 0.5
+_deltaMagic = 'LPMDELTA1'
+# chunk size for reading the new file of a delta and maximum literal record size
+_deltaWindowSize = 1024 * 1024
+# base and new source checksums of deltas not used as they were too large
+_rejectedDeltasFile = '.rejectedDeltas.json'
+_defaultServePort = 8000
+# seconds after which the repository proxy updates the available packages from upstream
+_serveUpdateInterval = 60
 
 # read metadata from __init__.py
 _localPMDirPath = os.path.dirname(os.path.realpath(__file__))
@@ -38,169 +107,2546 @@ class PackageError(StandardError): pass
 class PackageManagerError(StandardError): pass
 
 
+def _formatSize(numBytes):
+    """ Return a human readable representation of a byte count. """
+    size = float(numBytes)
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    if unit == 'B':
+        return '{0} B'.format(numBytes)
+    return '{0:.1f} {1}'.format(size, unit)
+
+
+def _unpackedMarkerPath(buildPath, packageName):
+    """ Path of the file recording that the source of packageName was
+    unpacked into its build directory while it was downloaded. """
+    return os.path.join(buildPath, packageName + '.unpacked')
+
+
+def _sourceStampPath(buildPath, packageName):
+    """ Path of the file recording from which source archive the build
+    directory of packageName was unpacked in incremental mode. """
+    return os.path.join(buildPath, packageName + '.source')
+
+
+def _directoryUsage(path):
+    """ Return the total size and the newest modification time of the files
+    below path, which may also be a single file. Symlinks are not followed. """
+    st = os.lstat(path)
+    size, mtime = st.st_size, st.st_mtime
+    if stat.S_ISDIR(st.st_mode):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                st = os.lstat(os.path.join(root, name))
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+    return size, mtime
+
+
+def _snapshotTree(path):
+    """ Map the paths of all files and symlinks below path to their size,
+    modification time and inode. """
+    snapshot = {}
+    for root, dirs, files in os.walk(path):
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            filePath = os.path.join(root, name)
+            st = os.lstat(filePath)
+            snapshot[filePath] = (st.st_size, st.st_mtime, st.st_ino)
+    return snapshot
+
+
+def _treeFiles(path):
+    """ Return the files and symlinks below path as list of their paths
+    relative to path and their absolute paths. """
+    files = []
+    for root, dirs, fileNames in os.walk(path):
+        # os.walk lists symlinks to directories with the directories
+        for fileName in fileNames + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            source = os.path.join(root, fileName)
+            files.append((os.path.relpath(source, path), source))
+    return files
+
+
+def _fileManifest(paths):
+    """ Map each of paths to its size and sha256 checksum. Symlinks have
+    neither, paths which don't exist any more are left out. """
+    manifest = {}
+    for path in paths:
+        if os.path.islink(path):
+            manifest[path] = (None, None)
+        elif os.path.isfile(path):
+            manifest[path] = (os.path.getsize(path), _sha256File(path))
+    return manifest
+
+
+class _TarStreamExtractor(object):
+    """ Extract a tar archive while its data is written to the extractor in
+    chunks. gzip and bzip2 archives are decompressed by tarfile, xz archives
+    by an xz process.
+
+    """
+    def __init__(self, archiveName, unpackTo):
+        self._archiveName = archiveName
+        self._error = None
+        if os.path.isdir(unpackTo):
+            shutil.rmtree(unpackTo)
+        os.makedirs(unpackTo)
+        if archiveName.endswith(('.xz', '.txz')):
+            try:
+                self._process = subprocess.Popen(['xz', '-dc'], stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE)
+            except OSError as e:
+                raise PackageError("Can not run xz to unpack {0}: {1}".format(archiveName, e))
+            self._input = self._process.stdin
+            output = self._process.stdout
+            mode = 'r|'
+        else:
+            self._process = None
+            readFd, writeFd = os.pipe()
+            self._input = os.fdopen(writeFd, 'wb')
+            output = os.fdopen(readFd, 'rb')
+            mode = 'r|*'
+        self._thread = threading.Thread(target=self._extract, args=(output, mode, unpackTo))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _extract(self, fileobj, mode, unpackTo):
+        try:
+            tf = tarfile.open(fileobj=fileobj, mode=mode)
+            try:
+                tf.extractall(path=unpackTo)
+            finally:
+                tf.close()
+        except Exception as e:
+            self._error = e
+        finally:
+            # read everything after the end of the archive so writes never block
+            try:
+                while fileobj.read(_downloadChunkSize):
+                    pass
+            except IOError:
+                pass
+            fileobj.close()
+
+    def write(self, data):
+        try:
+            self._input.write(data)
+        except IOError as e:
+            # the extraction failed, the error is reported by close
+            if self._error is None:
+                self._error = e
+
+    def close(self):
+        """ Wait for the extraction to finish and raise a PackageError if it
+        failed. """
+        try:
+            self._input.close()
+        except IOError:
+            pass
+        self._thread.join()
+        if self._process is not None and self._process.wait() != 0 and self._error is None:
+            self._error = "xz exited with status {0}".format(self._process.returncode)
+        if self._error is not None:
+            raise PackageError("Error while unpacking {0}: {1}".format(self._archiveName, self._error))
+
+
+def _readMarshalled(path, signature):
+    """ Return the object marshalled to path together with signature, or
+    None if the file doesn't exist or was written with another signature. """
+    try:
+        with open(path, 'rb') as f:
+            fileSignature, obj = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if fileSignature != signature:
+        return None
+    return obj
+
+
+def _writeMarshalled(path, signature, obj):
+    """ Atomically write obj together with signature to path. """
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump((signature, obj), f)
+        os.rename(tmpPath, path)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+def _sha256File(path):
+    """ Return the hex encoded sha256 checksum of the file at path. """
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(_downloadChunkSize)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _git(arguments, gitDir=None, cwd=None):
+    """ Run git with arguments on the repository gitDir or in cwd and
+    return its stripped output. Raises PackageError if it fails. """
+    command = ['git']
+    if gitDir is not None:
+        command.append('--git-dir=' + gitDir)
+    try:
+        process = subprocess.Popen(command + arguments, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise PackageError("Can not call git: {0}".format(e))
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        raise PackageError("git {0} failed: {1}".format(' '.join(arguments), errors.strip()))
+    return output.strip()
+
+
+def _partPath(destination):
+    """ The path of the partial file of a download to destination. """
+    return os.path.join(os.path.dirname(destination), '.' + os.path.basename(destination) + '.part')
+
+
+def _validatorPath(destination):
+    """ The path of the file keeping the ETag or Last-Modified date of the
+    partial file of a download to destination. """
+    return _partPath(destination) + '.validator'
+
+
+def _isCachedFileValid(path, sha256, size):
+    """ Return True if the file at path exists and matches the given
+    checksum and size. Files without a known checksum are never valid as
+    they can not be verified.
+
+    """
+    if sha256 is None or not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    return _sha256File(path) == sha256
+
+
+def _runDependencyOrdered(function, packages, jobs, onStart=None, onFinish=None):
+    """ Call function(package) for every package of the topologically
+    ordered list packages with at most jobs worker threads. A package is
+    started as soon as all its dependencies contained in packages are
+    finished, earlier packages in the list are preferred. onStart(package)
+    and onFinish(package, error) are called from the calling thread. After a
+    call failed no new calls are started; the first exception is re-raised
+    once the running calls are finished.
+
+    """
+    index = dict((p.name, i) for i, p in enumerate(packages))
+    waitingFor = {}
+    dependings = {}
+    ready = []
+    for i, p in enumerate(packages):
+        dependencies = set(d for d in p.dependencies if d in index)
+        waitingFor[p.name] = len(dependencies)
+        for d in dependencies:
+            dependings.setdefault(d, []).append(p)
+        if not dependencies:
+            heapq.heappush(ready, i)
+    finished = Queue.Queue()
+    errors = []
+    running = 0
+
+    def run(package):
+        try:
+            function(package)
+            finished.put((package, None))
+        except Exception:
+            finished.put((package, sys.exc_info()))
+
+    while ready or running:
+        while ready and running < jobs and not errors:
+            package = packages[heapq.heappop(ready)]
+            if onStart is not None:
+                onStart(package)
+            t = threading.Thread(target=run, args=(package,))
+            t.daemon = True
+            t.start()
+            running += 1
+        if not running:
+            # a call failed and no calls are left to wait for
+            break
+        # poll with timeout to keep the main thread responsive to ctrl-c
+        while True:
+            try:
+                package, error = finished.get(True, 0.1)
+                break
+            except Queue.Empty:
+                pass
+        running -= 1
+        if onFinish is not None:
+            onFinish(package, error and error[1])
+        if error is not None:
+            errors.append(error)
+            continue
+        for p in dependings.get(package.name, []):
+            waitingFor[p.name] -= 1
+            if waitingFor[p.name] == 0:
+                heapq.heappush(ready, index[p.name])
+    if errors:
+        excType, excValue, excTraceback = errors[0]
+        raise excType, excValue, excTraceback
+
+
+def _writeJson(obj, path):
+    """ Write obj as json to path, atomically replacing an existing file. """
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f, sort_keys=True, indent=4, separators=(',', ': '))
+        os.chmod(tmpPath, 0644)
+        os.rename(tmpPath, path)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+def writeRepositoryIndex(repositoryPath):
+    """ Write the repository index of the package repository at
+    repositoryPath. The index contains all package configs in the
+    availablePackages directory and is written uncompressed and gzip
+    compressed to the root of the repository.
+
+    """
+    availablePackagesPath = os.path.join(repositoryPath, _availablePackagesDir)
+    packages = {}
+    for packageConfigFile in sorted(os.listdir(availablePackagesPath)):
+        if packageConfigFile.startswith('.') or not packageConfigFile.endswith('.json'):
+            continue
+        with open(os.path.join(availablePackagesPath, packageConfigFile)) as f:
+            config = json.load(f)
+        # make sure only valid package configs are published
+        Package(config)
+        packages[packageConfigFile] = config
+    indexPath = os.path.join(repositoryPath, _repositoryIndexFile)
+    _writeJson({'packages': packages}, indexPath)
+    with open(indexPath, 'rb') as f:
+        data = f.read()
+    fd, tmpPath = tempfile.mkstemp(dir=repositoryPath, prefix='.' + _repositoryIndexFile + '.gz.')
+    os.close(fd)
+    gz = gzip.open(tmpPath, 'wb')
+    try:
+        gz.write(data)
+    finally:
+        gz.close()
+    os.chmod(tmpPath, 0644)
+    os.rename(tmpPath, indexPath + '.gz')
+    return len(packages)
+
+
+def _writeDelta(basePath, newPath, deltaPath):
+    """ Write a delta which turns the file basePath into the file newPath
+    to deltaPath and return its size. Blocks of the base file are found in
+    the new file at any offset with a rolling checksum like rsync does; the
+    delta consists of copies of base file ranges and literal data and is
+    gzip compressed. Both files are read in chunks, only the checksums of
+    the base blocks and a window of the new file are kept in memory.
+
+    """
+    blockSize = _deltaBlockSize
+    blocks = {}
+    with open(basePath, 'rb') as f:
+        offset = 0
+        while True:
+            block = f.read(blockSize)
+            if len(block) < blockSize:
+                break
+            blocks.setdefault(zlib.adler32(block) & 0xffffffff, {}).setdefault(hashlib.md5(block).digest(), offset)
+            offset += blockSize
+
+    out = gzip.open(deltaPath, 'wb')
+    try:
+        with open(newPath, 'rb') as f:
+            out.write(_deltaMagic)
+            # the data of the new file from offset windowStart on
+            window = bytearray()
+            windowStart = 0
+            end = None
+            copy = None
+            position = literalStart = 0
+            a = b = None
+            while True:
+                # a block and the byte after it are needed to roll the checksum
+                while end is None and windowStart + len(window) <= position + blockSize:
+                    chunk = f.read(_deltaWindowSize)
+                    window.extend(chunk)
+                    if not chunk:
+                        end = windowStart + len(window)
+                if end is not None and position + blockSize > end:
+                    break
+                if position - literalStart >= _deltaWindowSize:
+                    # long literals are written in parts to keep the window small
+                    if copy is not None:
+                        out.write('C' + struct.pack('>QI', *copy))
+                        copy = None
+                    out.write('L' + struct.pack('>I', position - literalStart) + \
+                            str(window[literalStart - windowStart:position - windowStart]))
+                    literalStart = position
+                    del window[:position - windowStart]
+                    windowStart = position
+                i = position - windowStart
+                if a is None:
+                    weak = zlib.adler32(str(window[i:i + blockSize])) & 0xffffffff
+                    a, b = weak & 0xffff, weak >> 16
+                candidates = blocks.get((b << 16) | a)
+                if candidates is not None:
+                    offset = candidates.get(hashlib.md5(str(window[i:i + blockSize])).digest())
+                    if offset is not None:
+                        if literalStart < position:
+                            if copy is not None:
+                                out.write('C' + struct.pack('>QI', *copy))
+                                copy = None
+                            out.write('L' + struct.pack('>I', position - literalStart) + \
+                                    str(window[literalStart - windowStart:i]))
+                        if copy is not None and copy[0] + copy[1] == offset:
+                            copy = (copy[0], copy[1] + blockSize)
+                        else:
+                            if copy is not None:
+                                out.write('C' + struct.pack('>QI', *copy))
+                            copy = (offset, blockSize)
+                        position += blockSize
+                        literalStart = position
+                        a = None
+                        if position - windowStart >= _deltaWindowSize:
+                            del window[:position - windowStart]
+                            windowStart = position
+                        continue
+                if end is None or position + blockSize < end:
+                    # roll the adler32 checksum one byte forward
+                    removed, added = window[i], window[i + blockSize]
+                    a = (a - removed + added) % 65521
+                    b = (b - blockSize * removed + a - 1) % 65521
+                position += 1
+            if copy is not None:
+                out.write('C' + struct.pack('>QI', *copy))
+            if literalStart < end:
+                out.write('L' + struct.pack('>I', end - literalStart) + str(window[literalStart - windowStart:]))
+            out.write('E')
+    finally:
+        out.close()
+    return os.path.getsize(deltaPath)
+
+
+def _applyDelta(basePath, deltaPath, outPath):
+    """ Write the file described by the delta deltaPath against the file
+    basePath to outPath. Raises PackageError if the delta is broken. """
+    delta = gzip.open(deltaPath, 'rb')
+    try:
+        with open(basePath, 'rb') as base:
+            with open(outPath, 'wb') as out:
+                if delta.read(len(_deltaMagic)) != _deltaMagic:
+                    raise PackageError("{0} is no delta file".format(deltaPath))
+                while True:
+                    record = delta.read(1)
+                    if record == 'E':
+                        return
+                    elif record == 'C':
+                        offset, length = struct.unpack('>QI', delta.read(12))
+                        base.seek(offset)
+                        data = base.read(length)
+                    elif record == 'L':
+                        length = struct.unpack('>I', delta.read(4))[0]
+                        data = delta.read(length)
+                    else:
+                        raise PackageError("{0} is truncated or broken".format(deltaPath))
+                    if len(data) != length:
+                        raise PackageError("{0} doesn't fit {1}".format(deltaPath, basePath))
+                    out.write(data)
+    except (IOError, struct.error, zlib.error) as e:
+        raise PackageError("Error while applying delta {0}: {1}".format(deltaPath, e))
+    finally:
+        delta.close()
+
+
+def writeSourceDeltas(repositoryPath):
+    """ Write deltas from the source file of each package version to the one
+    of the next version into the deltas directory of the package repository
+    at repositoryPath and add them to the config of the newer version. Deltas
+    not smaller than _maxDeltaRatio of the full file are not used and the
+    pair of source files is remembered so it isn't tried again. The
+    source file checksums the client verifies against are added to configs
+    lacking them, and an existing repository index is rewritten. Returns the
+    number of written deltas.
+
+    """
+    availablePackagesPath = os.path.join(repositoryPath, _availablePackagesDir)
+    sourcesPath = os.path.join(repositoryPath, _sourcesDir)
+    deltasPath = os.path.join(repositoryPath, _deltasDir)
+    if not os.path.isdir(deltasPath):
+        os.makedirs(deltasPath)
+    rejectedPath = os.path.join(deltasPath, _rejectedDeltasFile)
+    rejected = {}
+    if os.path.isfile(rejectedPath):
+        with open(rejectedPath) as f:
+            rejected = json.load(f)
+    versions = {}
+    for packageConfigFile in sorted(os.listdir(availablePackagesPath)):
+        if packageConfigFile.startswith('.') or not packageConfigFile.endswith('.json'):
+            continue
+        with open(os.path.join(availablePackagesPath, packageConfigFile)) as f:
+            config = json.load(f)
+        p = Package(config)
+        if p.packageType == 'archive' and os.path.isfile(os.path.join(sourcesPath, p.sourceFile)):
+            versions.setdefault(p.name, []).append((p.version, packageConfigFile, config))
+    written = 0
+    for name, packageVersions in sorted(versions.iteritems()):
+        packageVersions.sort(key=operator.itemgetter(0))
+        for (_, _, baseConfig), (_, configFile, config) in zip(packageVersions, packageVersions[1:]):
+            baseFile, newFile = baseConfig['sourceFile'], config['sourceFile']
+            if baseFile == newFile:
+                continue
+            basePath = os.path.join(sourcesPath, baseFile)
+            newPath = os.path.join(sourcesPath, newFile)
+            deltaFile = '{0}--{1}.delta'.format(baseFile, newFile)
+            deltaPath = os.path.join(deltasPath, deltaFile)
+            baseSha256 = _sha256File(basePath)
+            deltas = [d for d in config.get('sourceDeltas', []) if d['baseSourceFile'] != baseFile]
+            if os.path.isfile(deltaPath) and [d for d in config.get('sourceDeltas', []) \
+                    if d['deltaFile'] == deltaFile and d['baseSourceFileSha256'] == baseSha256]:
+                continue
+            pair = '{0}-{1}'.format(baseSha256, _sha256File(newPath))
+            if pair in rejected:
+                continue
+            deltaSize = _writeDelta(basePath, newPath, deltaPath)
+            newSize = os.path.getsize(newPath)
+            if deltaSize >= _maxDeltaRatio * newSize:
+                print "{0}: delta is {1} of {2}, not using it".format(deltaFile, _formatSize(deltaSize),
+                        _formatSize(newSize))
+                os.remove(deltaPath)
+                rejected[pair] = deltaSize
+                _writeJson(rejected, rejectedPath)
+                continue
+            print "{0}: {1} instead of {2}".format(deltaFile, _formatSize(deltaSize), _formatSize(newSize))
+            deltas.append({'baseSourceFile': baseFile, 'baseSourceFileSha256': baseSha256,
+                    'deltaFile': deltaFile, 'deltaSha256': _sha256File(deltaPath), 'deltaSize': deltaSize})
+            config['sourceDeltas'] = deltas
+            if not config.get('sourceFileSha256'):
+                config['sourceFileSha256'] = _sha256File(newPath)
+                config['sourceFileSize'] = newSize
+            _writeJson(config, os.path.join(availablePackagesPath, configFile))
+            written += 1
+    if os.path.isfile(os.path.join(repositoryPath, _repositoryIndexFile)):
+        writeRepositoryIndex(repositoryPath)
+    return written
+
+
+def _runParallel(function, argsList, jobs):
+    """ Call function(*args) for every args tuple in argsList with at most
+    jobs worker threads and return the results in the order of argsList. No
+    new calls are started after a call raised an exception; the first
+    exception is re-raised once all running calls are finished.
+
+    """
+    tasks = Queue.Queue()
+    for index, args in enumerate(argsList):
+        tasks.put((index, args))
+    results = [None] * len(argsList)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                index, args = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(*args)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(jobs, len(argsList))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # join with timeout to keep the main thread responsive to ctrl-c
+        while t.is_alive():
+            t.join(0.1)
+    if errors:
+        excType, excValue, excTraceback = errors[0]
+        raise excType, excValue, excTraceback
+    return results
+
+
+class _PooledResponse(object):
+    """ Response of a _ConnectionPool request with the interface of the
+    responses of urllib2.urlopen. Closing it returns the connection to the
+    pool if the response was read completely and the server keeps it open.
+
+    """
+    def __init__(self, pool, key, connection, response, url):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._url = url
+
+    def getcode(self):
+        return self._response.status
+
+    def geturl(self):
+        return self._url
+
+    def info(self):
+        return self._response.msg
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._response.read()
+        return self._response.read(amt)
+
+    def close(self):
+        if self._connection is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.release(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+
+class _ConnectionPool(object):
+    """ Keep-alive HTTP and HTTPS connections per host, shared by all
+    threads. Requests for which a proxy is configured in the environment,
+    and URLs of other schemes like file://, go through urllib2 without
+    reusing connections.
+
+    """
+    maxRedirects = 5
+
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._proxies = urllib.getproxies()
+
+    def release(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def _request(self, key, method, path, headers):
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle and idle.pop() or None
+        reused = connection is not None
+        while True:
+            if connection is None:
+                scheme, host = key
+                if scheme == 'https':
+                    connection = httplib.HTTPSConnection(host, timeout=self._timeout)
+                else:
+                    connection = httplib.HTTPConnection(host, timeout=self._timeout)
+            try:
+                connection.request(method, path, headers=headers)
+                return connection, connection.getresponse()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, retry with a new one
+                connection = None
+                reused = False
+
+    def _urlopen(self, url, headers):
+        """ Open url with urllib2. Missing local files raise a 404 HTTPError
+        like missing remote files. """
+        try:
+            return urlopen(Request(url, headers=headers), timeout=self._timeout)
+        except URLError as e:
+            if isinstance(e.reason, EnvironmentError) and e.reason.errno == errno.ENOENT:
+                raise HTTPError(url, 404, str(e.reason), None, None)
+            raise
+
+    def open(self, url, headers=None, method='GET'):
+        """ Request url and return the response. Redirects are followed and
+        error statuses raise HTTPError like urllib2.urlopen does.
+
+        """
+        headers = dict(headers or {})
+        for i in range(self.maxRedirects + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or \
+                    (parts.scheme in self._proxies and not urllib.proxy_bypass(parts.hostname)):
+                return self._urlopen(url, headers)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection, response = self._request(key, method, path, headers)
+            pooled = _PooledResponse(self, key, connection, response, url)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                pooled.read()
+                pooled.close()
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 300:
+                pooled.read()
+                pooled.close()
+                raise HTTPError(url, response.status, response.reason, response.msg, None)
+            return pooled
+        raise HTTPError(url, response.status, "too many redirects", response.msg, None)
+
+
+def _cpuTime():
+    """ CPU time used by this process and its finished child processes. """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def _peakRss():
+    """ Return the peak resident set size in KiB of this process and of its
+    largest finished child process, or None if it can't be determined. """
+    if resource is None:
+        return None, None
+    selfRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    childRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes instead of KiB
+        selfRss, childRss = selfRss // 1024, childRss // 1024
+    return selfRss, childRss
+
+
+class RunReport(object):
+    """ Record wall time, CPU time, transferred bytes and peak memory of the
+    phases of a run, e.g. the planning, every download and the unpacking and
+    install script of every package. CPU times are process wide and include
+    finished child processes, so phases running in parallel overlap. With
+    profile phases marked for profiling are run under cProfile. Without
+    keepPhases the phases are timed but not kept, for long running commands.
+
+    """
+    def __init__(self, profile=False, keepPhases=True):
+        self.phases = []
+        self.profile = profile
+        self.keepPhases = keepPhases
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._startTime = time.time()
+        self._startCpu = _cpuTime()
+
+    @contextlib.contextmanager
+    def phase(self, name, package=None, profile=False, **details):
+        """ Record the enclosed code as phase name. The yielded dict is stored
+        in the report, callers can add details like the number of 'bytes'
+        processed to it.
+
+        """
+        entry = {'phase': name}
+        if package is not None:
+            entry['package'] = package.name
+            entry['version'] = str(package.version)
+        entry.update(details)
+        profile = profile and self.profile
+        if profile:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        startTime = time.time()
+        startCpu = _cpuTime()
+        try:
+            yield entry
+        except:
+            entry['failed'] = True
+            raise
+        finally:
+            if profile:
+                self._profiler.disable()
+            entry['start'] = startTime - self._startTime
+            entry['wallSeconds'] = time.time() - startTime
+            entry['cpuSeconds'] = _cpuTime() - startCpu
+            if 'bytes' in entry:
+                entry['bytesPerSecond'] = entry['bytes'] / max(entry['wallSeconds'], 1e-6)
+            entry['peakRssKiB'], entry['peakChildRssKiB'] = _peakRss()
+            if self.keepPhases:
+                with self._lock:
+                    self.phases.append(entry)
+
+    def write(self, path, command, arguments):
+        """ Write the report with the totals of the run as JSON to path. """
+        peakRss, peakChildRss = _peakRss()
+        downloads = [p for p in self.phases if p['phase'] == 'download' and 'bytes' in p]
+        _writeJson({'command': command,
+                'arguments': arguments,
+                'version': _metadata['version'],
+                'host': socket.gethostname(),
+                'startTime': self._startTime,
+                'wallSeconds': time.time() - self._startTime,
+                'cpuSeconds': _cpuTime() - self._startCpu,
+                'peakRssKiB': peakRss,
+                'peakChildRssKiB': peakChildRss,
+                'downloadedBytes': sum(p['bytes'] for p in downloads),
+                'phases': sorted(self.phases, key=operator.itemgetter('start')),
+                }, os.path.abspath(path))
+
+    def writeProfile(self, path):
+        """ Write the cProfile statistics of the profiled phases to path.
+        Returns False if no phase was profiled.
+
+        """
+        if self._profiler is None:
+            return False
+        self._profiler.dump_stats(path)
+        return True
+
+
+_versionKeys = {}
+_preReleaseTags = {'dev': 0, 'a': 1, 'alpha': 1, 'b': 2, 'beta': 2, 'pre': 3, 'c': 4, 'rc': 4}
+
+
+def _versionKey(s):
+    """ Return a comparison key for the version string s. Numeric parts are
+    compared numerically, pre-release tags like 1.0rc1 sort before the
+    release and other suffixes like 1.0.2a or 1.0post1 after it. Keys are
+    cached as the same version strings are compared over and over.
+
+    """
+    try:
+        return _versionKeys[s]
+    except KeyError:
+        pass
+    key = []
+    tokens = re.findall('[0-9]+|[a-zA-Z]+', s)
+    for i, token in enumerate(tokens):
+        if token.isdigit():
+            key.append((3, int(token)))
+        else:
+            token = token.lower()
+            followedByNumber = i + 1 < len(tokens) and tokens[i + 1].isdigit()
+            if token in _preReleaseTags and (followedByNumber or len(token) > 1):
+                key.append((0, _preReleaseTags[token]))
+            else:
+                key.append((2, token))
+    # drop trailing zeros of numeric parts, 1.0 is the same as 1.0.0
+    normalized = []
+    for element in key:
+        if element[0] != 3:
+            while normalized and normalized[-1] == (3, 0):
+                normalized.pop()
+        normalized.append(element)
+    while normalized and normalized[-1] == (3, 0):
+        normalized.pop()
+    key = normalized
+    # the end of a version sorts after pre-release tags and before anything else
+    key.append((1,))
+    key = tuple(key)
+    _versionKeys[s] = key
+    return key
+
+
 class Version(object):
     def __init__(self, s):
         self._versionStr = s
+        self._key = None
+
+    @property
+    def key(self):
+        # parsed on first comparison, most versions are never compared
+        if self._key is None:
+            self._key = _versionKey(self._versionStr)
+        return self._key
 
     @classmethod
     def fromStr(cls, s):
-        cls(s)
+        return cls(s)
 
     def __str__(self):
         return self._versionStr
 
+    def __hash__(self):
+        return hash(self.key)
+
     def __eq__(self, other):
         if not isinstance(other, Version):
             return NotImplemented
-        return self._versionStr == other._versionStr
+        return self.key == other.key
+
+    def __ne__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key != other.key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key < other.key
+
+    def __le__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key <= other.key
 
     def __gt__(self, other):
         if not isinstance(other, Version):
             return NotImplemented
-        # TODO real version comparison
-        return self._versionStr != other._versionStr
+        return self.key > other.key
+
+    def __ge__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key >= other.key
+
+
+class VersionConstraint(object):
+    """ A comma separated list of version comparisons like '>=1.2,<2'. """
+    _operators = {'==': operator.eq, '!=': operator.ne, '>=': operator.ge,
+            '<=': operator.le, '>': operator.gt, '<': operator.lt}
+
+    def __init__(self, s):
+        self._constraintStr = s.replace(' ', '')
+        self._comparisons = []
+        for comparison in self._constraintStr.split(','):
+            m = re.match('(==|!=|>=|<=|>|<|=)?([^<>=!]+)$', comparison)
+            if m is None:
+                raise ValueError("invalid version constraint '{0}'".format(s))
+            op = m.group(1) or '=='
+            if op == '=':
+                op = '=='
+            self._comparisons.append((self._operators[op], Version(m.group(2))))
+
+    def __str__(self):
+        return self._constraintStr
+
+    def matches(self, version):
+        for op, v in self._comparisons:
+            if not op(version.key, v.key):
+                return False
+        return True
+
+
+def parseRequirement(s):
+    """ Split a requirement like 'name', 'name>=1.2,<2' or 'name (>=1.2)'
+    into the package name and a VersionConstraint or None.
+
+    """
+    m = re.match(r'\s*([^\s<>=!(]+)\s*\(?([^)]*)\)?\s*$', s)
+    if m is None:
+        raise ValueError("invalid requirement '{0}'".format(s))
+    name, constraint = m.groups()
+    if not constraint.strip():
+        return name, None
+    return name, VersionConstraint(constraint)
+
+
+class Package(object):
+    def __init__(self, config):
+        self.name = config['name']
+        self.version = Version(config['version'])
+        self.packageType = config['type']
+        self.description = config.get('description', '')
+        # dependencies are names, version constraints are kept separately
+        self.dependencies = []
+        self.dependencyConstraints = {}
+        for requirement in config['dependencies']:
+            dependencyName, constraint = parseRequirement(requirement)
+            if dependencyName not in self.dependencyConstraints:
+                self.dependencies.append(dependencyName)
+                self.dependencyConstraints[dependencyName] = []
+            if constraint is not None:
+                self.dependencyConstraints[dependencyName].append(constraint)
+        if self.packageType == 'archive':
+            self.sourceFile = config['sourceFile']
+            self.installScript = config['installScript']
+            # optional checksums used to verify downloads and cached files
+            self.sourceFileSha256 = config.get('sourceFileSha256')
+            self.sourceFileSize = config.get('sourceFileSize')
+            self.installScriptSha256 = config.get('installScriptSha256')
+            self.installScriptSize = config.get('installScriptSize')
+            # deltas from source files of other versions to the source file
+            self.sourceDeltas = config.get('sourceDeltas', [])
+            # the install script installs into $DESTDIR$LPM_INSTALL_PREFIX if DESTDIR is set
+            self.supportsDestdir = config.get('supportsDestdir', False)
+            self.shortType = 'a'
+        elif self.packageType == 'meta':
+            self.shortType = 'm'
+        elif self.packageType == 'git':
+            self.url = config['url']
+            # a branch, tag or commit id
+            self.ref = config.get('ref', 'HEAD')
+            self.installScript = config['installScript']
+            self.installScriptSha256 = config.get('installScriptSha256')
+            self.installScriptSize = config.get('installScriptSize')
+            self.supportsDestdir = config.get('supportsDestdir', False)
+            # the commit ref resolved to, recorded in the config of installed packages
+            self.resolvedCommit = config.get('resolvedCommit')
+            # the local mirror of url, set when it was fetched
+            self.gitMirror = None
+            self.shortType = 'g'
+        else:
+            raise ValueError("unknown package type {0.packageType}".format(self))
+
+    def __str__(self):
+        return '{0.name} ({0.version})'.format(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Package):
+            return NotImplemented
+        return (self.name == other.name and self.version == other.version)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @classmethod
+    def fromJsonFile(cls, jsonFile):
+        with open(jsonFile) as f:
+            obj = cls(json.load(f))
+            obj.configFile = os.path.basename(jsonFile)
+            return obj
+
+    def _sourceStamp(self, sourcesPath):
+        """ Identify the source archive by name and checksum. """
+        sha256 = self.sourceFileSha256 or _sha256File(os.path.join(sourcesPath, self.sourceFile))
+        return '{0} {1}'.format(self.sourceFile, sha256)
+
+    def _unpackSource(self, sourcesPath, buildPath, incremental=False):
+        """ Unpack the source archive into the build directory. In incremental
+        mode an existing build tree unpacked from an archive with the same
+        checksum is kept, so the install script can reuse what it built before.
+        Returns whether the archive was extracted.
+
+        """
+        unpackTo = os.path.join(buildPath, self.name)
+        # the source may already have been unpacked while it was downloaded
+        markerPath = _unpackedMarkerPath(buildPath, self.name)
+        unpackedFrom = None
+        if os.path.isfile(markerPath):
+            with open(markerPath) as f:
+                unpackedFrom = f.read()
+            os.remove(markerPath)
+        stampPath = _sourceStampPath(buildPath, self.name)
+        stamp = None
+        if incremental:
+            stamp = self._sourceStamp(sourcesPath)
+            if os.path.isdir(unpackTo) and os.path.isfile(stampPath):
+                with open(stampPath) as f:
+                    if f.read() == stamp:
+                        return False
+        if os.path.isfile(stampPath):
+            os.remove(stampPath)
+        extract = unpackedFrom != self.sourceFile or not os.path.isdir(unpackTo)
+        if extract:
+            self._extractSource(os.path.join(sourcesPath, self.sourceFile), unpackTo)
+        if stamp is not None:
+            with open(stampPath, 'w') as f:
+                f.write(stamp)
+        return extract
+
+    def _extractSource(self, sourceFile, unpackTo):
+        if sourceFile.endswith(('.xz', '.txz')):
+            # tarfile can't decompress xz itself
+            extractor = _TarStreamExtractor(sourceFile, unpackTo)
+            try:
+                with open(sourceFile, 'rb') as f:
+                    while True:
+                        chunk = f.read(_downloadChunkSize)
+                        if not chunk:
+                            break
+                        extractor.write(chunk)
+            finally:
+                extractor.close()
+            return
+        if os.path.isdir(unpackTo):
+            shutil.rmtree(unpackTo)
+        os.makedirs(unpackTo)
+        try:
+            tf = tarfile.open(sourceFile)
+        except (IOError, tarfile.TarError) as e:
+            raise PackageError("Error while unpacking source file {0}: {1}".format(sourceFile, e))
+        try:
+            tf.extractall(path=unpackTo)
+        finally:
+            tf.close()
+
+    def _checkout(self, buildPath, incremental=False):
+        """ Check out the resolved commit from the git mirror as worktree
+        into a directory named like the package in the build directory. The
+        worktree shares the objects of the mirror. In incremental mode an
+        existing worktree is switched to the commit, keeping untracked build
+        files. Returns whether a new worktree was created.
+
+        """
+        checkoutPath = os.path.abspath(os.path.join(buildPath, self.name, self.name))
+        if incremental and os.path.isfile(os.path.join(checkoutPath, '.git')):
+            try:
+                _git(['checkout', '--quiet', '--detach', '--force', self.resolvedCommit], cwd=checkoutPath)
+                return False
+            except PackageError:
+                pass
+        if os.path.isdir(os.path.join(buildPath, self.name)):
+            shutil.rmtree(os.path.join(buildPath, self.name))
+        # forget worktrees whose directories were removed
+        _git(['worktree', 'prune'], gitDir=self.gitMirror)
+        _git(['worktree', 'add', '--detach', '--force', checkoutPath, self.resolvedCommit], gitDir=self.gitMirror)
+        return True
+
+    def _runInstallScript(self, buildPath, installScriptsPath, environmentVariables, logFile=None):
+        installScript = os.path.abspath(os.path.join(installScriptsPath, self.installScript))
+        unpackedSource = os.path.join(buildPath, self.name)
+        env = dict(os.environ)
+        env.update(environmentVariables)
+        try:
+            if logFile is None:
+                subprocess.check_call([installScript], cwd=unpackedSource, env=env)
+            else:
+                with open(logFile, 'a') as log:
+                    subprocess.check_call([installScript], cwd=unpackedSource, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise PackageError("Can not call installation script: {0}".format(e))
+        except subprocess.CalledProcessError as e:
+            raise PackageError("Error in installation script: {0}".format(e))
+
+    def _installStaged(self, buildPath, installScriptsPath, environmentVariables, logFile, binaryFile):
+        """ Run the install script with DESTDIR pointing to a staging
+        directory and pack everything it installed below the install prefix
+        into binaryFile.
+
+        """
+        prefix = os.path.abspath(os.path.expanduser(environmentVariables['LPM_INSTALL_PREFIX']))
+        stagePath = os.path.abspath(os.path.join(buildPath, self.name + '.destdir'))
+        if os.path.isdir(stagePath):
+            shutil.rmtree(stagePath)
+        os.makedirs(stagePath)
+        env = dict(environmentVariables)
+        env['DESTDIR'] = stagePath
+        self._runInstallScript(buildPath, installScriptsPath, env, logFile)
+
+        stagedPrefix = os.path.join(stagePath, prefix.lstrip(os.sep))
+        staged = False
+        for root, dirs, files in os.walk(stagePath):
+            if files and not (root + os.sep).startswith(stagedPrefix + os.sep):
+                raise PackageError("Install script installed files outside of {0}: {1}" \
+                        .format(prefix, os.path.join(root, files[0])))
+            staged = staged or bool(files)
+        if not staged:
+            # the files were probably installed into the prefix directly
+            raise PackageError("Install script installed no files into DESTDIR, does it support DESTDIR?")
+        if not os.path.isdir(os.path.dirname(binaryFile)):
+            os.makedirs(os.path.dirname(binaryFile))
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(binaryFile),
+                prefix='.' + os.path.basename(binaryFile) + '.')
+        os.close(fd)
+        try:
+            tf = tarfile.open(tmpPath, 'w:gz')
+            try:
+                if os.path.isdir(stagedPrefix):
+                    for name in sorted(os.listdir(stagedPrefix)):
+                        tf.add(os.path.join(stagedPrefix, name), arcname=name)
+            finally:
+                tf.close()
+            os.chmod(tmpPath, 0644)
+            os.rename(tmpPath, binaryFile)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        shutil.rmtree(stagePath)
+
+    def _unpackBinary(self, binaryFile, unpackTo):
+        if not os.path.isdir(unpackTo):
+            os.makedirs(unpackTo)
+        try:
+            tf = tarfile.open(binaryFile)
+        except (IOError, tarfile.TarError) as e:
+            raise PackageError("Error while unpacking binary file {0}: {1}".format(binaryFile, e))
+        try:
+            tf.extractall(path=unpackTo)
+        finally:
+            tf.close()
+
+    def install(self, sourcesPath, installScriptsPath, buildPath, environmentVariables, logFile=None,
+            binaryFile=None, incremental=False, report=None, unpackTo=None):
+        """ Install the package. The output of the install script goes to
+        logFile if given, otherwise to the terminal. If binaryFile exists it
+        is unpacked into the install prefix instead of building the package.
+        If it is given but doesn't exist, the package is installed into a
+        DESTDIR staging directory, packed into binaryFile and unpacked from
+        there. The binary is unpacked into unpackTo instead of the install
+        prefix if given. Git packages are checked out from their fetched
+        mirror instead of unpacking a source archive. With incremental an
+        unchanged build tree is built again instead of being unpacked from
+        scratch. The steps are recorded in report if given.
+
+        """
+        if report is None:
+            report = RunReport()
+        fromBinary = binaryFile is not None and os.path.isfile(binaryFile)
+        header = "--- installing {0}{1} ---".format(self, fromBinary and " from binary" or "")
+        if logFile is None:
+            print "\n" + header
+        else:
+            with open(logFile, 'w') as log:
+                log.write(header + "\n")
+        if self.packageType in ('archive', 'git'):
+            if not fromBinary:
+                if self.packageType == 'git':
+                    with report.phase('checkout', self) as entry:
+                        entry['commit'] = self.resolvedCommit
+                        entry['checkedOut'] = self._checkout(buildPath, incremental)
+                else:
+                    with report.phase('unpackSource', self) as entry:
+                        entry['bytes'] = os.path.getsize(os.path.join(sourcesPath, self.sourceFile))
+                        entry['extracted'] = self._unpackSource(sourcesPath, buildPath, incremental)
+                if binaryFile is None:
+                    with report.phase('installScript', self):
+                        self._runInstallScript(buildPath, installScriptsPath, environmentVariables, logFile)
+                    return
+                with report.phase('stagedInstall', self):
+                    self._installStaged(buildPath, installScriptsPath, environmentVariables, logFile,
+                            binaryFile)
+            with report.phase('unpackBinary', self) as entry:
+                entry['bytes'] = os.path.getsize(binaryFile)
+                if unpackTo is None:
+                    unpackTo = os.path.expanduser(environmentVariables['LPM_INSTALL_PREFIX'])
+                self._unpackBinary(binaryFile, unpackTo)
+        elif self.packageType == 'meta':
+            pass
+        else:
+            raise ValueError("unknown package type {0.packageType}".format(self))
+
+
+class DependencyGraph(object):
+    """ Dependency graph of a dict of packages keyed by name. Packages are
+    ordered topologically with an iterative depth first search; the order of
+    every visited package is memoized, so repeated queries only visit new
+    parts of the graph and the whole graph is processed in O(V+E). A reverse
+    index of the dependencies is built on first use.
+
+    """
+    def __init__(self, packages, ignoreMissing=False):
+        self._packages = packages
+        self._ignoreMissing = ignoreMissing
+        self._position = {}
+        self._reverseIndex = None
+
+    def _dependencyNames(self, name):
+        dependencies = self._packages[name].dependencies
+        if self._ignoreMissing:
+            return [d for d in dependencies if d in self._packages]
+        return dependencies
+
+    def _visit(self, rootName):
+        """ Assign topological positions to rootName and all packages it
+        depends on. Raises PackageManagerError on missing dependencies or
+        dependency cycles.
+
+        """
+        if rootName in self._position:
+            return
+        if rootName not in self._packages:
+            raise PackageManagerError("Package '{0}' is not available".format(rootName))
+        path = [rootName]
+        onPath = {rootName: 0}
+        stack = [iter(self._dependencyNames(rootName))]
+        while stack:
+            name = path[-1]
+            for dependencyName in stack[-1]:
+                if dependencyName in self._position:
+                    continue
+                if dependencyName in onPath:
+                    cycle = path[onPath[dependencyName]:] + [dependencyName]
+                    raise PackageManagerError("Dependency cycle detected: {0}".format(' -> '.join(cycle)))
+                if dependencyName not in self._packages:
+                    raise PackageManagerError("Can not resolve dependency '{0}' of package {1}" \
+                            .format(dependencyName, self._packages[name]))
+                onPath[dependencyName] = len(path)
+                path.append(dependencyName)
+                stack.append(iter(self._dependencyNames(dependencyName)))
+                break
+            else:
+                # all dependencies of name are positioned
+                stack.pop()
+                path.pop()
+                del onPath[name]
+                self._position[name] = len(self._position)
+
+    def _sorted(self, names):
+        for name in names:
+            self._visit(name)
+        return [self._packages[n] for n in sorted(names, key=self._position.__getitem__)]
+
+    def dependencies(self, names):
+        """ Return the packages names and all their direct and indirect
+        dependencies, each once, in installation order: every package comes
+        after all of its dependencies.
+
+        """
+        closure = set()
+        toVisit = [(name, None) for name in names]
+        while toVisit:
+            name, dependingName = toVisit.pop()
+            if name in closure:
+                continue
+            if name not in self._packages:
+                if dependingName is None:
+                    raise PackageManagerError("Package '{0}' is not available".format(name))
+                raise PackageManagerError("Can not resolve dependency '{0}' of package {1}" \
+                        .format(name, self._packages[dependingName]))
+            closure.add(name)
+            toVisit.extend((d, name) for d in self._dependencyNames(name))
+        return self._sorted(closure)
+
+    def dependings(self, names):
+        """ Return all packages which depend directly or indirectly on one of
+        names, in the order they need to be rebuilt. names are not included
+        unless they depend on each other.
+
+        """
+        if self._reverseIndex is None:
+            self._reverseIndex = {}
+            for name in self._packages:
+                for dependencyName in self._dependencyNames(name):
+                    self._reverseIndex.setdefault(dependencyName, []).append(name)
+        result = set()
+        toVisit = list(names)
+        while toVisit:
+            for dependingName in self._reverseIndex.get(toVisit.pop(), []):
+                if dependingName not in result:
+                    result.add(dependingName)
+                    toVisit.append(dependingName)
+        return self._sorted(result)
+
+
+def _ngrams(s, n=3):
+    return set(s[i:i + n] for i in range(len(s) - n + 1))
+
+
+class SearchIndex(object):
+    """ Trigram index over the names and descriptions of packages. Names are
+    also kept sorted for prefix lookups, and dependencies in a reverse index.
+    The index consists of plain lists and dicts only, so it can be marshalled
+    next to the package index. It holds type and version of each package so
+    search results can be printed without loading the packages.
+
+    """
+    # scores of the different kinds of matches
+    exactScore = 100
+    prefixScore = 80
+    substringScore = 60
+    descriptionScore = 40
+    fuzzyScore = 20
+    fuzzyMinRatio = 0.6
+    # bumped whenever the layout of data() changes
+    formatVersion = 1
+
+    def __init__(self, data):
+        (self._names, self._sortedNames, self._descriptions, self._nameGrams, self._descriptionGrams,
+                self._dependings, self.summaries) = data
+
+    @classmethod
+    def build(cls, packages):
+        packages = sorted(packages, key=lambda p: p.name)
+        names = [p.name for p in packages]
+        sortedNames = sorted((name.lower(), i) for i, name in enumerate(names))
+        descriptions = [p.description.lower() for p in packages]
+        nameGrams = {}
+        descriptionGrams = {}
+        dependings = {}
+        summaries = {}
+        for i, p in enumerate(packages):
+            for gram in _ngrams(p.name.lower()):
+                nameGrams.setdefault(gram, []).append(i)
+            for gram in _ngrams(descriptions[i]):
+                descriptionGrams.setdefault(gram, []).append(i)
+            for dependencyName in p.dependencies:
+                dependings.setdefault(dependencyName.lower(), []).append(i)
+            summaries[p.name] = (p.shortType, str(p.version))
+        return cls((names, sortedNames, descriptions, nameGrams, descriptionGrams, dependings, summaries))
+
+    def data(self):
+        return (self._names, self._sortedNames, self._descriptions, self._nameGrams, self._descriptionGrams,
+                self._dependings, self.summaries)
+
+    def _candidates(self, term, grams):
+        """ Indices of all entries containing every trigram of term. """
+        termGrams = _ngrams(term)
+        if not termGrams:
+            return range(len(self._names))
+        postings = sorted((grams.get(g, []) for g in termGrams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+        return candidates
+
+    def search(self, term, fields=('name', 'description')):
+        """ Return a dict mapping the names of the packages matching term to
+        their score. Exact name matches score higher than prefix matches,
+        followed by substring, description and fuzzy matches.
+
+        """
+        term = term.lower()
+        scores = {}
+
+        def addScore(i, score):
+            if scores.get(i, 0) < score:
+                scores[i] = score
+
+        if 'name' in fields:
+            lowerNames = self._sortedNames
+            position = bisect.bisect_left(lowerNames, (term,))
+            while position < len(lowerNames) and lowerNames[position][0].startswith(term):
+                lowerName, i = lowerNames[position]
+                addScore(i, lowerName == term and self.exactScore or self.prefixScore)
+                position += 1
+            for i in self._candidates(term, self._nameGrams):
+                if term in self._names[i].lower():
+                    addScore(i, self.substringScore)
+            # fuzzy matches share at least a third of the trigrams of term
+            termGrams = _ngrams(term)
+            shared = {}
+            for gram in termGrams:
+                for i in self._nameGrams.get(gram, []):
+                    shared[i] = shared.get(i, 0) + 1
+            for i, count in shared.iteritems():
+                if i not in scores and count * 3 >= len(termGrams):
+                    ratio = difflib.SequenceMatcher(None, term, self._names[i].lower()).ratio()
+                    if ratio >= self.fuzzyMinRatio:
+                        addScore(i, self.fuzzyScore * (1 + ratio) / 2)
+        if 'description' in fields:
+            for i in self._candidates(term, self._descriptionGrams):
+                if term in self._descriptions[i]:
+                    addScore(i, self.descriptionScore)
+        if 'dependencies' in fields:
+            for i in self._dependings.get(term, []):
+                addScore(i, self.descriptionScore)
+        return dict((self._names[i], score) for i, score in scores.iteritems())
+
+    def searchRegex(self, pattern, fields=('name', 'description')):
+        """ Return a dict mapping the names of the packages whose name,
+        description or dependencies match the regular expression pattern to
+        their score.
+
+        """
+        scores = {}
+        for i, name in enumerate(self._names):
+            if 'name' in fields and pattern.search(name):
+                scores[name] = pattern.match(name) and self.prefixScore or self.substringScore
+            elif 'description' in fields and pattern.search(self._descriptions[i]):
+                scores[name] = self.descriptionScore
+        if 'dependencies' in fields:
+            for dependencyName, indices in self._dependings.iteritems():
+                if pattern.search(dependencyName):
+                    for i in indices:
+                        scores.setdefault(self._names[i], self.descriptionScore)
+        return scores
+
+
+class InstalledDatabase(object):
+    """ SQLite database of the installed packages with their configs, their
+    dependencies and the files they installed. Every change is a single
+    transaction, so an interrupted installation leaves the previous state.
+    The database may be used from several threads.
+
+    """
+    schemaVersion = 1
+    schema = """
+        CREATE TABLE packages (
+            name TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            configFile TEXT NOT NULL,
+            config TEXT NOT NULL,
+            installTime REAL NOT NULL);
+        CREATE TABLE dependencies (
+            package TEXT NOT NULL,
+            dependency TEXT NOT NULL,
+            PRIMARY KEY (package, dependency));
+        CREATE INDEX dependenciesByDependency ON dependencies (dependency);
+        CREATE TABLE files (
+            path TEXT PRIMARY KEY,
+            package TEXT NOT NULL,
+            size INTEGER,
+            sha256 TEXT);
+        CREATE INDEX filesByPackage ON files (package);
+        """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            with self._connection:
+                version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+                if version == 0:
+                    self._connection.executescript(self.schema)
+                    self._connection.execute('PRAGMA user_version = {0}'.format(self.schemaVersion))
+                elif version > self.schemaVersion:
+                    raise PackageManagerError("The installed packages database {0} was written by a newer " \
+                            "version of the package manager".format(path))
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+    def packages(self):
+        """ Return a list of the config file names and configs of all
+        installed packages. """
+        return [(configFile, json.loads(config)) for configFile, config \
+                in self._query('SELECT configFile, config FROM packages')]
+
+    def config(self, name):
+        """ Return the config of the installed package name or None. """
+        rows = self._query('SELECT config FROM packages WHERE name = ?', name)
+        return rows and json.loads(rows[0][0]) or None
+
+    def files(self, name):
+        """ Return a dict mapping the paths of the files of the package name
+        to their size and sha256 checksum. """
+        return dict((path, (size, sha256)) for path, size, sha256 \
+                in self._query('SELECT path, size, sha256 FROM files WHERE package = ?', name))
+
+    def owner(self, path):
+        """ Return the name of the package owning the file path or None. """
+        rows = self._query('SELECT package FROM files WHERE path = ?', path)
+        return rows and rows[0][0] or None
+
+    def dependings(self, name):
+        """ Return the names of the packages depending directly on name. """
+        return [row[0] for row in self._query('SELECT package FROM dependencies WHERE dependency = ?', name)]
+
+    def record(self, package, configFile, config, files):
+        """ Record package as installed from configFile with config and the
+        files manifest, replacing an installed version of it. Returns a dict
+        mapping paths which were owned by other packages to their previous
+        owner.
+
+        """
+        with self._lock:
+            with self._connection:
+                c = self._connection
+                overwritten = {}
+                for path in files:
+                    rows = c.execute('SELECT package FROM files WHERE path = ? AND package != ?',
+                            (path, package.name)).fetchall()
+                    if rows:
+                        overwritten[path] = rows[0][0]
+                c.execute('DELETE FROM dependencies WHERE package = ?', (package.name,))
+                c.execute('DELETE FROM files WHERE package = ?', (package.name,))
+                c.execute('INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?)',
+                        (package.name, str(package.version), configFile, json.dumps(config), time.time()))
+                c.executemany('INSERT INTO dependencies VALUES (?, ?)',
+                        [(package.name, d) for d in package.dependencies])
+                c.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                        [(path, package.name, size, sha256) for path, (size, sha256) in files.iteritems()])
+                return overwritten
+
+    def remove(self, name):
+        """ Remove the package name with its dependencies and files. """
+        with self._lock:
+            with self._connection:
+                for table, column in [('packages', 'name'), ('dependencies', 'package'), ('files', 'package')]:
+                    self._connection.execute('DELETE FROM {0} WHERE {1} = ?'.format(table, column), (name,))
+
+
+class InstallStore(object):
+    """ Store of installed packages for an install prefix. Every package is
+    unpacked into its own entry directory, named by the checksum of its
+    content, which is never modified afterwards. Identical files of all
+    entries are hardlinks to a single file in a pool. A profile generation
+    is a tree of hardlinks to the files of the entries of a set of packages
+    and the install prefix is a symlink to the current generation, so
+    switching to another set of packages is a single atomic rename. A new
+    generation is built next to the current one and the prefix switched to
+    it once it is complete.
+
+    """
+    def __init__(self, storePath, profilesPath, prefix):
+        self._storePath = storePath
+        self._poolPath = os.path.join(storePath, '.files')
+        self._profilesPath = profilesPath
+        self._prefix = prefix
+        self._lock = threading.RLock()
+        # the generation being built by begin
+        self._working = None
+        for d in [self._poolPath, profilesPath, os.path.dirname(prefix)]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        if os.path.isdir(prefix) and not os.path.islink(prefix):
+            if os.listdir(prefix):
+                raise PackageManagerError("The install prefix {0} is a directory, move it away to use " \
+                        "the install store".format(prefix))
+            os.rmdir(prefix)
+
+    def _generationPath(self, number):
+        return os.path.join(self._profilesPath, str(number))
+
+    def generations(self):
+        """ Return the sorted numbers of all generations. """
+        return sorted(int(name) for name in os.listdir(self._profilesPath) \
+                if name.isdigit() and os.path.isdir(os.path.join(self._profilesPath, name)))
+
+    def currentGeneration(self):
+        """ Return the number of the generation the install prefix points to
+        or None. """
+        if not os.path.islink(self._prefix):
+            return None
+        name = os.path.basename(os.readlink(self._prefix))
+        return name.isdigit() and int(name) or None
+
+    def generationInfo(self, number):
+        """ Return the info of generation number: a dict with the 'packages'
+        of the generation, the 'time' it was created and its 'changes'. """
+        if number is None:
+            return {'packages': {}, 'time': None, 'changes': []}
+        with open(self._generationPath(number) + '.json') as f:
+            return json.load(f)
+
+    def temporaryEntry(self):
+        """ Return a new directory in the store to unpack a package into. """
+        return tempfile.mkdtemp(prefix='.new-', dir=self._storePath)
+
+    def entryPath(self, entry):
+        return os.path.join(self._storePath, entry)
+
+    def addEntry(self, path, package):
+        """ Move the unpacked package at path into the store as entry of
+        package and return the name of the entry. The entry is named by the
+        checksum of its content, an entry with the same content is reused.
+
+        """
+        with self._lock:
+            checksum = self._deduplicate(path)
+            entry = '{0}-{1.name}-{1.version}'.format(checksum[:32], package)
+            entryPath = self.entryPath(entry)
+            if os.path.isdir(entryPath):
+                shutil.rmtree(path)
+            else:
+                os.rename(path, entryPath)
+        return entry
+
+    def _deduplicate(self, path):
+        """ Make the files below path read only and replace them by hardlinks
+        to identical files in the pool. Returns a checksum of the paths,
+        modes and contents of the tree.
+
+        """
+        tree = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files + [d for d in dirs if os.path.islink(os.path.join(root, d))]):
+                filePath = os.path.join(root, name)
+                st = os.lstat(filePath)
+                tree.update(os.path.relpath(filePath, path) + '\0')
+                if stat.S_ISLNK(st.st_mode):
+                    tree.update('link:' + os.readlink(filePath) + '\0')
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                mode = stat.S_IMODE(st.st_mode) & ~0222
+                os.chmod(filePath, mode)
+                sha256 = _sha256File(filePath)
+                tree.update('{0}-{1:o}\0'.format(sha256, mode))
+                poolFile = os.path.join(self._poolPath, '{0}-{1:o}'.format(sha256, mode))
+                if not os.path.isfile(poolFile):
+                    os.link(filePath, poolFile)
+                elif not os.path.samefile(filePath, poolFile):
+                    temporary = filePath + '.lpm-dedup'
+                    os.link(poolFile, temporary)
+                    os.rename(temporary, filePath)
+        return tree.hexdigest()
+
+    def begin(self):
+        """ Start a new generation from the current one in a directory which
+        isn't the install prefix and return the directory. Packages are
+        added to and removed from it with change until it is made the
+        current generation with commit or dropped with abort.
+
+        """
+        with self._lock:
+            if self._working is not None:
+                raise PackageManagerError("A generation is already being built")
+            number = max(self.generations() + [0]) + 1
+            path = os.path.join(self._profilesPath, '.' + str(number))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.mkdir(path)
+            packages = self.generationInfo(self.currentGeneration())['packages']
+            self._working = {'number': number, 'path': path, 'packages': packages, 'changes': [],
+                    'providers': {}}
+            for name in sorted(packages):
+                self._linkEntry(name)
+            return path
+
+    def workingPath(self):
+        """ The directory of the generation being built or None. """
+        return self._working is not None and self._working['path'] or None
+
+    def change(self, changedPackages, change):
+        """ Change the packages of the generation being built: changedPackages
+        maps package names to a dict with the 'store' entry, 'configFile' and
+        'config' of the package or to None for removed packages. change
+        describes the change. Only the files of the changed packages are
+        linked or unlinked.
+
+        """
+        with self._lock:
+            packages = self._working['packages']
+            for name, packageInfo in changedPackages.iteritems():
+                if name in packages:
+                    self._unlinkEntry(name)
+                    del packages[name]
+                if packageInfo is not None:
+                    packages[name] = packageInfo
+                    self._linkEntry(name)
+            self._working['changes'].append(change)
+
+    def commit(self):
+        """ Make the generation being built the current one by a single
+        atomic switch of the install prefix and return its number. """
+        with self._lock:
+            working = self._working
+            path = self._generationPath(working['number'])
+            _writeJson({'packages': working['packages'], 'time': time.time(), 'changes': working['changes']},
+                    path + '.json')
+            os.rename(working['path'], path)
+            self._working = None
+            self.activate(working['number'])
+            return working['number']
+
+    def abort(self):
+        """ Drop the generation being built, the install prefix is unchanged. """
+        with self._lock:
+            if self._working is not None:
+                shutil.rmtree(self._working['path'])
+                self._working = None
+
+    def _entryFiles(self, name):
+        """ Return the files of the store entry of package name of the
+        generation being built as list of relative and absolute paths. """
+        entry = self._working['packages'][name]['store']
+        if entry is None:
+            return []
+        return _treeFiles(self.entryPath(entry))
+
+    def _linkEntry(self, name):
+        """ Link the files of the store entry of package name into the
+        generation being built. If several packages have the same file the
+        one of the first package by name is used.
+
+        """
+        providers = self._working['providers']
+        for relativePath, source in self._entryFiles(name):
+            names = providers.setdefault(relativePath, [])
+            bisect.insort(names, name)
+            if len(names) > 1:
+                warnings.warn("{0} of {1} conflicts with {2}, using the one of {3}".format(
+                        relativePath, name, ', '.join(n for n in names if n != name), names[0]))
+            if names[0] == name:
+                self._linkFile(source, relativePath)
+
+    def _unlinkEntry(self, name):
+        """ Remove the files of package name from the generation being built,
+        replacing them by the ones of other packages having them, and the
+        directories which become empty by it. """
+        providers = self._working['providers']
+        directories = set()
+        for relativePath, source in self._entryFiles(name):
+            names = providers[relativePath]
+            wasUsed = names[0] == name
+            names.remove(name)
+            if not wasUsed:
+                continue
+            if names:
+                self._linkFile(os.path.join(self.entryPath(self._working['packages'][names[0]]['store']),
+                        relativePath), relativePath)
+                continue
+            del providers[relativePath]
+            os.remove(os.path.join(self._working['path'], relativePath))
+            directories.add(os.path.dirname(relativePath))
+        # remove the directories which became empty, deepest first
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory:
+                path = os.path.join(self._working['path'], directory)
+                if not os.path.isdir(path) or os.listdir(path):
+                    break
+                os.rmdir(path)
+                directory = os.path.dirname(directory)
+
+    def _linkFile(self, source, relativePath):
+        """ Link the file source of a store entry to relativePath in the
+        generation being built. Files are hardlinked, or symlinked if the
+        store is on another file system. """
+        destination = os.path.join(self._working['path'], relativePath)
+        if os.path.lexists(destination):
+            os.remove(destination)
+        elif not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), destination)
+            return
+        try:
+            os.link(source, destination)
+        except OSError:
+            os.symlink(source, destination)
+
+    def manifest(self, entry, prefix):
+        """ Return the files manifest of the store entry entry as installed
+        below prefix. """
+        if entry is None:
+            return {}
+        files = _treeFiles(self.entryPath(entry))
+        manifest = _fileManifest([source for relativePath, source in files])
+        return dict((os.path.join(prefix, relativePath), manifest[source]) for relativePath, source in files \
+                if source in manifest)
+
+    def activate(self, number):
+        """ Atomically point the install prefix to generation number. """
+        link = self._prefix + '.lpm-new'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(self._generationPath(number), link)
+        os.rename(link, self._prefix)
+
+    def _removeGeneration(self, number):
+        path = self._generationPath(number)
+        os.remove(path + '.json')
+        shutil.rmtree(path)
+
+    def collectGarbage(self, keep=None):
+        """ Remove all but the newest keep generations (all are kept if keep
+        is None), never the current one, then the store entries no remaining
+        generation uses and the pooled files no entry uses. Returns the
+        number of removed generations and entries and the freed bytes.
+
+        """
+        with self._lock:
+            current = self.currentGeneration()
+            generations = self.generations()
+            removedGenerations = 0
+            if keep is not None:
+                for number in generations[:max(len(generations) - keep, 0)]:
+                    if number != current:
+                        self._removeGeneration(number)
+                        removedGenerations += 1
+            used = set()
+            for number in self.generations():
+                used.update(p['store'] for p in self.generationInfo(number)['packages'].itervalues())
+            removedEntries = 0
+            for name in os.listdir(self._profilesPath):
+                # generations left by interrupted runs
+                if name.startswith('.') and name[1:].isdigit() and \
+                        (self._working is None or os.path.join(self._profilesPath, name) != self._working['path']):
+                    shutil.rmtree(os.path.join(self._profilesPath, name))
+            for entry in os.listdir(self._storePath):
+                # unused entries and leftovers of interrupted installations
+                if entry != os.path.basename(self._poolPath) and entry not in used:
+                    shutil.rmtree(self.entryPath(entry))
+                    removedEntries += 1
+            freed = 0
+            for name in os.listdir(self._poolPath):
+                poolFile = os.path.join(self._poolPath, name)
+                st = os.lstat(poolFile)
+                if st.st_nlink == 1:
+                    os.remove(poolFile)
+                    freed += st.st_size
+            return removedGenerations, removedEntries, freed
+
+
+class _Fetch(object):
+    """ A download of the repository proxy. Clients follow the partial file
+    while it is in progress and wait for done. error is set if the download
+    failed and missing if the file doesn't exist upstream.
+
+    """
+    def __init__(self, destination):
+        self.destination = destination
+        self.partPath = _partPath(destination)
+        self.done = threading.Event()
+        self.error = None
+        self.missing = False
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RepositoryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.proxy.handle(self, headOnly=False)
+
+    def do_HEAD(self):
+        self.server.proxy.handle(self, headOnly=True)
+
+    def log_message(self, format, *args):
+        # a single write keeps messages of parallel requests apart
+        sys.stdout.write("{0} {1}\n".format(self.address_string(), format % args))
+
+
+class RepositoryProxy(object):
+    """ Serves the package manager directory of packageManager as package
+    repository. The repository index and the package configs are generated
+    from the available packages, which are updated from upstream when they
+    are older than _serveUpdateInterval. Sources, install scripts and
+    binaries are served from the local caches; missing ones, and those whose
+    checksum doesn't match, are downloaded from upstream on demand. The
+    checksum of a cached file is verified once per version of the file.
+    Cached files without a checksum are served after upstream confirmed with
+    a conditional request that they didn't change, at most every
+    _serveUpdateInterval, and downloaded again if they did. Concurrent
+    requests for the same file share one download and are streamed the data
+    while it arrives. Other paths are forwarded to upstream.
+
+    """
+    def __init__(self, packageManager):
+        self._pm = packageManager
+        self._lock = threading.Lock()
+        self._updateLock = threading.Lock()
+        self._lastUpdate = None
+        self._fetches = {}
+        # when cached files without a checksum were last confirmed by upstream
+        self._revalidated = {}
+        # the checksum, inode, size and mtime of cached files found valid
+        self._verified = {}
+        self._indexSignature = None
+        self._index = None
+        self._checksumsCache = (None, None)
+        self._cachedDirectories = {_sourcesDir: packageManager._sourcesPath,
+                _installScriptsDir: packageManager._installScriptsPath,
+                _binariesDir: packageManager._binariesPath,
+                _deltasDir: packageManager._deltasPath}
+
+    def handle(self, handler, headOnly):
+        path = urllib.unquote(urlsplit(handler.path).path).lstrip('/')
+        directory, _, name = path.rpartition('/')
+        try:
+            if path in (_repositoryIndexFile, _repositoryIndexFile + '.gz'):
+                self._sendIndex(handler, path.endswith('.gz'), headOnly)
+            elif directory == _availablePackagesDir:
+                self._update()
+                if not name:
+                    self._sendListing(handler, self._pm._availablePackagesPath, headOnly)
+                else:
+                    self._sendFile(handler, self._localFile(self._pm._availablePackagesPath, name), headOnly)
+            elif directory in self._cachedDirectories and name:
+                self._sendCached(handler, directory, name, headOnly)
+            elif path.split('/')[0] == _pmDir:
+                self._forward(handler, path, headOnly)
+            else:
+                handler.send_error(404)
+        except socket.error:
+            # the client went away
+            handler.close_connection = 1
+
+    def _update(self):
+        """ Update the available packages from upstream if they are older
+        than _serveUpdateInterval. Requests arriving during an update wait
+        for it instead of starting another one. Upstream failures are
+        reported and the previous packages served.
+
+        """
+        with self._updateLock:
+            if self._lastUpdate is not None and time.time() - self._lastUpdate < _serveUpdateInterval:
+                return
+            try:
+                self._pm.updateAvailablePackages()
+            except (PackageManagerError, HTTPError, URLError, socket.error, httplib.HTTPException) as e:
+                sys.stdout.write("updating the available packages failed, serving the previous ones: {0}\n" \
+                        .format(e))
+            self._lastUpdate = time.time()
 
+    def _localFile(self, directory, name):
+        """ Return the path of file name in directory or None if name isn't
+        a plain file name. """
+        if not name or name.startswith('.') or '/' in name or '\\' in name:
+            return None
+        return os.path.join(directory, name)
 
-class Package(object):
-    def __init__(self, config):
-        self.name = config['name']
-        self.version = Version(config['version'])
-        self.packageType = config['type']
-        self.dependencies = config['dependencies']
-        if self.packageType == 'archive':
-            self.sourceFile = config['sourceFile']
-            self.installScript = config['installScript']
-            self.shortType = 'a'
-        elif self.packageType == 'meta':
-            self.shortType = 'm'
-        elif self.packageType == 'git':
-            # TODO
-            self.shortType = 'g'
-        else:
-            raise ValueError("unknown package type {0.packageType}".format(self))
+    def _checksums(self):
+        """ Return a dict mapping (directory, file name) of sources,
+        install scripts and deltas to their sha256 checksum and size. """
+        with self._lock:
+            signature = self._pm._configsSignature(self._pm._availablePackagesPath)
+            if signature == self._checksumsCache[0]:
+                return self._checksumsCache[1]
+            checksums = {}
+            for versions in self._pm._availablePackageVersions.itervalues():
+                for p in versions:
+                    if p.packageType == 'archive':
+                        checksums[(_sourcesDir, p.sourceFile)] = (p.sourceFileSha256, p.sourceFileSize)
+                        checksums[(_installScriptsDir, p.installScript)] = (p.installScriptSha256,
+                                p.installScriptSize)
+                        for delta in p.sourceDeltas:
+                            checksums[(_deltasDir, delta['deltaFile'])] = (delta.get('deltaSha256'),
+                                    delta.get('deltaSize'))
+            self._checksumsCache = (signature, checksums)
+            return checksums
 
-    def __str__(self):
-        return '{0.name} ({0.version})'.format(self)
+    def _sendIndex(self, handler, compressed, headOnly):
+        self._update()
+        configsPath = self._pm._availablePackagesPath
+        with self._lock:
+            signature = self._pm._configsSignature(configsPath)
+            if signature != self._indexSignature:
+                packages = {}
+                for configFile, config in self._pm._loadPackageConfigs(configsPath).iteritems():
+                    packages[configFile] = config
+                data = json.dumps({'packages': packages}, sort_keys=True)
+                gzData = StringIO()
+                gz = gzip.GzipFile(fileobj=gzData, mode='wb')
+                try:
+                    gz.write(data)
+                finally:
+                    gz.close()
+                self._index = (data, gzData.getvalue(), '"{0}"'.format(hashlib.sha256(data).hexdigest()[:32]))
+                self._indexSignature = signature
+            data, gzData, etag = self._index
+        if handler.headers.getheader('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        data = compressed and gzData or data
+        handler.send_response(200)
+        handler.send_header('Content-Type', compressed and 'application/gzip' or 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.send_header('ETag', etag)
+        handler.end_headers()
+        if not headOnly:
+            handler.wfile.write(data)
 
-    def __eq__(self, other):
-        if not isinstance(other, Package):
-            return NotImplemented
-        return (self.name == other.name and self.version == other.version)
+    def _sendListing(self, handler, directory, headOnly):
+        names = sorted(f for f in os.listdir(directory) if not f.startswith('.'))
+        data = '<html><body>\n{0}</body></html>\n'.format(''.join('<a href="{0}">{1}</a><br>\n'.format(
+                urllib.quote(name), cgi.escape(name)) for name in names))
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/html')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        if not headOnly:
+            handler.wfile.write(data)
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def _sendFile(self, handler, path, headOnly):
+        """ Send the local file path, honouring a 'bytes=start-' range, its
+        If-Range date and an If-Modified-Since date. """
+        if path is None or not os.path.isfile(path):
+            handler.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            lastModified = int(st.st_mtime)
+            since = email.utils.parsedate_tz(handler.headers.getheader('If-Modified-Since') or '')
+            if since is not None and lastModified <= email.utils.mktime_tz(since):
+                handler.send_response(304)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            start = 0
+            match = re.match(r'bytes=(\d+)-$', handler.headers.getheader('Range') or '')
+            ifRange = handler.headers.getheader('If-Range')
+            if ifRange is not None and ifRange != email.utils.formatdate(lastModified, usegmt=True):
+                # the client's partial data is of another version of the file
+                match = None
+            if match:
+                start = int(match.group(1))
+                if start >= size:
+                    handler.send_response(416)
+                    handler.send_header('Content-Range', 'bytes */{0}'.format(size))
+                    handler.send_header('Content-Length', '0')
+                    handler.end_headers()
+                    return
+                handler.send_response(206)
+                handler.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, size - 1, size))
+            else:
+                handler.send_response(200)
+            handler.send_header('Content-Type', 'application/octet-stream')
+            handler.send_header('Content-Length', str(size - start))
+            handler.send_header('Last-Modified', email.utils.formatdate(lastModified, usegmt=True))
+            handler.end_headers()
+            if headOnly:
+                return
+            f.seek(start)
+            shutil.copyfileobj(f, handler.wfile, _downloadChunkSize)
 
-    @classmethod
-    def fromJsonFile(cls, jsonFile):
-        with open(jsonFile) as f:
-            obj = cls(json.load(f))
-            obj.configFile = os.path.basename(jsonFile)
-            return obj
+    def _sendCached(self, handler, directory, name, headOnly):
+        """ Send a source, install script or binary from the local cache or
+        from a download of it, started if none is running. """
+        destination = self._localFile(self._cachedDirectories[directory], name)
+        if destination is None:
+            handler.send_error(404)
+            return
+        sha256, size = self._checksums().get((directory, name), (None, None))
+        cached = os.path.isfile(destination)
+        # binaries are named by their build key and never change
+        if (directory == _binariesDir and cached) or self._isCachedFileValid(destination, sha256, size):
+            self._sendFile(handler, destination, headOnly)
+            return
+        revalidate = cached and sha256 is None
+        if revalidate and time.time() - self._revalidated.get(destination, 0) < _serveUpdateInterval:
+            self._sendFile(handler, destination, headOnly)
+            return
+        with self._lock:
+            fetch = self._fetches.get(destination)
+            if fetch is None:
+                fetch = _Fetch(destination)
+                self._fetches[destination] = fetch
+                thread = threading.Thread(target=self._download, args=(fetch,
+                        urljoin(urljoin(self._pm.packageRepoURL, directory + '/'), urllib.quote(name)),
+                        directory == _installScriptsDir, sha256, size, revalidate))
+                thread.daemon = True
+                thread.start()
+        self._follow(handler, fetch, size, headOnly)
 
-    def _unpackSource(self, sourcesPath, buildPath):
-        sourceFile = os.path.join(sourcesPath, self.sourceFile)
-        unpackTo = os.path.join(buildPath, self.name)
-        if os.path.isdir(unpackTo):
-            shutil.rmtree(unpackTo)
-        os.makedirs(unpackTo)
+    def _isCachedFileValid(self, path, sha256, size):
+        """ Like _isCachedFileValid, hashing the file only if it changed
+        since it was last found valid. """
         try:
-            tf = tarfile.open(sourceFile)
-        except OSError as e:
-            raise PackageError("Error while unpacking source file: {0}".format(sourceFile))
+            stat = os.stat(path)
+        except OSError:
+            return False
+        signature = (sha256, stat.st_ino, stat.st_size, stat.st_mtime)
+        if sha256 is not None and self._verified.get(path) == signature:
+            return True
+        if not _isCachedFileValid(path, sha256, size):
+            return False
+        self._verified[path] = signature
+        return True
+
+    def _download(self, fetch, url, executable, sha256, size, revalidate):
+        """ Download url for fetch. With revalidate the cached file is kept
+        if upstream didn't change it since it was cached. """
         try:
-            tf.extractall(path=unpackTo)
+            if not (revalidate and self._isUnchangedUpstream(url, fetch.destination)):
+                fetch.missing = self._pm._downloadFile(url, fetch.destination, executable, sha256, size,
+                        missingOk=True) is None
+            if sha256 is None and not fetch.missing:
+                self._revalidated[fetch.destination] = time.time()
+        except Exception as e:
+            fetch.error = e
+            sys.stdout.write("download of {0} failed: {1}\n".format(url, e))
         finally:
-            tf.close()
+            with self._lock:
+                del self._fetches[fetch.destination]
+            fetch.done.set()
 
-    def _runInstallScript(self, buildPath, installScriptsPath, environmentVariables):
-        installScript = os.path.abspath(os.path.join(installScriptsPath, self.installScript))
-        unpackedSource = os.path.join(buildPath, self.name)
-	env = os.environ
-	env.update(environmentVariables)
+    def _isUnchangedUpstream(self, url, path):
+        """ Return True if upstream answers a HEAD request for url if
+        modified since the modification time of path with 304, or can't be
+        reached, so the cached file is served. """
+        headers = {'If-Modified-Since': email.utils.formatdate(os.path.getmtime(path), usegmt=True)}
         try:
-            subprocess.check_call([installScript], cwd=unpackedSource, env=env)
-        except OSError as e:
-            raise PackageError("Can not call installation script: {0}".format(e))
-        except subprocess.CalledProcessError as e:
-            raise PackageError("Error in installation script: {0}".format(e))
+            self._pm._withMirrors(url, lambda candidate: self._pm._connections.open(candidate, headers,
+                    'HEAD')).close()
+        except HTTPError as e:
+            return e.code == 304
+        except PackageManagerError as e:
+            sys.stdout.write("revalidating {0} failed, serving the cached file: {1}\n".format(url, e))
+            return True
+        return False
 
-    def install(self, sourcesPath, installScriptsPath, buildPath, environmentVariables):
-        print "\n--- installing {0} ---".format(self)
-        if self.packageType == 'archive':
-            self._unpackSource(sourcesPath, buildPath)
-            self._runInstallScript(buildPath, installScriptsPath, environmentVariables)
-        elif self.packageType == 'meta':
-            pass
-        elif self.packageType == 'git':
-            # TODO
-            raise NotImplementedError
-        else:
-            raise ValueError("unknown package type {0.packageType}".format(self))
+    def _follow(self, handler, fetch, size, headOnly):
+        """ Stream the data of fetch to the client while it arrives. """
+        while True:
+            # the partial file appears once upstream answered
+            while not fetch.done.is_set() and not os.path.exists(fetch.partPath):
+                fetch.done.wait(0.05)
+            if fetch.done.is_set():
+                if fetch.missing:
+                    handler.send_error(404)
+                elif fetch.error is not None:
+                    handler.send_error(502, str(fetch.error))
+                else:
+                    self._sendFile(handler, fetch.destination, headOnly)
+                return
+            try:
+                f = open(fetch.partPath, 'rb')
+                break
+            except IOError:
+                # renamed or removed in the meantime
+                continue
+        with f:
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/octet-stream')
+            if size is not None:
+                handler.send_header('Content-Length', str(size))
+            else:
+                # the end of the data is the end of the connection
+                handler.send_header('Connection', 'close')
+                handler.close_connection = 1
+            handler.end_headers()
+            if headOnly:
+                return
+            position = 0
+            while True:
+                finished = fetch.done.is_set()
+                chunk = f.read(_downloadChunkSize)
+                if chunk:
+                    handler.wfile.write(chunk)
+                    position += len(chunk)
+                    continue
+                if finished:
+                    break
+                if os.fstat(f.fileno()).st_size < position:
+                    # the download started over, the data sent is wrong
+                    fetch.error = fetch.error or PackageManagerError("download restarted")
+                    break
+                fetch.done.wait(0.05)
+        if fetch.error is not None or fetch.missing:
+            # the client sees a truncated response
+            handler.close_connection = 1
+
+    def _forward(self, handler, path, headOnly):
+        """ Send the upstream file path without caching it. """
+        try:
+            data, headers = self._pm._read(urljoin(self._pm.packageRepoURL, urllib.quote(path)))
+        except HTTPError as e:
+            handler.send_error(e.code)
+            return
+        except (PackageManagerError, URLError, socket.error, httplib.HTTPException) as e:
+            handler.send_error(502, str(e))
+            return
+        contentType = headers.getheader('Content-Type') or 'application/octet-stream'
+        handler.send_response(200)
+        handler.send_header('Content-Type', contentType)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        if not headOnly:
+            handler.wfile.write(data)
 
 
 class PackageManager(object):
     def __init__(self, config):
         self._basePath = os.path.expanduser(config['packageManagerDir'])
         self._availablePackagesPath = os.path.join(self._basePath, _availablePackagesDir)
-        self._installedPackagesPath = os.path.join(self._basePath, _installedPackagesDir)
+        self._databasePath = os.path.join(self._basePath, _installedDatabaseFile)
         self._sourcesPath = os.path.join(self._basePath, _sourcesDir)
         self._installScriptsPath = os.path.join(self._basePath, _installScriptsDir)
         self._buildPath = os.path.join(self._basePath, _buildDir)
+        self._binariesPath = os.path.join(self._basePath, _binariesDir)
+        self._deltasPath = os.path.join(self._basePath, _deltasDir)
+        self._gitPath = os.path.join(self._basePath, _gitDir)
 
         # create directories if they don't exist
-        for d in [self._availablePackagesPath, self._installedPackagesPath, \
-                self._sourcesPath, self._installScriptsPath, self._buildPath]:
+        for d in [self._availablePackagesPath, self._sourcesPath, self._installScriptsPath,
+                self._buildPath, self._binariesPath, self._deltasPath, self._gitPath]:
             if not os.path.isdir(d):
                 os.makedirs(d)
 
         self._installEnvs = config['installationEnvironmentVariables']
-        self.packageRepoURL = config['packageRepositoryURL']
+        # the mirrors of the repository, packageRepositoryURL is the primary one
+        self._mirrors = []
+        for url in [config.get('packageRepositoryURL')] + config.get('packageRepositoryURLs', []):
+            if url and url.rstrip('/') + '/' not in self._mirrors:
+                self._mirrors.append(url.rstrip('/') + '/')
+        if not self._mirrors:
+            raise PackageManagerError("No package repository URL configured")
+        self.packageRepoURL = self._mirrors[0]
+        self._rankedMirrorsCache = None
+        self._mirrorsLock = threading.Lock()
+        # one lock per git mirror, packages may share a repository
+        self._gitLocks = {}
+        self._connections = _ConnectionPool(_connectionTimeout)
+        self.downloadJobs = _defaultDownloadJobs
+        self.buildJobs = _defaultBuildJobs
+        self.streamExtract = False
+        # don't ask for confirmation
+        self.assumeYes = False
+        # configs of the packages of an applied lockfile by name, used instead of availablePackages
+        self._lockedConfigs = {}
+        # phases of the run are recorded here
+        self.report = RunReport()
+        # keep unchanged build trees and give install scripts cache directories
+        self.incrementalBuilds = config.get('incrementalBuilds', False)
+        # 0 means the sources cache is not limited in size
+        self._sourcesCacheMaxSize = config.get('sourcesCacheMaxSizeMB', 0) * 1024 * 1024
+        # staged installs are packed into binaries and reused, needs an install prefix
+        self._binaryCache = config.get('binaryCache', False) and 'LPM_INSTALL_PREFIX' in self._installEnvs
+        # packages are installed into an immutable store and linked into profile generations
+        self._useStore = config.get('installStore', False)
+        if self._useStore and 'LPM_INSTALL_PREFIX' not in self._installEnvs:
+            raise PackageManagerError("The install store needs LPM_INSTALL_PREFIX")
+        # installed packages with their config and files, recorded once the generation is switched
+        self._pendingRecords = []
+
+        # package configs are read lazily on first access
+        self._availablePackageVersionsCache = None
+        self._availablePackagesCache = None
+        self._installedPackagesCache = None
+        self._databaseCache = None
+        self._storeCache = None
+
+    @property
+    def _store(self):
+        """ The install store or None if it isn't used. """
+        if self._useStore and self._storeCache is None:
+            self._storeCache = InstallStore(os.path.join(self._basePath, _storeDir),
+                    os.path.join(self._basePath, _profilesDir), self._installPrefix())
+        return self._storeCache
+
+    @property
+    def _availablePackageVersions(self):
+        """ All available versions of each package, newest first. """
+        if self._availablePackageVersionsCache is None:
+            self._availablePackageVersionsCache = self._readPackageConfigs(self._availablePackagesPath)
+        return self._availablePackageVersionsCache
 
-        self._availablePackages = self._readPackageConfigs(self._availablePackagesPath)
-        self._installedPackages = self._readPackageConfigs(self._installedPackagesPath)
+    @property
+    def _availablePackages(self):
+        """ The newest available version of each package. """
+        if self._availablePackagesCache is None:
+            self._availablePackagesCache = dict((name, versions[0]) for name, versions \
+                    in self._availablePackageVersions.iteritems())
+        return self._availablePackagesCache
+
+    @property
+    def _database(self):
+        """ The database of the installed packages, opened on first use. """
+        if self._databaseCache is None:
+            self._databaseCache = InstalledDatabase(self._databasePath)
+            self._migrateInstalledPackages()
+        return self._databaseCache
+
+    def _migrateInstalledPackages(self):
+        """ Move the installed packages from the config file directory used
+        before the database into the database. The files they installed are
+        unknown. The directory is kept renamed as backup.
+
+        """
+        legacyPath = os.path.join(self._basePath, _installedPackagesDir)
+        if not os.path.isdir(legacyPath):
+            return
+        newest = {}
+        for configFile, config in sorted(self._loadPackageConfigs(legacyPath).iteritems()):
+            p = Package(config)
+            if p.name in newest:
+                warnings.warn("Multiple versions of package {0} are installed, migrating the newest." \
+                        .format(p.name))
+                if newest[p.name][0].version >= p.version:
+                    continue
+            newest[p.name] = (p, configFile, config)
+        for p, configFile, config in newest.itervalues():
+            self._database.record(p, configFile, config, {})
+        os.rename(legacyPath, legacyPath + '.migrated')
+        if os.path.isfile(legacyPath + _packageIndexSuffix):
+            os.remove(legacyPath + _packageIndexSuffix)
+        print "Migrated {0} installed packages into {1}".format(len(newest), self._databasePath)
+
+    @property
+    def _installedPackages(self):
+        if self._installedPackagesCache is None:
+            with self.report.phase('loadInstalledPackages') as entry:
+                self._installedPackagesCache = {}
+                for configFile, config in self._database.packages():
+                    p = Package(config)
+                    p.configFile = configFile
+                    self._installedPackagesCache[p.name] = p
+                entry['packages'] = len(self._installedPackagesCache)
+        return self._installedPackagesCache
+
+    def _installPrefix(self):
+        """ The absolute install prefix or None if none is configured. """
+        if 'LPM_INSTALL_PREFIX' not in self._installEnvs:
+            return None
+        return os.path.abspath(os.path.expanduser(self._installEnvs['LPM_INSTALL_PREFIX']))
+
+    def _configsSignature(self, configsPath):
+        configFiles = sorted(f for f in os.listdir(configsPath) if not f.startswith('.'))
+        return [marshal.version, os.stat(configsPath).st_mtime, configFiles]
+
+    def _loadPackageConfigs(self, configsPath):
+        """ Return a dict mapping the config file names in configsPath to the
+        parsed package configs. The configs are kept in a marshalled index
+        file next to configsPath which is only rebuilt if the modification time
+        or the file list of configsPath changed. Config files therefore have
+        to be replaced by renaming, not modified in place.
+
+        """
+        indexPath = configsPath + _packageIndexSuffix
+        signature = self._configsSignature(configsPath)
+        configs = _readMarshalled(indexPath, signature)
+        if configs is not None:
+            return configs
+        configs = {}
+        for packageConfigFile in signature[2]:
+            with open(os.path.join(configsPath, packageConfigFile)) as f:
+                configs[packageConfigFile] = json.load(f)
+        _writeMarshalled(indexPath, signature, configs)
+        return configs
 
     def _readPackageConfigs(self, configsPath):
+        """ Return a dict mapping package names to the list of all versions of
+        the package found in configsPath, newest first.
+
+        """
+        with self.report.phase('loadPackageConfigs', directory=os.path.basename(configsPath)) as entry:
+            configs = self._loadPackageConfigs(configsPath)
+            entry['configs'] = len(configs)
         packages = {}
-        for packageConfigFile in os.listdir(configsPath):
-            if not packageConfigFile.startswith('.'):
-                p = Package.fromJsonFile(os.path.join(configsPath, packageConfigFile))
-                if p.name in packages:
-                    warnings.warn("Package {0.name} from file {1} overwrites previous definition of package." \
-                            .format(p, packageConfigFile))
-                packages[p.name] = p
+        for packageConfigFile, config in sorted(configs.iteritems()):
+            p = Package(config)
+            p.configFile = packageConfigFile
+            versions = packages.setdefault(p.name, [])
+            if p in versions:
+                warnings.warn("Package {0} from file {1} overwrites previous definition of package." \
+                        .format(p, packageConfigFile))
+                versions.remove(p)
+            versions.append(p)
+        for versions in packages.itervalues():
+            if len(versions) > 1:
+                versions.sort(key=lambda p: p.version.key, reverse=True)
         return packages
 
-    def _getDependencies(self, package):
-        """ Return all dependencies of package recursively as a list. Direct
-        dependencies are first and dependencies of dependencies come after
-        those. The packages need to be installed in reversed order. Duplicates
-        are possible.
+    def _resolveVersions(self, requirements, preferInstalled=False, respectInstalled=False):
+        """ Select a version of every package needed for requirements, a list
+        of (name, VersionConstraint or None) tuples, and return them as a dict
+        keyed by name. The newest version satisfying all constraints on a
+        package is selected; with preferInstalled the installed version of a
+        dependency is kept if it satisfies them. If no version of a package
+        satisfies its constraints, the most recently selected of the packages
+        depending on it which has other versions to try is excluded and an
+        older version of it is tried instead; if none has, the packages
+        depending on those are tried and so on. Packages only needed by
+        replaced selections are dropped together with their constraints. With
+        respectInstalled the constraints of installed packages which are not
+        selected, and so stay installed as they are, apply as well.
 
         """
-        allDependencies = []
-        for dependencyName in package.dependencies:
-            try:
-                dependency = self._availablePackages[dependencyName]
-            except KeyError:
-                raise PackageManagerError("Can not resolve dependency '{0}' of package {1}"\
-                        .format(dependencyName, package))
-            allDependencies.append(dependency)
-            allDependencies += self._getDependencies(dependency)
-        return allDependencies
-
-    def _getInstalledDependings(self, package):
-        """ Return all packages which depend on package recursively as a list.
-        Directly depending packages are first, with indirectly depending
-        packages after those. Packages need to be rebuilt in normal order for
-        an upgrade. Duplicates are possible.
-
-        """
-        allDependings = []
-        for p in self._installedPackages.values():
-            if package.name in p.dependencies:
-                allDependings.append(p)
-                allDependings += self._getInstalledDependings(p)
-        return allDependings
+        versions = self._availablePackageVersions
+        rootNames = set(name for name, constraint in requirements)
+        # constraints[name][origin] is the list of constraints origin puts on name,
+        # every selected package depending on name is an origin, None are the requirements
+        constraints = {}
+        for name, constraint in requirements:
+            rootConstraints = constraints.setdefault(name, {}).setdefault(None, [])
+            if constraint is not None:
+                rootConstraints.append(constraint)
+        selected = {}
+        selectionOrder = {}
+        selectionCounter = itertools.count()
+        excluded = set()
+        conflict = None
+        # guard against selections changing back and forth forever
+        maxSelections = 10 * sum(len(v) for v in versions.itervalues()) + len(requirements)
+        toCheck = deque(name for name, constraint in requirements)
+        queued = set(toCheck)
+        # packages which lost constraints, a newer version may satisfy them now
+        relaxed = set()
+        # installedConstraints[name][origin] is the list of constraints the installed package origin puts on name
+        installedConstraints = {}
+        if respectInstalled:
+            for p in self._installedPackages.itervalues():
+                for dependencyName, dependencyConstraints in p.dependencyConstraints.iteritems():
+                    if dependencyConstraints:
+                        installedConstraints.setdefault(dependencyName, {})[p.name] = dependencyConstraints
+
+        def hasAlternative(name):
+            return any(p is not selected[name] and (name, p.version) not in excluded for p in versions[name])
+
+        def removeConstraints(name):
+            dependencyNames = list(selected[name].dependencies)
+            if name in self._installedPackages and respectInstalled:
+                # the constraints of the installed version apply again if name is dropped
+                dependencyNames += self._installedPackages[name].dependencies
+            for dependencyName in dependencyNames:
+                if dependencyName in constraints:
+                    constraints[dependencyName].pop(name, None)
+                relaxed.add(dependencyName)
+                if dependencyName not in queued:
+                    toCheck.append(dependencyName)
+                    queued.add(dependencyName)
+
+        def dropUnneeded():
+            needed = set()
+            toVisit = list(rootNames)
+            while toVisit:
+                name = toVisit.pop()
+                if name not in needed and name in selected:
+                    needed.add(name)
+                    toVisit.extend(selected[name].dependencies)
+            for name in [n for n in selected if n not in needed]:
+                removeConstraints(name)
+                del selected[name]
+
+        def satisfies(name, p):
+            if (name, p.version) in excluded:
+                return False
+            for originConstraints in constraints[name].itervalues():
+                for c in originConstraints:
+                    if not c.matches(p.version):
+                        return False
+            for origin, originConstraints in installedConstraints.get(name, {}).iteritems():
+                if origin not in selected:
+                    for c in originConstraints:
+                        if not c.matches(p.version):
+                            return False
+            return True
+
+        while toCheck:
+            name = toCheck.popleft()
+            queued.discard(name)
+            if name not in rootNames and not constraints.get(name):
+                # only needed by a replaced selection
+                continue
+            current = selected.get(name)
+            if current is not None and name not in relaxed and satisfies(name, current):
+                continue
+            relaxed.discard(name)
+            if name not in versions:
+                origins = [str(selected[o]) for o in constraints[name] if o is not None]
+                raise PackageManagerError("Can not resolve dependency '{0}' of package {1}" \
+                        .format(name, ', '.join(origins)))
+            candidate = None
+            if preferInstalled and name not in rootNames and name in self._installedPackages:
+                installedVersion = self._installedPackages[name].version
+                for p in versions[name]:
+                    if p.version == installedVersion and satisfies(name, p):
+                        candidate = p
+            if candidate is None:
+                for p in versions[name]:
+                    if satisfies(name, p):
+                        candidate = p
+                        break
+            if candidate is None:
+                description = ', '.join('{0} (required by {1})'.format(','.join(str(c) for c in cs),
+                        o is None and 'command line' or selected[o]) for o, cs in constraints[name].iteritems() if cs)
+                description += ''.join(', {0} (required by installed {1})'.format(','.join(str(c) for c in cs),
+                        self._installedPackages[o]) for o, cs in installedConstraints.get(name, {}).iteritems() \
+                        if o not in selected)
+                conflict = conflict or "Can not find a version of {0} satisfying {1}".format(name, description)
+                # exclude the version of the package which selected name last and has other versions,
+                # going up to the packages which selected those if none has, and try again
+                culprit = None
+                origins = set(o for o in constraints[name] if o is not None)
+                seen = set(origins)
+                while origins and culprit is None:
+                    alternatives = [o for o in origins if hasAlternative(o)]
+                    if alternatives:
+                        culprit = max(alternatives, key=selectionOrder.get)
+                    origins = set(o for n in origins for o in constraints[n] if o is not None and o not in seen)
+                    seen.update(origins)
+                if culprit is None:
+                    raise PackageManagerError(conflict)
+                excluded.add((culprit, selected[culprit].version))
+                for n in (culprit, name):
+                    if n not in queued:
+                        toCheck.append(n)
+                        queued.add(n)
+                continue
+            if candidate is current:
+                continue
+            if current is not None:
+                removeConstraints(name)
+            selected[name] = candidate
+            selectionOrder[name] = next(selectionCounter)
+            if selectionOrder[name] > maxSelections:
+                raise PackageManagerError(conflict or "Can not resolve the version constraints")
+            for dependencyName in candidate.dependencies:
+                constraints.setdefault(dependencyName, {})[name] = candidate.dependencyConstraints[dependencyName]
+                if dependencyName not in queued:
+                    toCheck.append(dependencyName)
+                    queued.add(dependencyName)
+            if current is not None:
+                dropUnneeded()
+        return selected
 
     def getAvailablePackages(self):
         return self._availablePackages
@@ -227,148 +2673,1213 @@ class PackageManager(object):
             except KeyError as e:
                 print "i{0} {1} package deprecated".format(p.shortType, p)
 
-    def searchPackages(self, packageNames):
-        foundPackages = []
-        # search packages in available pacakges
-        for sp in packageNames:
-            for ap in self._availablePackages:
-                if sp in ap:
-                    foundPackage = self._availablePackages[ap]
-                    foundPackages.append(foundPackage)
+    def _loadSearchIndex(self):
+        """ Return the SearchIndex of the available packages, which is kept
+        next to the package index and rebuilt together with it. """
+        indexPath = self._availablePackagesPath + _searchIndexSuffix
+        signature = self._configsSignature(self._availablePackagesPath) + [SearchIndex.formatVersion]
+        data = _readMarshalled(indexPath, signature)
+        if data is not None:
+            return SearchIndex(data)
+        index = SearchIndex.build(self._availablePackages.values())
+        _writeMarshalled(indexPath, signature, index.data())
+        return index
+
+    def searchPackages(self, queries, regex=False):
+        """ Search the available packages and print the matches, best matches
+        first. A query searches names and descriptions unless it is prefixed
+        with a field like 'name:', 'description:' or 'dependencies:'. With
+        regex the queries are regular expressions.
+
+        """
+        fieldNames = {'name': 'name', 'description': 'description', 'desc': 'description',
+                'dependencies': 'dependencies', 'deps': 'dependencies', 'dep': 'dependencies'}
+        index = self._loadSearchIndex()
+        scores = {}
+        for query in queries:
+            fields = ('name', 'description')
+            field, sep, term = query.partition(':')
+            if sep and field in fieldNames:
+                fields = (fieldNames[field],)
+            else:
+                term = query
+            if regex:
+                try:
+                    pattern = re.compile(term, re.IGNORECASE)
+                except re.error as e:
+                    raise PackageManagerError("Invalid regular expression '{0}': {1}".format(term, e))
+                matches = index.searchRegex(pattern, fields)
+            else:
+                matches = index.search(term, fields)
+            for name, score in matches.iteritems():
+                scores[name] = max(scores.get(name, 0), score)
 
         # print and check if any of them are already installed
-        for fp in sorted(foundPackages, key=lambda p: p.name):
-            if fp.name in self._installedPackages:
-                installedVersion = self._installedPackages[fp.name].version
-                print "i{0} {1} installed in version {2}".format(fp.shortType, fp, installedVersion)
+        for name in sorted(scores, key=lambda n: (-scores[n], n)):
+            shortType, version = index.summaries[name]
+            if name in self._installedPackages:
+                installedVersion = self._installedPackages[name].version
+                print "i{0} {1} ({2}) installed in version {3}".format(shortType, name, version, installedVersion)
             else:
-                print " {0} {1} not installed".format(fp.shortType, fp)
+                print " {0} {1} ({2}) not installed".format(shortType, name, version)
 
     def installPackages(self, packageNames, reinstall=False, reinstallDependencies=False, upgrade=False):
-        """ Install the list of package names with dependencies.
+        """ Install the list of package names with dependencies. Package names
+        may carry version constraints like 'name>=1.2,<2'.
 
         """
-        packagesToInstall = []
-        for packageName in reversed(packageNames):
-            if packageName not in self._availablePackages.keys():
+        requirements = []
+        requested = set()
+        for requirement in packageNames:
+            try:
+                packageName, constraint = parseRequirement(requirement)
+            except ValueError as e:
+                raise PackageManagerError(e)
+            if packageName not in self._availablePackages:
                 print "Package '{0}' is not available".format(packageName)
                 continue
-            package = self._availablePackages[packageName]
             # ignore if already in the install list
-            if package in packagesToInstall:
+            if packageName in requested:
                 continue
+            package = self._availablePackages[packageName]
             # ignore and warn if already installed
             # if reinstall or upgrade is True don't check if the packet is already installed
-            if not reinstall and not upgrade and packageName in self._installedPackages.keys():
+            if not reinstall and not upgrade and packageName in self._installedPackages:
                 installedPackage = self._installedPackages[packageName]
                 print "Package '{0.name}' is already installed in version {0.version}.".format(installedPackage)
                 if package.version > installedPackage.version:
                     print "Newer version ({0.version}) is available. Please do update first.".format(package)
                     return
                 continue
-            for p in reversed(self._getDependencies(package)):
-                if p not in packagesToInstall:
-                    # if reinstallDependencies is True don't check if the dependency is already installed
-                    if reinstallDependencies:
-                        packagesToInstall = [p] + packagesToInstall
-                    elif p.name in self._installedPackages:
-                        installedPackage = self._installedPackages[p.name]
-                        # only complain about newer dependencies versions if not in upgrade mode
-                        if p.version > installedPackage.version and not upgrade:
-                            print "Newer version ({0.version}) is available for {0.name}. Please do update first.".format(p)
-                            return
-                    else:
-                        packagesToInstall = [p] + packagesToInstall
-            packagesToInstall = [package] + packagesToInstall
+            requirements.append((packageName, constraint))
+            requested.add(packageName)
+        rootNames = [r[0] for r in requirements]
 
+        with self.report.phase('plan', profile=True) as entry:
+            # installed dependencies are kept if they satisfy all constraints
+            resolved = self._resolveVersions(requirements,
+                    preferInstalled=not upgrade and not reinstallDependencies, respectInstalled=True)
+            # packages in installation order, dependencies first
+            packagesToInstall = []
+            for p in DependencyGraph(resolved).dependencies(rootNames):
+                # if reinstallDependencies is True don't check if the dependency is already installed
+                if p.name in requested or reinstallDependencies:
+                    packagesToInstall.append(p)
+                elif p.name not in self._installedPackages or self._installedPackages[p.name] != p:
+                    packagesToInstall.append(p)
+            entry['packages'] = len(packagesToInstall)
+        self._installPlan(packagesToInstall, resolved)
+
+    def _confirm(self):
+        """ Ask whether to go on, unless assumeYes is set. """
+        if self.assumeYes:
+            return True
+        doIt = raw_input("are you sure? [y/n]\n")
+        return doIt.lower() == 'y'
+
+    def _installPlan(self, packagesToInstall, resolved):
+        """ Print the actions for the ordered list packagesToInstall and
+        install them after confirmation. resolved contains the packages with
+        all their dependencies.
+
+        """
         if packagesToInstall:
             print "The following actions will be done (in this order):"
-            for p in reversed(packagesToInstall):
+            for p in packagesToInstall:
                 if p.name not in self._installedPackages:
                     print "  {0.name} install version {0.version}".format(p)
-                elif p in self._installedPackages.values():
+                elif p == self._installedPackages[p.name]:
                     print "  {0.name} reinstall version {0.version}".format(p)
-                else:
+                elif p.version > self._installedPackages[p.name].version:
                     installedVersion = self._installedPackages[p.name].version
                     print "  {0.name} update from version {1} to {0.version}".format(p, installedVersion)
+                else:
+                    installedVersion = self._installedPackages[p.name].version
+                    print "  {0.name} downgrade from version {1} to {0.version}".format(p, installedVersion)
             print
 
-            doIt = raw_input("are you sure? [y/n]\n")
-            if doIt.lower() == 'y':
+            if self._confirm():
                 print
                 print "=== downloading packages ==="
                 print
-                self.downloadPackages(packagesToInstall)
+                with self.report.phase('fetchBinaries'):
+                    binaryFiles = self._fetchBinaries(packagesToInstall, resolved)
+                with self.report.phase('downloadPackages'):
+                    self.downloadPackages([p for p in packagesToInstall \
+                            if not os.path.isfile(binaryFiles.get(p.name, ''))])
                 print
                 print "=== installing packages ==="
-                for p in reversed(packagesToInstall):
-                    # install package
+                with self.report.phase('installPackages'):
+                    self._installInOrder(packagesToInstall, binaryFiles)
+
+    def writeLockfile(self, path, packageNames):
+        """ Resolve the list of package names with their dependencies
+        against the available packages and write the plan, the packages in
+        installation order with their configs and so their checksums, to the
+        lockfile path.
+
+        """
+        requirements = []
+        for requirement in packageNames:
+            try:
+                packageName, constraint = parseRequirement(requirement)
+            except ValueError as e:
+                raise PackageManagerError(e)
+            if packageName not in self._availablePackages:
+                raise PackageManagerError("Package '{0}' is not available".format(packageName))
+            requirements.append((packageName, constraint))
+        with self.report.phase('plan', profile=True) as entry:
+            resolved = self._resolveVersions(requirements)
+            packages = DependencyGraph(resolved).dependencies([r[0] for r in requirements])
+            entry['packages'] = len(packages)
+        lockedPackages = []
+        for p in packages:
+            if p.packageType == 'archive' and not (p.sourceFileSha256 and p.installScriptSha256):
+                print "{0} has no checksums, its files are not pinned by the lockfile".format(p)
+            with open(os.path.join(self._availablePackagesPath, p.configFile)) as f:
+                config = json.load(f)
+            if p.packageType == 'git':
+                # pin the commit the ref points to now
+                config['resolvedCommit'] = self._fetchGitPackage(p)
+            lockedPackages.append({'name': p.name, 'version': str(p.version), 'configFile': p.configFile,
+                    'config': config})
+        _writeJson({'formatVersion': _lockfileFormatVersion, 'requested': packageNames,
+                'packages': lockedPackages}, os.path.abspath(path))
+        print "Locked {0} packages in {1}".format(len(lockedPackages), path)
+
+    def applyLockfile(self, path):
+        """ Install the packages of the lockfile path which are not
+        installed with the locked version and config, in the locked order.
+        Neither the available packages are read nor are versions resolved.
+        The differences to the installed packages are printed first.
+
+        """
+        try:
+            with open(path) as f:
+                lock = json.load(f)
+        except (IOError, ValueError) as e:
+            raise PackageManagerError("Can't read lockfile {0}: {1}".format(path, e))
+        if lock.get('formatVersion') != _lockfileFormatVersion:
+            raise PackageManagerError("Unsupported lockfile format in {0}".format(path))
+        resolved = {}
+        packages = []
+        for locked in lock['packages']:
+            p = Package(locked['config'])
+            p.configFile = locked['configFile']
+            resolved[p.name] = p
+            packages.append(p)
+            self._lockedConfigs[p.name] = locked['config']
+        unchanged = []
+        packagesToInstall = []
+        for p in packages:
+            installed = self._installedPackages.get(p.name)
+            if installed is not None and installed == p and \
+                    self._database.config(p.name) == self._lockedConfigs[p.name]:
+                unchanged.append(p)
+            else:
+                packagesToInstall.append(p)
+        print "{0} of {1} locked packages are installed as locked".format(len(unchanged), len(packages))
+        notLocked = sorted(name for name in self._installedPackages if name not in resolved)
+        if notLocked:
+            print "Installed packages not in the lockfile (kept): {0}".format(', '.join(notLocked))
+        self._installPlan(packagesToInstall, resolved)
+
+    def _packageConfig(self, package):
+        """ Return the config of package. """
+        if package.name in self._lockedConfigs:
+            return self._lockedConfigs[package.name]
+        with open(os.path.join(self._availablePackagesPath, package.configFile)) as f:
+            return json.load(f)
+
+    def _installPackage(self, package, logFile=None, binaryFile=None):
+        """ Install a single package and record it with the files it
+        installed as installed. The files of packages installed from or into
+        a binary are the members of the binary; for other packages they are
+        found by comparing the install prefix before and after the
+        installation, so with several build jobs files of packages installed
+        at the same time may be attributed to each other.
+
+        With the install store the package is installed through a binary
+        into a new store entry which is added to the generation being built;
+        it is recorded once that generation became the install prefix.
+
+        """
+        prefix = self._installPrefix()
+        store = self._store
+        unpackTo = None
+        temporaryBinary = None
+        if store is not None and package.packageType in ('archive', 'git'):
+            if not package.supportsDestdir:
+                raise PackageManagerError("{0} doesn't support DESTDIR and can't be installed into the " \
+                        "install store".format(package))
+            if binaryFile is None:
+                binaryFile = temporaryBinary = os.path.join(self._buildPath, package.name + '.store.tar.gz')
+                if os.path.isfile(temporaryBinary):
+                    os.remove(temporaryBinary)
+            unpackTo = store.temporaryEntry()
+        snapshot = None
+        if prefix is not None and package.packageType != 'meta' and binaryFile is None:
+            with self.report.phase('snapshotPrefix', package):
+                snapshot = _snapshotTree(prefix)
+        try:
+            with self.report.phase('install', package):
+                package.install(self._sourcesPath, self._installScriptsPath, self._buildPath, \
+                        self._buildEnvironment(package), logFile, binaryFile, self.incrementalBuilds,
+                        self.report, unpackTo)
+        except PackageError as e:
+            if unpackTo is not None:
+                shutil.rmtree(unpackTo)
+            if logFile is not None:
+                raise PackageManagerError("Error while installing {0}: {1} (see {2})".format(package, e, logFile))
+            raise PackageManagerError("Error while installing {0}: {1}".format(package, e))
+        config = self._packageConfig(package)
+        if package.packageType == 'git':
+            config = dict(config, resolvedCommit=package.resolvedCommit)
+        if store is not None:
+            with self.report.phase('addToGeneration', package) as entry:
+                storeEntry = None
+                if unpackTo is not None:
+                    storeEntry = store.addEntry(unpackTo, package)
+                store.change({package.name: {'store': storeEntry, 'configFile': package.configFile,
+                        'config': config}}, "install {0}".format(package))
+                if temporaryBinary is not None:
+                    os.remove(temporaryBinary)
+                files = store.manifest(storeEntry, prefix)
+                entry['files'] = len(files)
+            self._pendingRecords.append((package, config, files))
+            return
+
+        with self.report.phase('recordInstall', package) as entry:
+            exact = True
+            paths = []
+            if binaryFile is not None and os.path.isfile(binaryFile):
+                tf = tarfile.open(binaryFile)
+                try:
+                    paths = [os.path.normpath(os.path.join(prefix, m.name)) for m in tf.getmembers() \
+                            if not m.isdir()]
+                finally:
+                    tf.close()
+            elif snapshot is not None:
+                exact = False
+                paths = [path for path, state in _snapshotTree(prefix).iteritems() \
+                        if snapshot.get(path) != state]
+            files = _fileManifest(paths)
+            previousFiles = self._database.files(package.name)
+            if not exact:
+                # install scripts may skip unchanged files, they still belong to the package
+                for path, fileEntry in previousFiles.iteritems():
+                    if path not in files and os.path.lexists(path):
+                        files[path] = fileEntry
+            overwritten = self._database.record(package, package.configFile, config, files)
+            entry['files'] = len(files)
+        if overwritten:
+            owners = sorted(set(overwritten.itervalues()))
+            sys.stdout.write("{0} overwrote {1} files of {2}\n".format(package, len(overwritten), ', '.join(owners)))
+        if exact:
+            # files of the previous version which the new one doesn't have
+            self._removeFiles(dict((path, fileEntry) for path, fileEntry in previousFiles.iteritems() \
+                    if path not in files), package.name)
+        self._installedPackages[package.name] = package
+
+    def _removeFiles(self, files, owner):
+        """ Remove the files of the manifest files which are owned by owner
+        or by no package, and the directories which become empty by it.
+        Files modified after they were installed are kept. Returns the number
+        of removed files.
+
+        """
+        removed = 0
+        directories = set()
+        for path, (size, sha256) in sorted(files.iteritems()):
+            if not os.path.lexists(path) or self._database.owner(path) not in (None, owner):
+                continue
+            if not os.path.islink(path) and (os.path.getsize(path) != size or _sha256File(path) != sha256):
+                print "keeping modified file {0}".format(path)
+                continue
+            os.remove(path)
+            removed += 1
+            directories.add(os.path.dirname(path))
+        prefix = self._installPrefix()
+        # remove the directories which became empty, deepest first
+        for directory in sorted(directories, key=len, reverse=True):
+            while prefix is not None and directory.startswith(prefix + os.sep) and os.path.isdir(directory) \
+                    and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+        return removed
+
+    def uninstallPackages(self, packageNames):
+        """ Remove the files of the installed packages packageNames and
+        unregister them. Packages still required by other installed packages
+        are not uninstalled.
+
+        """
+        for name in packageNames:
+            if name not in self._installedPackages:
+                raise PackageManagerError("Package '{0}' is not installed".format(name))
+        names = set(packageNames)
+        for name in packageNames:
+            requiredBy = [d for d in self._database.dependings(name) if d not in names]
+            if requiredBy:
+                raise PackageManagerError("Package '{0}' is required by {1}".format(name,
+                        ', '.join(sorted(requiredBy))))
+        # dependings are removed before their dependencies
+        graph = DependencyGraph(dict((name, self._installedPackages[name]) for name in names),
+                ignoreMissing=True)
+        packages = list(reversed(graph.dependencies(packageNames)))
+
+        print "The following packages will be uninstalled (in this order):"
+        for p in packages:
+            print "  {0.name} version {0.version}".format(p)
+        print
+        if not self._confirm():
+            return
+        if self._store is not None:
+            # the files stay in the store for rollbacks
+            self._store.begin()
+            try:
+                self._store.change(dict((p.name, None) for p in packages),
+                        "uninstall {0}".format(', '.join(str(p) for p in packages)))
+            except:
+                self._store.abort()
+                raise
+            generation = self._store.commit()
+            for p in packages:
+                self._database.remove(p.name)
+                del self._installedPackages[p.name]
+            print "uninstalled {0} packages, switched to generation {1}".format(len(packages), generation)
+            return
+        for p in packages:
+            files = self._database.files(p.name)
+            removed = self._removeFiles(files, p.name)
+            self._database.remove(p.name)
+            del self._installedPackages[p.name]
+            print "uninstalled {0}, removed {1} of {2} files".format(p, removed, len(files))
+
+    def _requireStore(self):
+        if self._store is None:
+            raise PackageManagerError("The install store is not enabled, set installStore in the config")
+        return self._store
+
+    def printGenerations(self):
+        """ Print the profile generations of the install store. """
+        store = self._requireStore()
+        current = store.currentGeneration()
+        for number in store.generations():
+            info = store.generationInfo(number)
+            print "{0} {1:>4}  {2}  {3} packages: {4}".format(number == current and '*' or ' ', number,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(info['time'])), len(info['packages']),
+                    '; '.join(info['changes']))
+
+    def rollback(self, generation=None):
+        """ Point the install prefix to the profile generation number
+        generation, by default the one before the current one, and record its
+        packages as installed.
+
+        """
+        store = self._requireStore()
+        current = store.currentGeneration()
+        generations = store.generations()
+        if generation is None:
+            older = [number for number in generations if current is None or number < current]
+            if not older:
+                raise PackageManagerError("There is no generation before the current one")
+            generation = older[-1]
+        elif generation not in generations:
+            raise PackageManagerError("Generation {0} doesn't exist".format(generation))
+        store.activate(generation)
+        packages = store.generationInfo(generation)['packages']
+        prefix = self._installPrefix()
+        for name in list(self._installedPackages):
+            if name not in packages:
+                self._database.remove(name)
+                del self._installedPackages[name]
+        for name, info in packages.iteritems():
+            p = Package(info['config'])
+            p.configFile = info['configFile']
+            self._database.record(p, p.configFile, info['config'], store.manifest(info['store'], prefix))
+            self._installedPackages[name] = p
+        print "switched from generation {0} to {1}".format(current, generation)
+
+    def collectGarbage(self, keep=None):
+        """ Remove all but the newest keep profile generations and the store
+        entries and files no remaining generation uses. """
+        generations, entries, freed = self._requireStore().collectGarbage(keep)
+        print "removed {0} generations and {1} store entries, freed {2}".format(generations, entries,
+                _formatSize(freed))
+
+    def printOwners(self, paths):
+        """ Print which installed package owns each of paths. """
+        for path in paths:
+            path = os.path.abspath(os.path.expanduser(path))
+            owner = self._database.owner(path)
+            if owner is None:
+                print "{0} is not owned by any installed package".format(path)
+            else:
+                print "{0} is owned by {1}".format(path, self._installedPackages[owner])
+
+    def printFiles(self, packageNames):
+        """ Print the files installed by the packages packageNames. """
+        for name in packageNames:
+            if name not in self._installedPackages:
+                raise PackageManagerError("Package '{0}' is not installed".format(name))
+            for path in sorted(self._database.files(name)):
+                print path
+
+    def _buildEnvironment(self, package):
+        """ Return the install environment variables for package.
+        LPM_BUILD_PREFIX is where the installed packages are found during the
+        build: the install prefix, or with the install store the generation
+        being built, which becomes the install prefix after all packages are
+        installed. For incremental builds they include a persistent cache
+        directory of the package and hints for compiler caches, unless those
+        are already set.
+
+        """
+        envs = dict(self._installEnvs)
+        if self._installPrefix() is not None:
+            envs['LPM_BUILD_PREFIX'] = self._store is not None and self._store.workingPath() \
+                    or self._installPrefix()
+        if not self.incrementalBuilds:
+            return envs
+        buildPath = os.path.abspath(self._buildPath)
+        cachePath = os.path.join(buildPath, package.name + '.cache')
+        if not os.path.isdir(cachePath):
+            os.makedirs(cachePath)
+        envs['LPM_INCREMENTAL_BUILD'] = '1'
+        envs['LPM_PACKAGE_CACHE_DIR'] = cachePath
+        hints = [('CCACHE_DIR', os.path.join(buildPath, '.ccache')),
+                ('CCACHE_BASEDIR', os.path.join(buildPath, package.name)),
+                ('SCCACHE_DIR', os.path.join(buildPath, '.sccache'))]
+        for name, value in hints:
+            if name not in envs and name not in os.environ:
+                envs[name] = value
+        return envs
+
+    def _installInOrder(self, packages, binaryFiles={}):
+        """ Install the topologically ordered list of packages. With more than
+        one build job independent packages are built concurrently and the
+        output of each install script is written to a log file in the build
+        directory. binaryFiles maps package names to their binary file.
+
+        With the install store the packages are added to a new generation
+        which becomes the install prefix only if all of them were installed.
+
+        """
+        store = self._store
+        if store is None or not packages:
+            self._installAll(packages, binaryFiles)
+            return
+        store.begin()
+        self._pendingRecords = []
+        try:
+            self._installAll(packages, binaryFiles)
+        except:
+            store.abort()
+            self._pendingRecords = []
+            print "the install prefix was not changed"
+            raise
+        generation = store.commit()
+        for package, config, files in self._pendingRecords:
+            overwritten = self._database.record(package, package.configFile, config, files)
+            if overwritten:
+                owners = sorted(set(overwritten.itervalues()))
+                print "{0} overwrote {1} files of {2}".format(package, len(overwritten), ', '.join(owners))
+            self._installedPackages[package.name] = package
+        self._pendingRecords = []
+        print "switched the install prefix to generation {0}".format(generation)
+
+    def _installAll(self, packages, binaryFiles):
+        if self.buildJobs == 1:
+            for p in packages:
+                self._installPackage(p, binaryFile=binaryFiles.get(p.name))
+            return
+
+        def logFile(package):
+            return os.path.join(self._buildPath, package.name + '.log')
+
+        def onStart(package):
+            print "--- installing {0} (log: {1}) ---".format(package, logFile(package))
+
+        def onFinish(package, error):
+            if error is None:
+                print "--- installed {0} ---".format(package)
+            else:
+                print "--- failed to install {0}, waiting for running installations ---".format(package)
+
+        print "installing with up to {0} parallel jobs".format(self.buildJobs)
+        _runDependencyOrdered(lambda p: self._installPackage(p, logFile(p), binaryFiles.get(p.name)),
+                packages, self.buildJobs, onStart, onFinish)
+
+    def _computeBuildKeys(self, packages):
+        """ Return a dict mapping package names to a hash of everything that
+        goes into building the package: the checksums of source file and
+        install script, or the repository and resolved commit of git packages,
+        the install environment variables and the build keys of all
+        dependencies. packages must contain all dependencies. Packages without
+        known checksums or commit, or depending on such packages, get no key.
+
+        """
+        keys = {}
+        environment = json.dumps(self._installEnvs, sort_keys=True)
+        for p in DependencyGraph(packages).dependencies(packages.keys()):
+            if [d for d in p.dependencies if d not in keys]:
+                continue
+            inputs = [p.name, str(p.version), p.packageType, environment]
+            if p.packageType == 'archive':
+                if not (p.supportsDestdir and p.sourceFileSha256 and p.installScriptSha256):
+                    continue
+                inputs += [p.sourceFileSha256, p.installScriptSha256]
+            elif p.packageType == 'git':
+                if not (p.supportsDestdir and p.resolvedCommit and p.installScriptSha256):
+                    continue
+                inputs += [p.url, p.resolvedCommit, p.installScriptSha256]
+            elif p.packageType != 'meta':
+                continue
+            inputs += sorted(keys[d] for d in p.dependencies)
+            keys[p.name] = hashlib.sha256('\0'.join(inputs).encode('utf-8')).hexdigest()
+        return keys
+
+    def _fetchBinaries(self, packages, resolved):
+        """ Return a dict mapping the names of packages which can be installed
+        from a binary to the binary file path in the local binaries directory.
+        Binaries missing locally are downloaded from the binaries directory of
+        the repository if it has them. Binary files which don't exist after
+        this are created during the installation. The git packages to install
+        are fetched first as their build keys contain the resolved commit;
+        installed git dependencies use the commit they were built from.
+
+        """
+        if not self._binaryCache:
+            return {}
+        self._fetchGitPackages(packages)
+        names = set(p.name for p in packages)
+        keyPackages = dict(resolved)
+        for name, p in resolved.iteritems():
+            if p.packageType == 'git' and name not in names and name in self._installedPackages:
+                keyPackages[name] = self._installedPackages[name]
+        keys = self._computeBuildKeys(keyPackages)
+        binariesDirURL = urljoin(self.packageRepoURL, _binariesDir + '/')
+        binaryFiles = {}
+        downloads = []
+        for p in packages:
+            if p.packageType not in ('archive', 'git') or p.name not in keys:
+                continue
+            binaryFileName = '{0.name}-{0.version}-{1}.tar.gz'.format(p, keys[p.name])
+            binaryFiles[p.name] = os.path.join(self._binariesPath, binaryFileName)
+            if not os.path.isfile(binaryFiles[p.name]):
+                downloads.append((urljoin(binariesDirURL, binaryFileName), binaryFiles[p.name]))
+        if downloads:
+            _runParallel(lambda url, path: self._downloadFile(url, path, missingOk=True),
+                    downloads, self.downloadJobs)
+        available = len([f for f in binaryFiles.itervalues() if os.path.isfile(f)])
+        buildable = len([p for p in packages if p.packageType in ('archive', 'git')])
+        print "{0} of {1} archive and git packages are available as binaries".format(available, buildable)
+        return binaryFiles
+
+    @property
+    def _rankedMirrors(self):
+        """ The mirrors ordered by the latency of a request for their root
+        directory, unreachable mirrors last. Measured once per run. """
+        with self._mirrorsLock:
+            if self._rankedMirrorsCache is None:
+                def probe(mirror):
+                    startTime = time.time()
                     try:
-                        p.install(self._sourcesPath, self._installScriptsPath, self._buildPath, \
-                                self._installEnvs)
-                    except PackageError as e:
-                        raise PackageManagerError("Error while installing {0}: {1}".format(p, e))
-                    # copy config file to installed packages directory
-                    fromPath = os.path.join(self._availablePackagesPath, p.configFile)
-                    toPath = os.path.join(self._installedPackagesPath, p.configFile)
-                    shutil.copy(fromPath, toPath)
-
-    def _downloadFile(self, url, destination, executable=False):
+                        response = self._connections.open(mirror, method='HEAD')
+                        response.read()
+                        response.close()
+                    except HTTPError:
+                        # the server answered, directory listings may be forbidden
+                        pass
+                    except (URLError, socket.error, httplib.HTTPException) as e:
+                        sys.stdout.write("mirror {0} is not reachable: {1}\n".format(mirror, e))
+                        return None
+                    return time.time() - startTime
+
+                latencies = _runParallel(probe, [(m,) for m in self._mirrors], len(self._mirrors))
+                ranking = sorted(range(len(self._mirrors)),
+                        key=lambda i: (latencies[i] is None, latencies[i], i))
+                self._rankedMirrorsCache = [self._mirrors[i] for i in ranking]
+            return self._rankedMirrorsCache
+
+    def _demoteMirror(self, url):
+        """ Move the mirror url belongs to to the end of the ranking, so
+        later downloads try the other mirrors first. """
+        with self._mirrorsLock:
+            for mirror in self._rankedMirrorsCache or []:
+                if url.startswith(mirror):
+                    self._rankedMirrorsCache.remove(mirror)
+                    self._rankedMirrorsCache.append(mirror)
+                    return
+
+    def _mirrorURLs(self, url):
+        """ Return the URLs of url on all mirrors, fastest mirror first. URLs
+        outside of the repository are returned unchanged. """
+        if len(self._mirrors) == 1 or not url.startswith(self.packageRepoURL):
+            return [url]
+        path = url[len(self.packageRepoURL):]
+        return [mirror + path for mirror in self._rankedMirrors]
+
+    def _withMirrors(self, url, function):
+        """ Call function with the URL of url on each mirror until a call
+        succeeds and return its result. Calls failing with network or server
+        errors, stalled connections or broken data are tried on the next
+        mirror, and all mirrors are tried again with increasing delays. If no
+        mirror has url, the HTTPError is raised; other client errors are
+        raised immediately.
+
+        """
+        candidates = self._mirrorURLs(url)
+        lastError = None
+        for attempt in range(_downloadRetries + 1):
+            if attempt:
+                delay = _retryDelay * 2 ** (attempt - 1)
+                sys.stdout.write("retrying {0} in {1:.0f} s\n".format(url, delay))
+                time.sleep(delay)
+            missing = []
+            for candidate in candidates:
+                try:
+                    return function(candidate)
+                except HTTPError as e:
+                    if e.code in (403, 404):
+                        missing.append(e)
+                        continue
+                    if e.code < 500:
+                        raise
+                    lastError = e
+                except (URLError, socket.error, httplib.HTTPException, PackageManagerError) as e:
+                    lastError = e
+                # a single write keeps messages of parallel downloads apart
+                sys.stdout.write("download of {0} failed: {1}\n".format(candidate, lastError))
+                self._demoteMirror(candidate)
+            if len(missing) == len(candidates):
+                raise missing[0]
+        raise PackageManagerError("can not download {0}: {1}".format(url, lastError))
+
+    def _read(self, url, headers=None):
+        """ Request url from the fastest mirror having it over a pooled
+        connection and return the data and the headers of the response. The
+        data is read within the mirror failover, so a mirror failing while
+        sending it is replaced by the next one. """
+        def read(candidate):
+            response = self._connections.open(candidate, headers)
+            try:
+                return response.read(), response.info()
+            finally:
+                response.close()
+        return self._withMirrors(url, read)
+
+    def _downloadFile(self, url, destination, executable=False, sha256=None, size=None, missingOk=False,
+            unpackTo=None):
+        """ Download url to destination with _transferFile from the fastest
+        mirror having it and record the download in the run report. Returns
+        the number of bytes transferred and the time it took in seconds, or
+        None if url doesn't exist and missingOk is set.
+
+        """
+        with self.report.phase('download', file=os.path.basename(destination), url=url) as entry:
+            def transfer(candidate):
+                entry['url'] = candidate
+                entry['attempts'] = entry.get('attempts', 0) + 1
+                return self._transferFile(candidate, destination, executable, sha256, size, unpackTo)
+
+            try:
+                result = self._withMirrors(url, transfer)
+            except HTTPError as e:
+                if missingOk and e.code in (403, 404):
+                    entry['missing'] = True
+                    return None
+                raise PackageManagerError("can not download {0}: {1}".format(url, e))
+            entry['bytes'] = result[0]
+        return result
+
+    def _transferFile(self, url, destination, executable, sha256, size, unpackTo):
+        """ Download url to destination in chunks. The data is written to a
+        partial file next to destination which is renamed once the download
+        is complete, so destination never contains a partial file. A partial
+        file left by an interrupted or stalled download is resumed with a
+        range request if the remote file can't have changed unnoticed: if
+        sha256 is given, or with an If-Range request for the ETag or
+        Last-Modified date the partial file was downloaded with. Otherwise
+        it is downloaded from the beginning. If sha256 or size are given the downloaded data is
+        verified against them. If unpackTo is given the data is also extracted
+        as tar archive into this directory while it arrives. Returns the
+        number of bytes transferred and the time it took in seconds; network
+        and HTTP errors are raised as they are.
+
+        """
+        startTime = time.time()
+        partPath = _partPath(destination)
+        validatorPath = _validatorPath(destination)
+        offset = 0
+        validator = None
+        if os.path.isfile(partPath):
+            if os.path.isfile(validatorPath):
+                with open(validatorPath) as f:
+                    validator = f.read().strip() or None
+            if sha256 is not None or validator is not None:
+                offset = os.path.getsize(partPath)
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            if validator is not None:
+                headers['If-Range'] = validator
         try:
-            remote = urlopen(url)
+            remote = self._connections.open(url, headers)
         except HTTPError as e:
-            raise PackageManagerError("can not download {0}: {1}".format(url, e))
+            if e.code != 416:
+                raise
+            # the partial file doesn't fit the remote file any more
+            offset = 0
+            remote = self._connections.open(url)
+        if offset:
+            contentRange = remote.info().getheader('Content-Range') or ''
+            if remote.getcode() != 206 or not contentRange.startswith('bytes {0}-'.format(offset)):
+                # the server doesn't support ranges or the file changed, start from the beginning
+                offset = 0
+        if not offset:
+            # weak ETags can't be used with If-Range
+            etag = remote.info().getheader('ETag')
+            validator = etag and not etag.startswith('W/') and etag or remote.info().getheader('Last-Modified')
+            if validator:
+                with open(validatorPath, 'w') as f:
+                    f.write(validator)
+            elif os.path.isfile(validatorPath):
+                os.remove(validatorPath)
+
+        transferred = 0
+        checksum = hashlib.sha256()
+        extractor = None
         try:
-            with open(destination, 'w') as local:
-                local.write(remote.read())
+            if unpackTo is not None:
+                extractor = _TarStreamExtractor(os.path.basename(destination), unpackTo)
+            if offset:
+                # feed the data downloaded before to checksum and extractor
+                with open(partPath, 'rb') as f:
+                    while True:
+                        chunk = f.read(_downloadChunkSize)
+                        if not chunk:
+                            break
+                        checksum.update(chunk)
+                        if extractor is not None:
+                            extractor.write(chunk)
+            with open(partPath, offset and 'ab' or 'wb') as local:
+                while True:
+                    chunk = remote.read(_downloadChunkSize)
+                    if not chunk:
+                        break
+                    local.write(chunk)
+                    checksum.update(chunk)
+                    if extractor is not None:
+                        extractor.write(chunk)
+                    transferred += len(chunk)
+            try:
+                if size is not None and offset + transferred != size:
+                    raise PackageManagerError("size mismatch for {0}: expected {1} bytes, got {2}" \
+                            .format(url, size, offset + transferred))
+                if sha256 is not None and checksum.hexdigest() != sha256:
+                    raise PackageManagerError("checksum mismatch for {0}: expected {1}, got {2}" \
+                            .format(url, sha256, checksum.hexdigest()))
+                if extractor is not None:
+                    try:
+                        extractor.close()
+                    finally:
+                        extractor = None
+            except:
+                # the data is broken, don't resume from it
+                os.remove(partPath)
+                if os.path.isfile(validatorPath):
+                    os.remove(validatorPath)
+                raise
+            mode = 0644
+            if os.path.isfile(destination):
+                # a replaced file keeps its permissions, like the executable pm.py on selfUpgrade
+                mode = stat.S_IMODE(os.stat(destination).st_mode)
             if executable:
-                st = os.stat(destination)
-                os.chmod(destination, st.st_mode | stat.S_IEXEC)
+                mode |= 0111
+            os.chmod(partPath, mode)
+            os.rename(partPath, destination)
+            if os.path.isfile(validatorPath):
+                os.remove(validatorPath)
+        except PackageError as e:
+            raise PackageManagerError(str(e))
         finally:
             remote.close()
+            if extractor is not None:
+                try:
+                    extractor.close()
+                except PackageError:
+                    pass
+        return transferred, time.time() - startTime
+
+    def _evictSources(self, keep):
+        """ Remove the least recently used files from the sources directory
+        until its size is below the configured limit. Files whose names are in
+        keep are never removed.
+
+        """
+        if not self._sourcesCacheMaxSize:
+            return
+        cachedFiles = []
+        totalSize = 0
+        for fileName in os.listdir(self._sourcesPath):
+            path = os.path.join(self._sourcesPath, fileName)
+            if fileName.startswith('.') or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            totalSize += st.st_size
+            if fileName not in keep:
+                cachedFiles.append((st.st_mtime, st.st_size, fileName))
+        for mtime, fileSize, fileName in sorted(cachedFiles):
+            if totalSize <= self._sourcesCacheMaxSize:
+                break
+            print "evicting {0} from sources cache".format(fileName)
+            os.remove(os.path.join(self._sourcesPath, fileName))
+            totalSize -= fileSize
+
+    def cleanBuildDirectory(self, maxSize=0):
+        """ Remove the least recently used entries of the build directory
+        until its size is at most maxSize bytes. Build trees, their caches and
+        logs are separate entries; the compiler caches are entries too.
+
+        """
+        entries = []
+        totalSize = 0
+        for fileName in os.listdir(self._buildPath):
+            size, mtime = _directoryUsage(os.path.join(self._buildPath, fileName))
+            totalSize += size
+            entries.append((mtime, size, fileName))
+        for mtime, size, fileName in sorted(entries):
+            if totalSize <= maxSize:
+                break
+            print "removing {0} ({1})".format(fileName, _formatSize(size))
+            path = os.path.join(self._buildPath, fileName)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            totalSize -= size
+        print "build directory uses {0}".format(_formatSize(totalSize))
 
     def downloadPackages(self, packages):
+        """ Download the source files and install scripts of packages with
+        self.downloadJobs parallel downloads and print a summary. The mirrors
+        of git packages are fetched. Files
+        already cached with the checksum given in the package configuration
+        are not downloaded again. Afterwards the sources cache is trimmed to
+        its configured size.
+
+        """
+        self._fetchGitPackages(packages)
         sourcesDirURL = urljoin(self.packageRepoURL, _sourcesDir + '/')
         installScriptsDirURL = urljoin(self.packageRepoURL, _installScriptsDir + '/')
+        downloads = []
+        # deltas usable for source files by local path
+        deltas = {}
+        cached = []
+        seen = set()
+        usedSources = set()
         for package in packages:
+            files = []
             # source file
             try:
                 sourceFile = package.sourceFile
-                print "downloading sources of {0}".format(package)
-                sourceFileURL = urljoin(sourcesDirURL, sourceFile)
-                localSourceFilePath = os.path.join(self._sourcesPath, sourceFile)
-                self._downloadFile(sourceFileURL, localSourceFilePath)
+                usedSources.add(sourceFile)
+                unpackTo = None
+                if self.streamExtract:
+                    unpackTo = os.path.join(self._buildPath, package.name)
+                    # an existing tree may be reused by an incremental build
+                    if self.incrementalBuilds and os.path.isdir(unpackTo):
+                        unpackTo = None
+                files.append((urljoin(sourcesDirURL, sourceFile),
+                        os.path.join(self._sourcesPath, sourceFile), False,
+                        package.sourceFileSha256, package.sourceFileSize, False, unpackTo))
+                delta = self._usableDelta(package)
+                if delta is not None:
+                    deltas[os.path.join(self._sourcesPath, sourceFile)] = delta
             except AttributeError:
                 pass
             # install script
             try:
                 installScript = package.installScript
-                print "downloading install script of {0}".format(package)
-                installScriptURL = urljoin(installScriptsDirURL, installScript)
-                localScriptPath = os.path.join(self._installScriptsPath, installScript)
-                self._downloadFile(installScriptURL, localScriptPath, executable=True)
+                files.append((urljoin(installScriptsDirURL, installScript),
+                        os.path.join(self._installScriptsPath, installScript), True,
+                        package.installScriptSha256, package.installScriptSize, False, None))
             except AttributeError:
                 pass
+            for f in files:
+                url, localPath, executable, sha256, size = f[:5]
+                if localPath in seen:
+                    continue
+                seen.add(localPath)
+                if _isCachedFileValid(localPath, sha256, size):
+                    cached.append(localPath)
+                    # mark as recently used for the cache eviction
+                    os.utime(localPath, None)
+                else:
+                    downloads.append(f)
+
+        if cached:
+            print "{0} files are already cached".format(len(cached))
+        if downloads:
+            print "downloading {0} files with up to {1} parallel downloads".format(len(downloads),
+                    self.downloadJobs)
+            rebuilt = set()
+
+            def download(*args):
+                if args[1] in deltas:
+                    result = self._downloadDelta(deltas[args[1]], args[1], args[3], args[4])
+                    if result is not None:
+                        rebuilt.add(args[1])
+                        return result
+                return self._downloadFile(*args)
+
+            startTime = time.time()
+            results = _runParallel(download, downloads, self.downloadJobs)
+            totalTime = time.time() - startTime
+
+            totalBytes = 0
+            nameLen = max(len(os.path.basename(d[1])) for d in downloads)
+            for download, (transferred, seconds) in zip(downloads, results):
+                totalBytes += transferred
+                print ("  {0:<" + str(nameLen) + "}  {1:>10} in {2:6.2f} s ({3}/s){4}").format(
+                        os.path.basename(download[1]), _formatSize(transferred), seconds,
+                        _formatSize(transferred / max(seconds, 1e-6)),
+                        download[1] in rebuilt and " from delta" or "")
+            print "downloaded {0} files, {1} in {2:.2f} s ({3}/s)".format(len(downloads),
+                    _formatSize(totalBytes), totalTime, _formatSize(totalBytes / max(totalTime, 1e-6)))
+            # the installation doesn't need to unpack sources extracted while downloading
+            for download in downloads:
+                unpackTo = download[6]
+                if unpackTo is not None and download[1] not in rebuilt:
+                    with open(_unpackedMarkerPath(self._buildPath, os.path.basename(unpackTo)), 'w') as f:
+                        f.write(os.path.basename(download[1]))
+
+        self._evictSources(usedSources)
+
+    def _gitMirrorPath(self, url):
+        """ The path of the local bare mirror of the git repository url. """
+        name = os.path.basename(url.rstrip('/'))
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        return os.path.join(self._gitPath, '{0}-{1}.git'.format(
+                hashlib.sha256(url.encode('utf-8')).hexdigest()[:16], name))
+
+    def _fetchGitPackages(self, packages):
+        """ Fetch the git packages of packages not fetched by this run yet
+        in parallel. """
+        gitPackages = [(p,) for p in packages if p.packageType == 'git' and p.gitMirror is None]
+        if gitPackages:
+            print "fetching {0} git repositories".format(len(gitPackages))
+            _runParallel(self._fetchGitPackage, gitPackages, self.downloadJobs)
+
+    def _fetchGitPackage(self, package):
+        """ Create or update the local mirror of the git repository of
+        package and resolve its ref, or its already resolved commit, to a
+        commit. Mirrors are updated incrementally and not at all if they have
+        a requested commit id. Returns the commit.
+
+        """
+        if package.gitMirror is not None:
+            # already fetched by this run
+            return package.resolvedCommit
+        mirror = self._gitMirrorPath(package.url)
+        with self._mirrorsLock:
+            lock = self._gitLocks.setdefault(mirror, threading.Lock())
+        target = package.resolvedCommit or package.ref
+        with lock:
+            with self.report.phase('gitFetch', package, url=package.url) as entry:
+                try:
+                    if not os.path.isdir(mirror):
+                        temporary = tempfile.mkdtemp(prefix='.' + os.path.basename(mirror) + '.', dir=self._gitPath)
+                        try:
+                            _git(['clone', '--quiet', '--mirror', package.url, temporary])
+                            os.rename(temporary, mirror)
+                        except:
+                            shutil.rmtree(temporary)
+                            raise
+                        entry['cloned'] = True
+                    elif not (re.match('[0-9a-f]{40}$', target) and self._hasCommit(mirror, target)):
+                        _git(['fetch', '--quiet', '--prune'], gitDir=mirror)
+                        entry['fetched'] = True
+                    commit = _git(['rev-parse', '--verify', '--quiet', target + '^{commit}'], gitDir=mirror)
+                except PackageError as e:
+                    raise PackageManagerError("Can not fetch {0} from {1}: {2}".format(package, package.url, e))
+                entry['commit'] = commit
+        package.gitMirror = mirror
+        package.resolvedCommit = commit
+        return commit
+
+    def _hasCommit(self, mirror, commit):
+        try:
+            _git(['cat-file', '-e', commit + '^{commit}'], gitDir=mirror)
+            return True
+        except PackageError:
+            return False
+
+    def _usableDelta(self, package):
+        """ Return the first delta of package whose base file is in the
+        sources cache with the right checksum, or None. """
+        if not package.sourceFileSha256:
+            return None
+        for delta in package.sourceDeltas:
+            basePath = os.path.join(self._sourcesPath, delta['baseSourceFile'])
+            if _isCachedFileValid(basePath, delta['baseSourceFileSha256'], None):
+                return delta
+        return None
+
+    def _downloadDelta(self, delta, destination, sha256, size):
+        """ Download delta and rebuild the source file destination from it
+        and its cached base file, verified against sha256 and size. Returns
+        the number of bytes transferred and the time it took in seconds, or
+        None if this failed and the file has to be downloaded in full.
+
+        """
+        startTime = time.time()
+        deltaURL = urljoin(urljoin(self.packageRepoURL, _deltasDir + '/'), urllib.quote(delta['deltaFile']))
+        deltaPath = os.path.join(self._deltasPath, delta['deltaFile'])
+        partPath = _partPath(destination)
+        try:
+            transferred = self._downloadFile(deltaURL, deltaPath, sha256=delta.get('deltaSha256'),
+                    size=delta.get('deltaSize'))[0]
+            with self.report.phase('applyDelta', file=os.path.basename(destination)) as entry:
+                _applyDelta(os.path.join(self._sourcesPath, delta['baseSourceFile']), deltaPath, partPath)
+                entry['bytes'] = os.path.getsize(partPath)
+            if (size is not None and os.path.getsize(partPath) != size) or _sha256File(partPath) != sha256:
+                raise PackageError("the rebuilt file doesn't match its checksum")
+            os.chmod(partPath, 0644)
+            os.rename(partPath, destination)
+        except (PackageError, PackageManagerError, EnvironmentError) as e:
+            sys.stdout.write("can't use delta for {0}, downloading it in full: {1}\n".format(
+                    os.path.basename(destination), e))
+            # the full download must not resume from the rebuilt data
+            if os.path.isfile(partPath):
+                os.remove(partPath)
+            return None
+        finally:
+            if os.path.isfile(deltaPath):
+                os.remove(deltaPath)
+        return transferred, time.time() - startTime
+
+    def _readRepositoryState(self):
+        """ Return the state of the last repository index update. """
+        try:
+            with open(os.path.join(self._basePath, _repositoryStateFile)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _applyRepositoryIndex(self, packageConfigs, knownEntries):
+        """ Bring the available packages directory in line with the package
+        configs of a repository index. knownEntries maps the config file names
+        written by the last update to their checksum, only added, changed or
+        removed configs are written. Returns the new entries.
+
+        """
+        entries = {}
+        added = changed = removed = 0
+        for packageConfigFile, config in packageConfigs.iteritems():
+            checksum = hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()
+            entries[packageConfigFile] = checksum
+            localFile = os.path.join(self._availablePackagesPath, packageConfigFile)
+            if knownEntries.get(packageConfigFile) == checksum and os.path.isfile(localFile):
+                continue
+            if os.path.isfile(localFile):
+                changed += 1
+            else:
+                added += 1
+            _writeJson(config, localFile)
+        for packageConfigFile in os.listdir(self._availablePackagesPath):
+            if packageConfigFile not in entries and not packageConfigFile.startswith('.'):
+                os.remove(os.path.join(self._availablePackagesPath, packageConfigFile))
+                removed += 1
+        print "{0} packages added, {1} changed, {2} removed".format(added, changed, removed)
+        return entries
+
+    def _updateFromRepositoryIndex(self):
+        """ Update the available packages from the repository index. The
+        compressed index is preferred and conditional requests are used, so
+        an unchanged repository costs a single request. Returns False if the
+        repository doesn't provide an index.
+
+        """
+        state = self._readRepositoryState()
+        localFiles = set(f for f in os.listdir(self._availablePackagesPath) if not f.startswith('.'))
+        localStateValid = localFiles == set(state.get('entries', {}))
+        for indexFile in [_repositoryIndexFile + '.gz', _repositoryIndexFile]:
+            indexURL = urljoin(self.packageRepoURL, indexFile)
+            headers = {}
+            if localStateValid and state.get('url') == indexURL:
+                if state.get('etag'):
+                    headers['If-None-Match'] = state['etag']
+                if state.get('lastModified'):
+                    headers['If-Modified-Since'] = state['lastModified']
+            error = None
+            with self.report.phase('download', file=indexFile, url=indexURL) as entry:
+                try:
+                    data, headers = self._read(indexURL, headers)
+                    entry['bytes'] = len(data)
+                except HTTPError as e:
+                    entry['status'] = e.code
+                    error = e
+            if error is not None:
+                if error.code == 304:
+                    print "Available packages are up to date"
+                    return True
+                elif error.code in (403, 404):
+                    continue
+                raise PackageManagerError("can not download {0}: {1}".format(indexURL, error))
+            if indexFile.endswith('.gz'):
+                data = gzip.GzipFile(fileobj=StringIO(data)).read()
+            try:
+                packageConfigs = json.loads(data)['packages']
+            except (ValueError, KeyError) as e:
+                raise PackageManagerError("invalid repository index {0}: {1}".format(indexURL, e))
+            entries = self._applyRepositoryIndex(packageConfigs, state.get('entries', {}))
+            _writeJson({'url': indexURL,
+                    'etag': headers.getheader('ETag'),
+                    'lastModified': headers.getheader('Last-Modified'),
+                    'entries': entries},
+                    os.path.join(self._basePath, _repositoryStateFile))
+            return True
+        return False
+
+    def _updateFromDirectoryListing(self):
+        """ Update the available packages by downloading every package config
+        found in the HTML directory listing of the repository. This is the
+        fallback for repositories without an index.
+
+        """
+        availablePackagesURL = urljoin(self.packageRepoURL, _availablePackagesDir + '/')
+        availablePackagesHTML = self._read(availablePackagesURL)[0].decode('utf-8')
+        packageFileList = set(re.findall('href="([^"]+\.json)"', availablePackagesHTML))
+        downloads = [(urljoin(availablePackagesURL, packageFileName),
+                os.path.join(self._availablePackagesPath, packageFileName))
+                for packageFileName in packageFileList]
+        _runParallel(self._downloadFile, downloads, self.downloadJobs)
+        # delete packages which are no longer available
+        for packageFileName in os.listdir(self._availablePackagesPath):
+            if packageFileName not in packageFileList and not packageFileName.startswith('.'):
+                os.remove(os.path.join(self._availablePackagesPath, packageFileName))
+        # the local state doesn't correspond to a repository index any more
+        repositoryStateFile = os.path.join(self._basePath, _repositoryStateFile)
+        if os.path.isfile(repositoryStateFile):
+            os.remove(repositoryStateFile)
 
     def updateAvailablePackages(self):
         print "Updating available packages repository"
-        availablePackagesURL = urljoin(self.packageRepoURL, _availablePackagesDir + '/')
-        availablePackagesPath = urlopen(availablePackagesURL)
-        availablePackagesHTML = availablePackagesPath.read().decode('utf-8')
-        packageFileList = re.findall('href="([^"]+\.json)"', availablePackagesHTML)
-        # delete current availalable packages
-        if os.path.isdir(self._availablePackagesPath):
-            shutil.rmtree(self._availablePackagesPath)
-        os.makedirs(self._availablePackagesPath)
-        for packageFileName in packageFileList:
-            packageFileURL = urljoin(availablePackagesURL, packageFileName)
-            localFile = os.path.join(self._availablePackagesPath, packageFileName)
-            self._downloadFile(packageFileURL, localFile)
+        with self.report.phase('updateAvailablePackages'):
+            if not self._updateFromRepositoryIndex():
+                print "No repository index found, reading the package directory listing"
+                self._updateFromDirectoryListing()
+        # read the updated configs on next access
+        self._availablePackageVersionsCache = None
+        self._availablePackagesCache = None
 
         print "Checking for new version of package manager"
         remoteInitFileURL = urljoin(self.packageRepoURL, _pmDir + '/__init__.py')
-        remoteInitFilePath = urlopen(remoteInitFileURL)
-        remoteInitFile = remoteInitFilePath.read().decode('utf-8')
+        remoteInitFile = self._read(remoteInitFileURL)[0].decode('utf-8')
         remoteMetadata = dict(re.findall("__([a-z]+)__ = '([^']+)'", remoteInitFile))
         remoteVersion = Version(remoteMetadata['version'])
         localVersion = Version(_metadata['version'])
@@ -379,41 +3890,66 @@ class PackageManager(object):
             print "Most recent version installed"
 
     def upgradeInstalledPackages(self):
-        packagesToUpgrade = []
+        installedNames = []
         for installedPackage in self._installedPackages.values():
-            try:
-                availablePackage = self._availablePackages[installedPackage.name]
-            except KeyError:
+            if installedPackage.name not in self._availablePackages:
                 print "{0} is deprecated, not upgrading it".format(installedPackage.name)
                 continue
-            if availablePackage.version > installedPackage.version:
-                packagesToUpgrade.append(installedPackage)
-        # reinstall installed packages that depend on the packages to be upgraded
-        packagesToReinstall = []
-        for package in packagesToUpgrade:
-            packagesToReinstall += self._getInstalledDependings(package)
-        # filter out duplicates
-        packageNamesToReinstall = []
-        for p in reversed(packagesToUpgrade + packagesToReinstall):
-            if p.name not in packageNamesToReinstall:
-                packageNamesToReinstall = [p.name] + packageNamesToReinstall
-        # reverse package list to update deepest dependency first and reinstall depending packages afterwards
-        packageNamesToReinstall.reverse()
-        # install them
-        self.installPackages(packageNamesToReinstall, upgrade=True)
+            installedNames.append(installedPackage.name)
+        with self.report.phase('planUpgrade', profile=True) as entry:
+            # the newest versions satisfying the constraints of all installed packages
+            resolved = self._resolveVersions([(name, None) for name in installedNames], respectInstalled=True)
+            packagesToUpgrade = []
+            for name in installedNames:
+                if resolved[name].version > self._installedPackages[name].version:
+                    packagesToUpgrade.append(self._installedPackages[name])
+            # git packages of the same version are upgraded if their ref moved
+            gitPackages = [resolved[name] for name in installedNames if resolved[name].packageType == 'git' \
+                    and resolved[name].version == self._installedPackages[name].version]
+            self._fetchGitPackages(gitPackages)
+            for p in gitPackages:
+                installedCommit = self._installedPackages[p.name].resolvedCommit
+                if p.resolvedCommit != installedCommit:
+                    print "{0} moved from commit {1} to {2}".format(p, (installedCommit or 'unknown')[:12],
+                            p.resolvedCommit[:12])
+                    packagesToUpgrade.append(self._installedPackages[p.name])
+            # reinstall installed packages that depend on the packages to be upgraded
+            installedGraph = DependencyGraph(self._installedPackages, ignoreMissing=True)
+            packagesToReinstall = installedGraph.dependings([p.name for p in packagesToUpgrade])
+            reinstallNames = set(p.name for p in packagesToUpgrade + packagesToReinstall)
+            # install the resolved versions, with new dependencies, in dependency order
+            packagesToInstall = [p for p in DependencyGraph(resolved).dependencies(installedNames) \
+                    if p.name in reinstallNames or p.name not in self._installedPackages]
+            entry['packages'] = len(packagesToInstall)
+        self._installPlan(packagesToInstall, resolved)
+
+    def serveRepository(self, port=_defaultServePort, address=''):
+        """ Serve the package manager directory as package repository on
+        port until interrupted. """
+        server = _ThreadingHTTPServer((address, port), _RepositoryRequestHandler)
+        server.proxy = RepositoryProxy(self)
+        # a report keeping every proxied download would grow without bound
+        self.report = RunReport(keepPhases=False)
+        print "Serving {0} as package repository on port {1}, upstream {2}".format(self._basePath,
+                server.server_address[1], self.packageRepoURL)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
 
     def selfUpgrade(self):
         print "Downloading package manager from server"
         pmFilesURL = urljoin(self.packageRepoURL, _pmDir + '/')
-        pmFileListPath = urlopen(pmFilesURL)
-        pmFileListHTML = pmFileListPath.read().decode('utf-8')
+        pmFileListHTML = self._read(pmFilesURL)[0].decode('utf-8')
         pmFileList = re.findall('href="([^"]+\.py)"', pmFileListHTML)
         pmFileList += ['README.md', 'LICENSE']
         for pmFileName in pmFileList:
             print "downloading {0}".format(pmFileName)
             pmFileURL = urljoin(pmFilesURL, pmFileName)
             localFile = os.path.join(_localPMDirPath, pmFileName)
-            self._downloadFile(pmFileURL, localFile)
+            self._downloadFile(pmFileURL, localFile, executable=pmFileName.endswith('.py'))
 
 def main():
     # define supported commands
@@ -422,9 +3958,21 @@ def main():
             ('update', 'update the available package list'),
             ('upgrade', 'update all installed packages to the available version'),
             ('selfUpgrade', 'update the package manager to the available version'),
+            ('makeIndex', 'write the repository index of the given repository directory'),
+            ('makeDeltas', 'write deltas between source versions of the given repository directory'),
+            ('serve', 'serve the package manager directory as caching repository on the given port'),
             ('listInstalled', 'list all installed packages with their version'),
             ('listAvailable', 'list all available packages with their version'),
             ('search', 'search for a given list of packages'),
+            ('uninstall', 'uninstall the provided list of packages'),
+            ('lock', 'write the resolved plan of the given packages to the given lockfile'),
+            ('apply', 'install the packages of the given lockfile as locked'),
+            ('owner', 'show which installed packages own the given files'),
+            ('listFiles', 'list the files installed by the given packages'),
+            ('clean', 'clean the build directory down to the given size in MB (default 0)'),
+            ('listGenerations', 'list the profile generations of the install store'),
+            ('rollback', 'switch the install prefix to the given or the previous generation'),
+            ('gc', 'remove all but the given number of newest generations and unused store entries'),
             ('listCommands', 'list the possible commands and exit'),
             ('help', 'show this help message and exit'),
     ]
@@ -445,6 +3993,25 @@ def main():
             help="reinstall the package if it is already installed.")
     optParser.add_option('--reinstall-deps', dest='reinstallDeps', action='store_true', default=False, \
             help="also reinstall already installed dependencies.")
+    optParser.add_option('--download-jobs', '--jobs', dest='downloadJobs', type='int', \
+            default=_defaultDownloadJobs, metavar='JOBS', \
+            help="number of parallel downloads (default %default, --jobs is deprecated)")
+    optParser.add_option('-j', '--build-jobs', dest='buildJobs', type='int', default=_defaultBuildJobs, \
+            help="number of packages to install in parallel (default %default)")
+    optParser.add_option('-y', '--yes', dest='yes', action='store_true', default=False, \
+            help="don't ask for confirmation")
+    optParser.add_option('--regex', dest='regex', action='store_true', default=False, \
+            help="search queries are regular expressions")
+    optParser.add_option('--stream-extract', dest='streamExtract', action='store_true', default=False, \
+            help="unpack source archives while they are downloaded")
+    optParser.add_option('--incremental', dest='incremental', action='store_true', default=False, \
+            help="keep build trees of unchanged sources and expose build caches to install scripts")
+    optParser.add_option('--bind', dest='bind', default='', metavar='ADDRESS', \
+            help="address serve listens on (default all addresses)")
+    optParser.add_option('--report', dest='report', metavar='FILE', \
+            help="write timings, transferred bytes and memory use of every phase as JSON to FILE")
+    optParser.add_option('--profile', dest='profile', metavar='FILE', \
+            help="write cProfile statistics of the dependency planning to FILE")
     (opts, args) = optParser.parse_args()
 
     if opts.printVersion:
@@ -457,6 +4024,16 @@ def main():
     except IndexError:
         optParser.error("No command specified")
 
+    if command in ('makeIndex', 'makeDeltas'):
+        # runs on the repository server and doesn't need a config
+        if len(packages) != 1:
+            optParser.error("{0} needs exactly one repository directory".format(command))
+        if command == 'makeIndex':
+            print "Indexed {0} packages".format(writeRepositoryIndex(packages[0]))
+        else:
+            print "Wrote {0} deltas".format(writeSourceDeltas(packages[0]))
+        sys.exit(0)
+
     # read config
     configFile = os.path.expanduser(opts.config)
     if not os.path.isfile(configFile):
@@ -469,44 +4046,125 @@ def main():
     with open(configFile) as f:
         pmConfig = json.load(f)
 
+    if opts.downloadJobs < 1:
+        optParser.error("--download-jobs must be at least 1")
+    if opts.buildJobs < 1:
+        optParser.error("--build-jobs must be at least 1")
+
     pm = PackageManager(pmConfig)
+    pm.report = RunReport(profile=bool(opts.profile))
+    pm.downloadJobs = opts.downloadJobs
+    pm.buildJobs = opts.buildJobs
+    pm.streamExtract = opts.streamExtract
+    pm.assumeYes = opts.yes
+    if opts.incremental:
+        pm.incrementalBuilds = True
 
-    if command == 'install':
-        if packages:
+    try:
+        if command == 'install':
+            if packages:
+                try:
+                    pm.installPackages(packages, reinstall=opts.reinstall,
+                            reinstallDependencies=opts.reinstallDeps)
+                except PackageManagerError as e:
+                    print >> sys.stderr, e
+                    sys.exit(-1)
+            else:
+                optParser.error("No packages to install provided")
+        elif command == 'update':
+            pm.updateAvailablePackages()
+        elif command == 'upgrade':
             try:
-                pm.installPackages(packages, reinstall=opts.reinstall,
-                        reinstallDependencies=opts.reinstallDeps)
+                pm.upgradeInstalledPackages()
             except PackageManagerError as e:
                 print >> sys.stderr, e
                 sys.exit(-1)
-        else:
-            optParser.error("No packages to install provided")
-    elif command == 'update':
-        pm.updateAvailablePackages()
-    elif command == 'upgrade':
-        pm.upgradeInstalledPackages()
-    elif command == 'selfUpgrade':
-        pm.selfUpgrade()
-    elif command == 'listInstalled':
-        pm.printInstalledPackages()
-    elif command == 'listAvailable':
-        pm.printAvailablePackages()
-    elif command == 'search':
-        if packages:
+        elif command == 'selfUpgrade':
+            pm.selfUpgrade()
+        elif command == 'serve':
+            if len(packages) > 1:
+                optParser.error("serve takes at most one port")
             try:
-                pm.searchPackages(packages)
+                port = int(packages[0]) if packages else _defaultServePort
+            except ValueError:
+                optParser.error("Invalid port for serve: {0}".format(packages[0]))
+            pm.serveRepository(port, opts.bind)
+        elif command == 'listInstalled':
+            pm.printInstalledPackages()
+        elif command == 'listAvailable':
+            pm.printAvailablePackages()
+        elif command == 'search':
+            if packages:
+                try:
+                    pm.searchPackages(packages, regex=opts.regex)
+                except PackageManagerError as e:
+                    print >> sys.stderr, e
+                    sys.exit(-1)
+            else:
+                optParser.error("No packages to search for provided")
+        elif command in ('uninstall', 'owner', 'listFiles'):
+            if not packages:
+                optParser.error("No arguments for {0} provided".format(command))
+            try:
+                if command == 'uninstall':
+                    pm.uninstallPackages(packages)
+                elif command == 'owner':
+                    pm.printOwners(packages)
+                else:
+                    pm.printFiles(packages)
+            except PackageManagerError as e:
+                print >> sys.stderr, e
+                sys.exit(-1)
+        elif command in ('lock', 'apply'):
+            if not packages or (command == 'lock' and len(packages) < 2) \
+                    or (command == 'apply' and len(packages) > 1):
+                optParser.error("Usage: {0}".format(command == 'lock' and "lock <lockfile> package [package] ..."
+                        or "apply <lockfile>"))
+            try:
+                if command == 'lock':
+                    pm.writeLockfile(packages[0], packages[1:])
+                else:
+                    pm.applyLockfile(packages[0])
             except PackageManagerError as e:
                 print >> sys.stderr, e
                 sys.exit(-1)
+        elif command == 'clean':
+            if len(packages) > 1:
+                optParser.error("clean takes at most one size in MB")
+            try:
+                maxSizeMB = float(packages[0]) if packages else 0
+            except ValueError:
+                optParser.error("Invalid size for clean: {0}".format(packages[0]))
+            pm.cleanBuildDirectory(int(maxSizeMB * 1024 * 1024))
+        elif command in ('listGenerations', 'rollback', 'gc'):
+            if len(packages) > 1 or (command == 'listGenerations' and packages):
+                optParser.error("Too many arguments for {0}".format(command))
+            try:
+                number = int(packages[0]) if packages else None
+            except ValueError:
+                optParser.error("Invalid number for {0}: {1}".format(command, packages[0]))
+            try:
+                if command == 'listGenerations':
+                    pm.printGenerations()
+                elif command == 'rollback':
+                    pm.rollback(number)
+                else:
+                    pm.collectGarbage(number)
+            except PackageManagerError as e:
+                print >> sys.stderr, e
+                sys.exit(-1)
+        elif command == 'help':
+            optParser.print_help()
+        elif command == 'listCommands':
+            print ' '.join((c[0] for c in supportedCommands))
+
         else:
-            optParser.error("No packages to search for provided")
-    elif command == 'help':
-        optParser.print_help()
-    elif command == 'listCommands':
-        print ' '.join((c[0] for c in supportedCommands))
-
-    else:
-        optParser.error("Unsupported command: {0}".format(command))
+            optParser.error("Unsupported command: {0}".format(command))
+    finally:
+        if opts.report:
+            pm.report.write(opts.report, command, packages)
+        if opts.profile and not pm.report.writeProfile(opts.profile):
+            print >> sys.stderr, "Nothing was planned, no profile written"
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,62 @@
+""" A local HTTP server for the repositories of the tests. """
+
+import email.utils
+import os
+import posixpath
+import re
+import threading
+import urllib
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+
+class _RequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """ Serve the files below the root of the server with 'bytes=start-'
+    ranges and If-Range dates. """
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split('?', 1)[0]))
+        return os.path.join(self.server.root, *[p for p in path.split('/') if p and p not in ('.', '..')])
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        match = re.match(r'bytes=(\d+)-$', self.headers.getheader('Range') or '')
+        if match is None or not os.path.isfile(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        lastModified = email.utils.formatdate(int(os.path.getmtime(path)), usegmt=True)
+        ifRange = self.headers.getheader('If-Range')
+        if ifRange is not None and ifRange != lastModified:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        start = int(match.group(1))
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, size - 1, size))
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Last-Modified', lastModified)
+        self.end_headers()
+        return f
+
+    def log_message(self, format, *args):
+        self.server.requests.append(self.requestline)
+
+
+class RepositoryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server for the files below root on a free local port. The
+    request lines are recorded in requests. """
+    daemon_threads = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _RequestHandler)
+        self.root = root
+        self.requests = []
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,252 @@
+""" Tests of the source file deltas, written by writeSourceDeltas on the
+repository server and used by the client to rebuild new source files. """
+
+import gzip
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pm
+from server import RepositoryServer
+
+
+def _randomData(size, seed):
+    generator = random.Random(seed)
+    return ''.join(chr(generator.randrange(256)) for _ in xrange(size))
+
+
+def _records(deltaPath):
+    """ Return the (type, length) of the records of the delta at deltaPath. """
+    records = []
+    delta = gzip.open(deltaPath, 'rb')
+    try:
+        assert delta.read(len(pm._deltaMagic)) == pm._deltaMagic
+        while True:
+            record = delta.read(1)
+            if record == 'E':
+                return records
+            elif record == 'C':
+                records.append(('C', struct.unpack('>QI', delta.read(12))[1]))
+            else:
+                length = struct.unpack('>I', delta.read(4))[0]
+                delta.read(length)
+                records.append(('L', length))
+    finally:
+        delta.close()
+
+
+class DeltaFormatTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._windowSize = pm._deltaWindowSize
+
+    def tearDown(self):
+        pm._deltaWindowSize = self._windowSize
+        shutil.rmtree(self._path)
+
+    def _roundTrip(self, base, new):
+        """ Write a delta from base to new, check that applying it gives new
+        and return the path of the delta. """
+        basePath, newPath = os.path.join(self._path, 'base'), os.path.join(self._path, 'new')
+        deltaPath, outPath = os.path.join(self._path, 'delta'), os.path.join(self._path, 'out')
+        with open(basePath, 'wb') as f:
+            f.write(base)
+        with open(newPath, 'wb') as f:
+            f.write(new)
+        self.assertEqual(pm._writeDelta(basePath, newPath, deltaPath), os.path.getsize(deltaPath))
+        pm._applyDelta(basePath, deltaPath, outPath)
+        with open(outPath, 'rb') as f:
+            self.assertEqual(f.read(), new)
+        return deltaPath
+
+    def testRoundTrip(self):
+        base = _randomData(100000, 1)
+        # moved, inserted, removed and appended data at offsets not aligned to blocks
+        new = base[50000:70001] + 'inserted' + base[:30000] + base[30123:50000] + base[70001:] + 'end'
+        deltaPath = self._roundTrip(base, new)
+        # only the data around the changes, up to a block each, is literal
+        self.assertLess(os.path.getsize(deltaPath), len(new) // 10)
+        self.assertEqual(set(r[0] for r in _records(deltaPath)), set(['C', 'L']))
+
+    def testShortFiles(self):
+        self._roundTrip('', 'new')
+        self._roundTrip('base', '')
+        self._roundTrip('same', 'same')
+
+    def testLiteralWindow(self):
+        pm._deltaWindowSize = 4096
+        base = _randomData(10000, 1)
+        # literal data longer than the window is written in parts
+        new = base[:5000] + _randomData(20000, 2) + base[5000:]
+        records = _records(self._roundTrip(base, new))
+        literals = [length for record, length in records if record == 'L']
+        self.assertTrue(20000 <= sum(literals) < len(new))
+        self.assertTrue(len(literals) > 20000 // 4096)
+        self.assertTrue(max(literals) <= 4096)
+
+    def testBrokenDelta(self):
+        deltaPath = self._roundTrip('base', 'new data')
+        delta = gzip.open(deltaPath, 'wb')
+        delta.write(pm._deltaMagic + 'C' + struct.pack('>QI', 0, 100) + 'E')
+        delta.close()
+        self.assertRaises(pm.PackageError, pm._applyDelta, os.path.join(self._path, 'base'), deltaPath,
+                os.path.join(self._path, 'out'))
+
+
+class SourceDeltasTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._repositoryPath = os.path.join(self._path, 'repository')
+        for d in (pm._availablePackagesDir, pm._sourcesDir, pm._installScriptsDir, pm._pmDir):
+            os.makedirs(os.path.join(self._repositoryPath, d))
+        shutil.copy(pm._initFilePath, os.path.join(self._repositoryPath, pm._pmDir))
+        with open(os.path.join(self._repositoryPath, pm._installScriptsDir, 'a.sh'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        self._base = _randomData(50000, 1)
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+        shutil.rmtree(self._path)
+
+    def _package(self, version, data):
+        sourceFile = 'a-{0}.tar.gz'.format(version)
+        with open(os.path.join(self._repositoryPath, pm._sourcesDir, sourceFile), 'wb') as f:
+            f.write(data)
+        pm._writeJson({'name': 'a', 'version': version, 'type': 'archive', 'sourceFile': sourceFile,
+                'installScript': 'a.sh', 'dependencies': []}, self._configPath(version))
+
+    def _configPath(self, version):
+        return os.path.join(self._repositoryPath, pm._availablePackagesDir, 'a-{0}.json'.format(version))
+
+    def _config(self, version):
+        with open(self._configPath(version)) as f:
+            return json.load(f)
+
+    def _rejected(self):
+        with open(os.path.join(self._repositoryPath, pm._deltasDir, pm._rejectedDeltasFile)) as f:
+            return json.load(f)
+
+    def testWriteDeltas(self):
+        self._package('1.0', self._base)
+        self._package('2.0', self._base[:20000] + 'changed' + self._base[20000:])
+        self.assertEqual(pm.writeSourceDeltas(self._repositoryPath), 1)
+        delta = self._config('2.0')['sourceDeltas'][0]
+        self.assertEqual(delta['baseSourceFile'], 'a-1.0.tar.gz')
+        self.assertEqual(delta['deltaSha256'], pm._sha256File(
+                os.path.join(self._repositoryPath, pm._deltasDir, delta['deltaFile'])))
+        self.assertTrue(self._config('2.0')['sourceFileSha256'])
+        # existing deltas aren't written again
+        self.assertEqual(pm.writeSourceDeltas(self._repositoryPath), 0)
+
+    def testRejectedDeltas(self):
+        self._package('1.0', self._base)
+        self._package('2.0', _randomData(50000, 2))
+        writeDelta = pm._writeDelta
+        written = []
+
+        def countingWriteDelta(*args):
+            written.append(args)
+            return writeDelta(*args)
+        pm._writeDelta = countingWriteDelta
+        try:
+            self.assertEqual(pm.writeSourceDeltas(self._repositoryPath), 0)
+            self.assertEqual(len(written), 1)
+            self.assertEqual(len(self._rejected()), 1)
+            self.assertEqual(os.listdir(os.path.join(self._repositoryPath, pm._deltasDir)),
+                    [pm._rejectedDeltasFile])
+            self.assertNotIn('sourceDeltas', self._config('2.0'))
+            # the rejected pair isn't tried again
+            self.assertEqual(pm.writeSourceDeltas(self._repositoryPath), 0)
+            self.assertEqual(len(written), 1)
+            # but a changed source file is
+            self._package('2.0', self._base + 'appended')
+            self.assertEqual(pm.writeSourceDeltas(self._repositoryPath), 1)
+            self.assertEqual(len(written), 2)
+        finally:
+            pm._writeDelta = writeDelta
+
+
+class DeltaDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._repositoryPath = os.path.join(self._path, 'repository')
+        for d in (pm._availablePackagesDir, pm._sourcesDir, pm._installScriptsDir, pm._pmDir):
+            os.makedirs(os.path.join(self._repositoryPath, d))
+        shutil.copy(pm._initFilePath, os.path.join(self._repositoryPath, pm._pmDir))
+        with open(os.path.join(self._repositoryPath, pm._installScriptsDir, 'a.sh'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        self._base = _randomData(50000, 1)
+        self._new = self._base[:20000] + 'changed' + self._base[20000:]
+        for version, data in (('1.0', self._base), ('2.0', self._new)):
+            sourceFile = 'a-{0}.tar.gz'.format(version)
+            with open(os.path.join(self._repositoryPath, pm._sourcesDir, sourceFile), 'wb') as f:
+                f.write(data)
+            pm._writeJson({'name': 'a', 'version': version, 'type': 'archive', 'sourceFile': sourceFile,
+                    'installScript': 'a.sh', 'dependencies': []},
+                    os.path.join(self._repositoryPath, pm._availablePackagesDir, 'a-{0}.json'.format(version)))
+        pm.writeRepositoryIndex(self._repositoryPath)
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        pm.writeSourceDeltas(self._repositoryPath)
+        self._server = RepositoryServer(self._repositoryPath)
+        # the client has the source file of the old version cached
+        sourcesPath = os.path.join(self._path, 'pm', pm._sourcesDir)
+        os.makedirs(sourcesPath)
+        shutil.copy(os.path.join(self._repositoryPath, pm._sourcesDir, 'a-1.0.tar.gz'), sourcesPath)
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+        self._server.stop()
+        shutil.rmtree(self._path)
+
+    def _download(self):
+        """ Download the sources of the newest version of a and return its
+        source file and the paths requested from the server. """
+        packageManager = pm.PackageManager({'packageManagerDir': os.path.join(self._path, 'pm'),
+                'packageRepositoryURL': self._server.url, 'installationEnvironmentVariables': {}})
+        packageManager.updateAvailablePackages()
+        del self._server.requests[:]
+        packageManager.downloadPackages([packageManager._availablePackages['a']])
+        with open(os.path.join(self._path, 'pm', pm._sourcesDir, 'a-2.0.tar.gz'), 'rb') as f:
+            return f.read(), [r.split()[1] for r in self._server.requests]
+
+    def testDelta(self):
+        data, requests = self._download()
+        self.assertEqual(data, self._new)
+        self.assertIn('/deltas/a-1.0.tar.gz--a-2.0.tar.gz.delta', requests)
+        self.assertNotIn('/sources/a-2.0.tar.gz', requests)
+
+    def testBadDeltaFallback(self):
+        # a delta which is intact but rebuilds another file than the one expected
+        configPath = os.path.join(self._repositoryPath, pm._availablePackagesDir, 'a-2.0.json')
+        with open(configPath) as f:
+            config = json.load(f)
+        delta = config['sourceDeltas'][0]
+        otherPath = os.path.join(self._path, 'other')
+        with open(otherPath, 'wb') as f:
+            f.write(self._base + 'other')
+        deltaPath = os.path.join(self._repositoryPath, pm._deltasDir, delta['deltaFile'])
+        delta['deltaSize'] = pm._writeDelta(os.path.join(self._repositoryPath, pm._sourcesDir, 'a-1.0.tar.gz'),
+                otherPath, deltaPath)
+        delta['deltaSha256'] = pm._sha256File(deltaPath)
+        pm._writeJson(config, configPath)
+        pm.writeRepositoryIndex(self._repositoryPath)
+        data, requests = self._download()
+        self.assertEqual(data, self._new)
+        self.assertIn('/deltas/a-1.0.tar.gz--a-2.0.tar.gz.delta', requests)
+        self.assertIn('/sources/a-2.0.tar.gz', requests)
+        self.assertFalse(os.path.exists(os.path.join(self._path, 'pm', pm._deltasDir, delta['deltaFile'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
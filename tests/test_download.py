@@ -0,0 +1,114 @@
+""" Tests of resumed downloads and file:// repositories. """
+
+import email.utils
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pm
+from server import RepositoryServer
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._remotePath = os.path.join(self._path, 'repository')
+        os.makedirs(self._remotePath)
+        self._server = RepositoryServer(self._remotePath)
+        self._pm = pm.PackageManager({'packageManagerDir': os.path.join(self._path, 'pm'),
+                'packageRepositoryURL': self._server.url, 'installationEnvironmentVariables': {}})
+        self._destination = os.path.join(self._path, 'pm', 'file')
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+        self._server.stop()
+        shutil.rmtree(self._path)
+
+    def _remoteFile(self, data, mtime=None):
+        path = os.path.join(self._remotePath, 'file')
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _partFile(self, data, validator=None):
+        with open(pm._partPath(self._destination), 'wb') as f:
+            f.write(data)
+        if validator is not None:
+            with open(pm._validatorPath(self._destination), 'w') as f:
+                f.write(validator)
+
+    def _download(self, sha256=None):
+        self._pm._downloadFile(self._server.url + 'file', self._destination, sha256=sha256)
+        with open(self._destination, 'rb') as f:
+            return f.read()
+
+    def testResumeWithChecksum(self):
+        self._remoteFile('0123456789')
+        self._partFile('01234')
+        self.assertEqual(self._download(hashlib.sha256('0123456789').hexdigest()), '0123456789')
+        self.assertEqual(self._pm.report.phases[-1]['bytes'], 5)
+        self.assertFalse(os.path.exists(pm._partPath(self._destination)))
+
+    def testStalePartFileWithoutChecksum(self):
+        # without checksum or validator the partial data can't be trusted
+        self._remoteFile('new content')
+        self._partFile('old')
+        self.assertEqual(self._download(), 'new content')
+
+    def testIfRange(self):
+        self._remoteFile('0123456789', 1000000000)
+        self._partFile('01234', email.utils.formatdate(1000000000, usegmt=True))
+        self.assertEqual(self._download(), '0123456789')
+        self.assertEqual(self._pm.report.phases[-1]['bytes'], 5)
+        self.assertFalse(os.path.exists(pm._validatorPath(self._destination)))
+
+    def testIfRangeChangedFile(self):
+        self._remoteFile('abcdefghij', 1000000000)
+        self._partFile('01234', email.utils.formatdate(900000000, usegmt=True))
+        self.assertEqual(self._download(), 'abcdefghij')
+        self.assertEqual(self._pm.report.phases[-1]['bytes'], 10)
+
+
+class FileURLTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._remotePath = os.path.join(self._path, 'repository')
+        os.makedirs(self._remotePath)
+        self._pm = pm.PackageManager({'packageManagerDir': os.path.join(self._path, 'pm'),
+                'packageRepositoryURL': 'file://' + self._remotePath + '/',
+                'installationEnvironmentVariables': {}})
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+        shutil.rmtree(self._path)
+
+    def testDownload(self):
+        with open(os.path.join(self._remotePath, 'file'), 'wb') as f:
+            f.write('content')
+        destination = os.path.join(self._path, 'pm', 'file')
+        self._pm._downloadFile('file://' + self._remotePath + '/file', destination)
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), 'content')
+
+    def testMissingFile(self):
+        # a missing local file is missing like a 404, not retried as a failing mirror
+        try:
+            self._pm._read('file://' + self._remotePath + '/missing')
+            self.fail()
+        except pm.HTTPError as e:
+            self.assertEqual(e.code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
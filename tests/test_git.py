@@ -0,0 +1,164 @@
+""" Tests of git packages, installed from local file:// repositories with
+the install scripts served by a local HTTP server. """
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pm
+from server import RepositoryServer
+
+
+def _hasGit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['git', '--version'], stdout=devnull)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+_installScript = """#!/bin/sh
+set -e
+mkdir -p $DESTDIR$LPM_INSTALL_PREFIX/share
+cp e/file.txt $DESTDIR$LPM_INSTALL_PREFIX/share/e.txt
+echo built >> e/untracked.o
+"""
+
+
+@unittest.skipUnless(_hasGit(), "git is not installed")
+class GitPackageTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._sourcePath = os.path.join(self._path, 'e')
+        os.mkdir(self._sourcePath)
+        self._git('init', '--quiet')
+        self._git('config', 'user.email', 'test@example.com')
+        self._git('config', 'user.name', 'test')
+        self._head = self._commit('1')
+        repositoryPath = os.path.join(self._path, 'repository')
+        for d in (pm._availablePackagesDir, pm._installScriptsDir, pm._pmDir):
+            os.makedirs(os.path.join(repositoryPath, d))
+        shutil.copy(pm._initFilePath, os.path.join(repositoryPath, pm._pmDir))
+        scriptPath = os.path.join(repositoryPath, pm._installScriptsDir, 'e.sh')
+        with open(scriptPath, 'w') as f:
+            f.write(_installScript)
+        with open(os.path.join(repositoryPath, pm._availablePackagesDir, 'e.json'), 'w') as f:
+            json.dump({'name': 'e', 'version': '1.0', 'type': 'git', 'url': 'file://' + self._sourcePath,
+                    'ref': 'HEAD', 'installScript': 'e.sh', 'installScriptSha256': pm._sha256File(scriptPath),
+                    'supportsDestdir': True, 'dependencies': []}, f)
+        pm.writeRepositoryIndex(repositoryPath)
+        self._server = RepositoryServer(repositoryPath)
+        self._prefix = os.path.join(self._path, 'prefix')
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+        self._server.stop()
+        shutil.rmtree(self._path)
+
+    def _git(self, *arguments):
+        return subprocess.check_output(['git', '-C', self._sourcePath] + list(arguments)).strip()
+
+    def _commit(self, content):
+        with open(os.path.join(self._sourcePath, 'file.txt'), 'w') as f:
+            f.write(content)
+        self._git('add', 'file.txt')
+        self._git('commit', '--quiet', '-m', content)
+        return self._git('rev-parse', 'HEAD')
+
+    def _packageManager(self, **config):
+        """ Return a new package manager on the common package manager
+        directory, updated from the repository. """
+        config = dict({'packageManagerDir': os.path.join(self._path, 'pm'),
+                'packageRepositoryURL': self._server.url,
+                'installationEnvironmentVariables': {'LPM_INSTALL_PREFIX': self._prefix}}, **config)
+        packageManager = pm.PackageManager(config)
+        packageManager.assumeYes = True
+        packageManager.updateAvailablePackages()
+        return packageManager
+
+    def _installedFile(self):
+        with open(os.path.join(self._prefix, 'share', 'e.txt')) as f:
+            return f.read()
+
+    def _phases(self, packageManager, name):
+        return [p for p in packageManager.report.phases if p['phase'] == name]
+
+    def testClone(self):
+        packageManager = self._packageManager()
+        packageManager.installPackages(['e'])
+        self.assertEqual(self._installedFile(), '1')
+        fetches = self._phases(packageManager, 'gitFetch')
+        self.assertEqual(len(fetches), 1)
+        self.assertTrue(fetches[0].get('cloned'))
+        self.assertEqual(fetches[0]['commit'], self._head)
+        self.assertTrue(os.path.isdir(packageManager._gitMirrorPath('file://' + self._sourcePath)))
+        self.assertEqual(packageManager._database.config('e')['resolvedCommit'], self._head)
+
+    def testIncrementalFetch(self):
+        self._packageManager().installPackages(['e'])
+        head = self._commit('2')
+        packageManager = self._packageManager()
+        package = packageManager._availablePackages['e']
+        self.assertEqual(packageManager._fetchGitPackage(package), head)
+        fetch = self._phases(packageManager, 'gitFetch')[0]
+        self.assertTrue(fetch.get('fetched'))
+        self.assertFalse(fetch.get('cloned'))
+        # a mirror having the requested commit isn't fetched again
+        packageManager = self._packageManager()
+        package = packageManager._availablePackages['e']
+        package.resolvedCommit = self._head
+        self.assertEqual(packageManager._fetchGitPackage(package), self._head)
+        self.assertFalse(self._phases(packageManager, 'gitFetch')[0].get('fetched'))
+
+    def testUpgradeSkipsUnchangedRef(self):
+        self._packageManager().installPackages(['e'])
+        packageManager = self._packageManager()
+        packageManager.upgradeInstalledPackages()
+        self.assertEqual(self._phases(packageManager, 'install'), [])
+        head = self._commit('2')
+        packageManager = self._packageManager()
+        packageManager.upgradeInstalledPackages()
+        self.assertEqual(len(self._phases(packageManager, 'install')), 1)
+        self.assertEqual(self._installedFile(), '2')
+        self.assertEqual(packageManager._database.config('e')['resolvedCommit'], head)
+
+    def testWorktreeCheckout(self):
+        self._packageManager(incrementalBuilds=True).installPackages(['e'])
+        worktreePath = os.path.join(self._path, 'pm', pm._buildDir, 'e', 'e')
+        self.assertEqual(subprocess.check_output(['git', '-C', worktreePath, 'rev-parse', 'HEAD']).strip(),
+                self._head)
+        self._commit('2')
+        packageManager = self._packageManager(incrementalBuilds=True)
+        packageManager.upgradeInstalledPackages()
+        self.assertEqual(self._installedFile(), '2')
+        # the worktree was checked out again, keeping the untracked build output
+        with open(os.path.join(worktreePath, 'untracked.o')) as f:
+            self.assertEqual(f.read(), 'built\nbuilt\n')
+
+    def testBinaryCache(self):
+        packageManager = self._packageManager(binaryCache=True)
+        packageManager.installPackages(['e'])
+        binaries = os.listdir(os.path.join(self._path, 'pm', pm._binariesDir))
+        self.assertEqual(len(binaries), 1)
+        # reinstalling the same commit uses the binary, a new commit gets a new one
+        packageManager = self._packageManager(binaryCache=True)
+        packageManager.installPackages(['e'], reinstall=True)
+        self.assertEqual(self._phases(packageManager, 'checkout'), [])
+        self._commit('2')
+        packageManager = self._packageManager(binaryCache=True)
+        packageManager.upgradeInstalledPackages()
+        self.assertEqual(self._installedFile(), '2')
+        self.assertEqual(len(os.listdir(os.path.join(self._path, 'pm', pm._binariesDir))), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+""" Tests of the installation, upgrade and uninstallation of archive
+packages and of the files they install, plainly, through the binary cache
+and into the install store. """
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pm
+from server import RepositoryServer
+
+
+_installScript = """#!/bin/sh
+set -e
+mkdir -p $DESTDIR$LPM_INSTALL_PREFIX/share/{0}
+cp src/* $DESTDIR$LPM_INSTALL_PREFIX/share/{0}/
+"""
+
+
+class _InstallTests(object):
+    """ The tests run with each package manager config of the test
+    classes below. """
+    config = {}
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._repositoryPath = os.path.join(self._path, 'repository')
+        for d in (pm._availablePackagesDir, pm._sourcesDir, pm._installScriptsDir, pm._pmDir):
+            os.makedirs(os.path.join(self._repositoryPath, d))
+        shutil.copy(pm._initFilePath, os.path.join(self._repositoryPath, pm._pmDir))
+        self._publish('a', '1.0', {'one.txt': 'one', 'common.txt': '1'})
+        self._publish('b', '1.0', {'b.txt': 'b'}, ['a'])
+        self._server = RepositoryServer(self._repositoryPath)
+        self._prefix = os.path.join(self._path, 'prefix')
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+        self._server.stop()
+        shutil.rmtree(self._path)
+
+    def _publish(self, name, version, files, dependencies=[]):
+        """ Add version of the package name installing files, a dict mapping
+        file names to their content, into share/name to the repository. """
+        sourceFile = '{0}-{1}.tar.gz'.format(name, version)
+        buildPath = os.path.join(self._path, 'src')
+        os.mkdir(buildPath)
+        for fileName, content in files.iteritems():
+            with open(os.path.join(buildPath, fileName), 'w') as f:
+                f.write(content)
+        sourcePath = os.path.join(self._repositoryPath, pm._sourcesDir, sourceFile)
+        tf = tarfile.open(sourcePath, 'w:gz')
+        try:
+            tf.add(buildPath, 'src')
+        finally:
+            tf.close()
+        shutil.rmtree(buildPath)
+        installScript = name + '.sh'
+        scriptPath = os.path.join(self._repositoryPath, pm._installScriptsDir, installScript)
+        with open(scriptPath, 'w') as f:
+            f.write(_installScript.format(name))
+        # binary cache keys need the checksums
+        with open(os.path.join(self._repositoryPath, pm._availablePackagesDir,
+                '{0}-{1}.json'.format(name, version)), 'w') as f:
+            json.dump({'name': name, 'version': version, 'type': 'archive', 'sourceFile': sourceFile,
+                    'sourceFileSha256': pm._sha256File(sourcePath), 'installScript': installScript,
+                    'installScriptSha256': pm._sha256File(scriptPath),
+                    'supportsDestdir': True, 'dependencies': dependencies}, f)
+        pm.writeRepositoryIndex(self._repositoryPath)
+
+    def _packageManager(self):
+        """ Return a new package manager on the common package manager
+        directory, updated from the repository. """
+        config = dict({'packageManagerDir': os.path.join(self._path, 'pm'),
+                'packageRepositoryURL': self._server.url,
+                'installationEnvironmentVariables': {'LPM_INSTALL_PREFIX': self._prefix}}, **self.config)
+        packageManager = pm.PackageManager(config)
+        packageManager.assumeYes = True
+        packageManager.updateAvailablePackages()
+        return packageManager
+
+    def _file(self, name, fileName):
+        return os.path.join(self._prefix, 'share', name, fileName)
+
+    def _read(self, name, fileName):
+        with open(self._file(name, fileName)) as f:
+            return f.read()
+
+    def _versions(self, packageManager):
+        return dict((name, str(p.version)) for name, p in packageManager.getInstalledPackages().iteritems())
+
+    def testInstallRecordsFiles(self):
+        packageManager = self._packageManager()
+        packageManager.installPackages(['b'])
+        self.assertEqual(self._versions(packageManager), {'a': '1.0', 'b': '1.0'})
+        database = packageManager._database
+        self.assertEqual(sorted(database.files('a')),
+                [self._file('a', 'common.txt'), self._file('a', 'one.txt')])
+        self.assertEqual(database.files('a')[self._file('a', 'one.txt')],
+                (3, hashlib.sha256('one').hexdigest()))
+        self.assertEqual(database.owner(self._file('b', 'b.txt')), 'b')
+        self.assertEqual(database.owner(self._file('b', 'missing.txt')), None)
+
+    def testUpgrade(self):
+        self._packageManager().installPackages(['b'])
+        self._publish('a', '2.0', {'two.txt': 'two', 'common.txt': '2'})
+        packageManager = self._packageManager()
+        packageManager.upgradeInstalledPackages()
+        self.assertEqual(self._versions(packageManager), {'a': '2.0', 'b': '1.0'})
+        self.assertEqual(self._read('a', 'common.txt'), '2')
+        self.assertEqual(self._read('a', 'two.txt'), 'two')
+        files = packageManager._database.files('a')
+        self.assertIn(self._file('a', 'two.txt'), files)
+        self.assertEqual(files[self._file('a', 'common.txt')][1], hashlib.sha256('2').hexdigest())
+        return packageManager
+
+    def testUninstall(self):
+        self._packageManager().installPackages(['b'])
+        packageManager = self._packageManager()
+        # a is still required by b
+        self.assertRaises(pm.PackageManagerError, packageManager.uninstallPackages, ['a'])
+        packageManager.uninstallPackages(['a', 'b'])
+        self.assertEqual(self._versions(packageManager), {})
+        self.assertEqual(packageManager._database.files('a'), {})
+        self.assertFalse(os.path.exists(os.path.join(self._prefix, 'share')))
+        self.assertEqual(self._versions(self._packageManager()), {})
+
+
+class PlainInstallTest(_InstallTests, unittest.TestCase):
+    def testUpgrade(self):
+        _InstallTests.testUpgrade(self)
+        # without a binary the files of the new version aren't known exactly and old ones are kept
+        self.assertTrue(os.path.isfile(self._file('a', 'one.txt')))
+
+    def testUninstallKeepsModifiedFiles(self):
+        self._packageManager().installPackages(['a'])
+        with open(self._file('a', 'one.txt'), 'w') as f:
+            f.write('modified')
+        packageManager = self._packageManager()
+        packageManager.uninstallPackages(['a'])
+        self.assertEqual(self._read('a', 'one.txt'), 'modified')
+        self.assertFalse(os.path.exists(self._file('a', 'common.txt')))
+
+
+class BinaryCacheInstallTest(_InstallTests, unittest.TestCase):
+    config = {'binaryCache': True}
+
+    def testInstallRecordsFiles(self):
+        _InstallTests.testInstallRecordsFiles(self)
+        self.assertEqual(len(os.listdir(os.path.join(self._path, 'pm', pm._binariesDir))), 2)
+
+    def testUpgrade(self):
+        packageManager = _InstallTests.testUpgrade(self)
+        # files of the previous version which the new one doesn't have are removed
+        self.assertFalse(os.path.exists(self._file('a', 'one.txt')))
+        self.assertNotIn(self._file('a', 'one.txt'), packageManager._database.files('a'))
+
+
+class StoreInstallTest(_InstallTests, unittest.TestCase):
+    config = {'installStore': True}
+
+    def _store(self, packageManager):
+        return packageManager._requireStore()
+
+    def testUpgrade(self):
+        packageManager = _InstallTests.testUpgrade(self)
+        self.assertFalse(os.path.exists(self._file('a', 'one.txt')))
+        self.assertTrue(os.path.islink(self._prefix))
+        self.assertEqual(len(self._store(packageManager).generations()), 2)
+
+    def testRollbackAndGarbageCollection(self):
+        self._packageManager().installPackages(['b'])
+        self._publish('a', '2.0', {'two.txt': 'two', 'common.txt': '2'})
+        self._packageManager().upgradeInstalledPackages()
+        packageManager = self._packageManager()
+        store = self._store(packageManager)
+        self.assertEqual(store.generations(), [1, 2])
+        packageManager.rollback()
+        self.assertEqual(store.currentGeneration(), 1)
+        self.assertEqual(self._versions(packageManager), {'a': '1.0', 'b': '1.0'})
+        self.assertEqual(self._read('a', 'one.txt'), 'one')
+        self.assertFalse(os.path.exists(self._file('a', 'two.txt')))
+        self.assertEqual(sorted(packageManager._database.files('a')),
+                [self._file('a', 'common.txt'), self._file('a', 'one.txt')])
+        # the rolled back state is what a new run finds
+        self.assertEqual(self._versions(self._packageManager()), {'a': '1.0', 'b': '1.0'})
+        packageManager.rollback(2)
+        self.assertEqual(self._read('a', 'common.txt'), '2')
+        storePath = os.path.join(self._path, 'pm', pm._storeDir)
+        self.assertEqual(len([e for e in os.listdir(storePath) if not e.startswith('.')]), 3)
+        packageManager.collectGarbage(1)
+        self.assertEqual(store.generations(), [2])
+        # the store entry of a 1.0 isn't used by any generation any more
+        self.assertEqual(len([e for e in os.listdir(storePath) if not e.startswith('.')]), 2)
+        self.assertEqual(self._read('a', 'common.txt'), '2')
+        self.assertRaises(pm.PackageManagerError, packageManager.rollback)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+""" Tests of the version resolution of the package manager. """
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pm
+
+
+class ResolveVersionsTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp(prefix='lpm-test-')
+        self._pm = None
+
+    def tearDown(self):
+        shutil.rmtree(self._path)
+
+    def _packageManager(self, packages):
+        """ Return a package manager with the available meta packages
+        packages, a list of (name, version, dependencies) tuples, added to
+        the ones of previous calls. """
+        availablePath = os.path.join(self._path, pm._availablePackagesDir)
+        if not os.path.isdir(availablePath):
+            os.makedirs(availablePath)
+        for name, version, dependencies in packages:
+            with open(os.path.join(availablePath, '{0}-{1}.json'.format(name, version)), 'w') as f:
+                json.dump({'name': name, 'version': version, 'type': 'meta', 'dependencies': dependencies}, f)
+        return pm.PackageManager({'packageManagerDir': self._path, 'packageRepositoryURL': 'http://localhost/',
+                'installationEnvironmentVariables': {}})
+
+    def _installed(self, packageManager):
+        return dict((name, str(p.version)) for name, p in packageManager.getInstalledPackages().iteritems())
+
+    def _resolve(self, packageManager, requirements):
+        resolved = packageManager._resolveVersions([pm.parseRequirement(r) for r in requirements])
+        return dict((name, str(p.version)) for name, p in resolved.iteritems())
+
+    def testNewestVersions(self):
+        packageManager = self._packageManager([('a', '1', ['b']), ('a', '2', ['b']),
+                ('b', '1', []), ('b', '1.5', [])])
+        self.assertEqual(self._resolve(packageManager, ['a']), {'a': '2', 'b': '1.5'})
+
+    def testConstraints(self):
+        packageManager = self._packageManager([('a', '1', []), ('a', '2', ['b<2']),
+                ('b', '1', []), ('b', '2', [])])
+        self.assertEqual(self._resolve(packageManager, ['a<2']), {'a': '1'})
+        self.assertEqual(self._resolve(packageManager, ['a', 'b']), {'a': '2', 'b': '1'})
+
+    def testBacktrackConstrainingPackage(self):
+        packageManager = self._packageManager([('x', '1', ['a', 'c>=2']),
+                ('a', '1', ['c']), ('a', '2', ['c<2']), ('c', '1', []), ('c', '2', [])])
+        self.assertEqual(self._resolve(packageManager, ['x']), {'x': '1', 'a': '1', 'c': '2'})
+
+    def testBacktrackUnconstrainedDependency(self):
+        # b has no other version, so a which selected b without a constraint is downgraded
+        packageManager = self._packageManager([('x', '1', ['a', 'c>=2']),
+                ('a', '1', []), ('a', '2', ['b']), ('b', '1', ['c<2']), ('c', '1', []), ('c', '2', [])])
+        self.assertEqual(self._resolve(packageManager, ['x']), {'x': '1', 'a': '1', 'c': '2'})
+        self.assertEqual(self._resolve(packageManager, ['a', 'c>=2']), {'a': '1', 'c': '2'})
+
+    def testConstraintsOfDroppedPackagesDontApply(self):
+        # d 1 is only needed by b 2, its constraint on e is dropped with it
+        packageManager = self._packageManager([('a', '1', ['b', 'e']),
+                ('b', '1', []), ('b', '2', ['d', 'f<1']), ('d', '1', ['e<2']), ('e', '1', []), ('e', '2', []),
+                ('f', '1', [])])
+        self.assertEqual(self._resolve(packageManager, ['a']), {'a': '1', 'b': '1', 'e': '2'})
+
+    def testConflict(self):
+        packageManager = self._packageManager([('a', '1', ['c<2']), ('b', '1', ['c>=2']),
+                ('c', '1', []), ('c', '2', [])])
+        self.assertRaises(pm.PackageManagerError, self._resolve, packageManager, ['a', 'b'])
+
+    def testMissingDependency(self):
+        packageManager = self._packageManager([('a', '1', ['b'])])
+        self.assertRaises(pm.PackageManagerError, self._resolve, packageManager, ['a'])
+
+    def testInstalledConstraints(self):
+        packageManager = self._packageManager([('a', '1', ['b<2']), ('b', '1', []), ('c', '1', ['b'])])
+        packageManager.assumeYes = True
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            packageManager.installPackages(['a', 'c'])
+            packageManager = self._packageManager([('b', '2', []), ('c', '2', ['b']), ('x', '1', ['b>=2'])])
+            packageManager.assumeYes = True
+            # the upgrade keeps b 1 as the installed a needs it
+            packageManager.upgradeInstalledPackages()
+            self.assertEqual(self._installed(packageManager), {'a': '1', 'b': '1', 'c': '2'})
+            self.assertRaises(pm.PackageManagerError, packageManager.installPackages, ['x'])
+            self.assertEqual(self._resolve(packageManager, ['x']), {'x': '1', 'b': '2'})
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+
+if __name__ == '__main__':
+    unittest.main()